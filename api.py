@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""Local HTTP API serving the stored forecasts and their postcards.
+
+Endpoints:
+
+- ``GET /forecast?from=YYYY-MM-DD&to=YYYY-MM-DD&location=LAT,LON`` - the forecasts of the days from ``from`` up to
+  but not including ``to`` as JSON, the next 10 days of the default location by default;
+- ``GET /postcard/YYYY-MM-DD?location=LAT,LON`` - the JPEG postcard of the day;
+- ``GET /stats`` - the counters of the postcards cache.
+
+Encoded postcards are kept in a LRU cache bounded by their total size. A cached postcard is tagged with the digest
+of its Forecast row, so it is rendered again as soon as the row changes, e.g. after a refresh of the daemon.
+The digest is also the ETag of the postcard, the answer to a request with a matching If-None-Match is 304.
+
+Usage: python api.py [--host HOST] [--port PORT] [--cache-bytes BYTES]
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import threading
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from assets import get_assets
+from base import DatabaseUpdater, Forecast
+from constants import API_HOST, API_PORT, API_CACHE_BYTES, DEFAULT_LOCATION, TEMPLATE_PATH
+from locations import parse_location
+from postcard import ImageMaker
+
+FORECAST_DAYS = 10  # days of the forecast range if it is not given
+
+
+class PostcardCache:
+    """Thread-safe LRU cache of encoded postcards, bounded by the total size of the postcards.
+
+    Every postcard is stored with the version of the data it was rendered from, a request with another version
+    evicts it.
+
+    Args:
+        max_bytes: The maximum total size of the postcards.
+    """
+
+    def __init__(self, max_bytes: int = API_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._items: OrderedDict[tuple, tuple[str, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, version: str) -> Optional[bytes]:
+        """Returns the postcard rendered from the data of the version or None."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] == version:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, version: str, data: bytes) -> None:
+        """Stores the postcard, evicting the least recently used ones to stay within the size limit."""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = version, data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def invalidate(self, key: tuple) -> None:
+        """Drops the postcard if it is cached."""
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {'items': len(self._items), 'bytes': self.size, 'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def _remove(self, key: tuple) -> None:
+        self.size -= len(self._items.pop(key)[1])
+
+
+def get_forecast_version(forecast: dict) -> str:
+    """Digest of the forecast fields drawn on the postcard, used as the version of the postcard and its ETag."""
+    drawn_fields = (forecast['date'], forecast['weather_type'], forecast['temperature'], forecast['weather_category'])
+    return hashlib.sha1(repr(drawn_fields).encode()).hexdigest()[:20]
+
+
+class ForecastAPI:
+    """Answers the API requests: reads the forecasts from the database and renders the postcards.
+
+    Args:
+        cache: The cache of the encoded postcards.
+        path_to_template: The path to the postcard's template file.
+    """
+
+    def __init__(self, cache: Optional[PostcardCache] = None, path_to_template: str = TEMPLATE_PATH):
+        self.cache = cache if cache is not None else PostcardCache()
+        self.path_to_template = path_to_template
+        self.db_updater = DatabaseUpdater()
+        self._local = threading.local()  # an image maker per thread, it keeps the size of the drawn postcard
+        get_assets(path_to_template)
+
+    def get_forecasts(self, starts_from: datetime.date, to: datetime.date, location: str = DEFAULT_LOCATION) -> list:
+        """The forecasts of the days from starts_from up to but not including to in JSON compatible format."""
+        forecasts = self.db_updater.get_forecasts(starts_from, to, location)
+        for forecast in forecasts:
+            forecast['date'] = forecast['date'].isoformat()
+            if forecast['fetched_at'] is not None:
+                forecast['fetched_at'] = forecast['fetched_at'].isoformat(timespec='seconds')
+        return forecasts
+
+    def get_postcard(self, day: datetime.date, location: str = DEFAULT_LOCATION,
+                     if_none_match: Optional[str] = None) -> tuple[Optional[str], Optional[bytes]]:
+        """Gets the encoded postcard of the day from the cache or renders it.
+
+        :param day: the date of the postcard
+        :param location: coordinates of the forecast location
+        :param if_none_match: the ETag of the postcard the client has
+        :return: the ETag and the JPEG bytes of the postcard, the bytes are None if the client has the same postcard;
+            (None, None) if there is no forecast for the day
+        """
+        forecasts = self.db_updater.get_forecasts(day, day + datetime.timedelta(days=1), location)
+        if not forecasts:
+            return None, None
+        version = get_forecast_version(forecasts[0])
+        etag = f'"{version}"'
+        if if_none_match is not None and etag in (tag.strip() for tag in if_none_match.split(',')):
+            return etag, None
+
+        key = location, day
+        postcard = self.cache.get(key, version)
+        if postcard is None:
+            record = next(self.db_updater.iter_data_for_dates([day], location), None)
+            if record is None:  # deleted after the version was read
+                return None, None
+            postcard = self._get_image_maker().encode_postcard(record)
+            self.cache.put(key, version, postcard)
+        return etag, postcard
+
+    def _get_image_maker(self) -> ImageMaker:
+        image_maker = getattr(self._local, 'image_maker', None)
+        if image_maker is None:
+            image_maker = self._local.image_maker = ImageMaker('', self.path_to_template)
+        return image_maker
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    """Routes the requests to the ForecastAPI of the server."""
+    protocol_version = 'HTTP/1.1'  # keep-alive connections, every answer has Content-Length
+    disable_nagle_algorithm = True  # the headers and the body are written separately
+
+    def setup(self):
+        super().setup()
+        Forecast._meta.database.connect(reuse_if_open=True)  # a database connection per client connection
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            Forecast._meta.database.close()
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            location = parse_location(query.get('location', DEFAULT_LOCATION))
+            if url.path == '/forecast':
+                self.send_forecasts(query, location)
+            elif url.path.startswith('/postcard/'):
+                self.send_postcard(datetime.date.fromisoformat(url.path[len('/postcard/'):]), location)
+            elif url.path == '/stats':
+                self.send_json(200, self.server.api.cache.get_stats())
+            else:
+                self.send_json(404, {'error': f'{url.path} is not found'})
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+
+    def send_forecasts(self, query: dict, location: str) -> None:
+        starts_from = datetime.date.fromisoformat(query['from']) if 'from' in query else datetime.date.today()
+        to = datetime.date.fromisoformat(query['to']) if 'to' in query \
+            else starts_from + datetime.timedelta(days=FORECAST_DAYS)
+        body = json.dumps(self.server.api.get_forecasts(starts_from, to, location)).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304, b'', {'ETag': etag})
+        else:
+            self.send_body(200, body, {'ETag': etag, 'Content-Type': 'application/json'})
+
+    def send_postcard(self, day: datetime.date, location: str) -> None:
+        etag, postcard = self.server.api.get_postcard(day, location, self.headers.get('If-None-Match'))
+        if etag is None:
+            self.send_json(404, {'error': f'there is no forecast for {day} in {location}'})
+        elif postcard is None:
+            self.send_body(304, b'', {'ETag': etag})
+        else:
+            self.send_body(200, postcard, {'ETag': etag, 'Content-Type': 'image/jpeg', 'Cache-Control': 'no-cache'})
+
+    def send_json(self, status_code: int, data) -> None:
+        self.send_body(status_code, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+    def send_body(self, status_code: int, body: bytes, headers: dict) -> None:
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class APIServer(ThreadingHTTPServer):
+    """HTTP server of the API, a thread per connection."""
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int] = (API_HOST, API_PORT), api: Optional[ForecastAPI] = None):
+        super().__init__(address, APIHandler)
+        self.api = api if api is not None else ForecastAPI()
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    """Serves the API until SIGINT."""
+    parser = argparse.ArgumentParser(description='Serve the forecasts and the postcards over HTTP')
+    parser.add_argument('--host', type=str, default=API_HOST, help='host to listen on')
+    parser.add_argument('--port', type=int, default=API_PORT, help='port to listen on')
+    parser.add_argument('--cache-bytes', type=int, default=API_CACHE_BYTES,
+                        help='total size of the encoded postcards kept in memory')
+    params = parser.parse_args(args)
+
+    server = APIServer((params.host, params.port), ForecastAPI(PostcardCache(params.cache_bytes)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Registry of decoded postcard assets.
+
+The postcard template and the weather icons from ``ICONS_DATA`` are decoded once per process and kept
+already resized to the postcard size, so rendering a batch of postcards does no repeated decoding or file I/O.
+"""
+import os
+from functools import lru_cache
+from typing import Optional
+
+import cv2
+from numpy import ndarray
+
+from constants import TEMPLATE_PATH, ICONS_PATH, ICONS_DATA, ICON_FILE_NAME
+from metrics import get_metrics
+from overlay import IconOverlay
+from utils import get_norm_and_joined_path, make_read_only
+
+
+class AssetRegistry:
+    """Decoded postcard template and weather icons prepared for the postcard size and for the overlaying.
+
+    All the arrays are handed out as read-only views: copy the template before drawing on it.
+    """
+
+    ICON_SCALE = .4  # icon side relative to the postcard side
+
+    def __init__(self, path_to_template: str = TEMPLATE_PATH, icons_path: str = ICONS_PATH):
+        """Decodes the template and the icons from ICONS_DATA.
+
+        :param path_to_template: the path to the postcard's template file
+        :param icons_path: the directory with the weather icons
+        """
+        template = cv2.imread(path_to_template)
+        if template is None:
+            raise FileNotFoundError(f'Postcard template {path_to_template} can not be read')
+
+        self.postcard_side = max(template.shape[:2])
+        self.icon_side = int(self.postcard_side * self.ICON_SCALE)
+        self._template = make_read_only(cv2.resize(template, (self.postcard_side, self.postcard_side)))
+        self._icons = {}
+        self._overlays = {}  # id of a registered icon array -> its overlay
+        for icon_data in ICONS_DATA.values():
+            if icon_data[ICON_FILE_NAME]:
+                self.icon(get_norm_and_joined_path(icons_path, icon_data[ICON_FILE_NAME]))
+
+    @property
+    def template(self) -> ndarray:
+        """Square postcard template, read-only."""
+        return self._template.view()
+
+    def icon(self, icon_path: str) -> Optional[ndarray]:
+        """Get the icon resized to the postcard icon size, decoding it on the first request only.
+
+        :param icon_path: the path to the icon file, as stored in the database
+        :return: a read-only BGRA icon array or None if the icon can not be read
+        """
+        key = os.path.normpath(icon_path)
+        if key not in self._icons:
+            with get_metrics().timer('decode_icon'):
+                icon = cv2.imread(key, -1)
+                if icon is not None:
+                    icon = make_read_only(self.fit_icon(icon))
+                    self._overlays[id(icon)] = IconOverlay(icon)
+            self._icons[key] = icon
+        icon = self._icons[key]
+        return None if icon is None else icon.view()
+
+    def fit_icon(self, icon: ndarray) -> ndarray:
+        """Resize an icon to the postcard icon size unless it already has it.
+
+        :param icon: a BGRA icon array of any size
+        :return: the icon of the postcard icon size
+        """
+        if icon.shape[:2] == (self.icon_side, self.icon_side):
+            return icon
+        return cv2.resize(icon, (self.icon_side, self.icon_side))
+
+    def overlay(self, icon: ndarray) -> IconOverlay:
+        """Get the overlay of an icon, precompiled for the icons handed out by the registry.
+
+        A slice or another partial view of a registered icon gets an overlay computed for it.
+
+        :param icon: a BGRA icon array
+        :return: the overlay of the icon
+        """
+        registered_icon = icon if icon.base is None else icon.base
+        overlay = self._overlays.get(id(registered_icon))
+        if overlay is not None and icon.shape == registered_icon.shape and icon.strides == registered_icon.strides \
+                and icon.ctypes.data == registered_icon.ctypes.data:
+            return overlay
+        return IconOverlay(icon)
+
+
+@lru_cache(maxsize=None)
+def get_assets(path_to_template: str = TEMPLATE_PATH) -> AssetRegistry:
+    """Get the process-wide asset registry for the template.
+
+    :param path_to_template: the path to the postcard's template file
+    :return: the registry, created on the first call only
+    """
+    return AssetRegistry(path_to_template)
@@ -1,16 +1,44 @@
 # -*- coding: utf-8 -*-
 import datetime
-import sqlite3
-from typing import Optional
+import threading
+import time
+from collections import defaultdict
+import weakref
+from typing import TYPE_CHECKING, Iterable, Iterator, NamedTuple, Optional, Union
 
-import cv2
 import peewee
-from numpy.core.multiarray import ndarray
 
-from constants import DATE_FORMAT_ON_POSTCARD
+from constants import DATE_FORMAT_ON_POSTCARD, SYNC_TTL, DEFAULT_LOCATION, WEATHER_CATEGORY_CODES, ICONS_DATA, \
+    ICONS_PATH, ICON_FILE_NAME, COLOR, WEATHER_TYPE, WEATHER_CATEGORY, NO_TEMPERATURE
+from metrics import get_metrics
+from utils import get_norm_and_joined_path
+
+if TYPE_CHECKING:
+    from numpy import ndarray
 
 DATABASE_NAME = 'weather.db'
-database = peewee.SqliteDatabase(DATABASE_NAME)
+DATABASE_TIMEOUT = 30  # seconds to wait for the write lock taken by another connection
+DATABASE_PRAGMAS = {
+    'journal_mode': 'wal',  # readers and the writer do not block each other
+    'synchronous': 'normal',  # durable with WAL, the file is synced on checkpoints only
+    'cache_size': -32 * 1024,  # KiB of page cache per connection
+    'mmap_size': 256 * 1024 * 1024,  # bytes of the file read through memory mapping
+    'temp_store': 'memory',
+}
+SQLITE_MAX_VARIABLES = 999  # per query in SQLite before 3.32, newer versions allow 32766
+
+
+def create_database(name: str = DATABASE_NAME) -> peewee.SqliteDatabase:
+    """Creates the database manager, it opens a connection per thread on its first query.
+
+    Close the connection of a worker thread with ``database.connection_context()`` or ``database.close()``.
+
+    :param name: the path to the database file
+    """
+    return peewee.SqliteDatabase(name, pragmas=DATABASE_PRAGMAS, timeout=DATABASE_TIMEOUT)
+
+
+database = create_database()
 
 
 class BaseTable(peewee.Model):
@@ -18,64 +46,307 @@ class BaseTable(peewee.Model):
         database = database
 
 
+class WeatherCategory(BaseTable):
+    """Lookup table of the weather types from ICONS_DATA with their icons and colors."""
+    code = peewee.IntegerField(primary_key=True)
+    name = peewee.CharField(unique=True)
+    icon_path = peewee.CharField()
+    colors = peewee.CharField()  # BGR in "b, g, r" format
+
+
 class Forecast(BaseTable):
-    date = peewee.DateTimeField(unique=True)
-    temperature = peewee.CharField()
+    location = peewee.CharField(default=DEFAULT_LOCATION)  # "latitude,longitude"
+    date = peewee.DateField()
+    temperature = peewee.FloatField(null=True)  # unknown for the legacy rows with unparsable text
     weather_type = peewee.CharField()
-    icon_path = peewee.CharField()
-    colors = peewee.CharField()
+    weather_category = peewee.ForeignKeyField(WeatherCategory, column_name='weather_category')
+    fetched_at = peewee.DateTimeField(null=True)
+
+    class Meta:
+        # the primary key of a table without rowid is its clustered index,
+        # range queries by date for a location read adjacent pages
+        primary_key = peewee.CompositeKey('location', 'date')
+        without_rowid = True
+
+
+class HourlyForecast(BaseTable):
+    location = peewee.CharField(default=DEFAULT_LOCATION)
+    date = peewee.DateField()
+    time = peewee.IntegerField()  # unix timestamp of the hour
+    summary = peewee.CharField(null=True)
+    temperature = peewee.FloatField(null=True)
+    apparent_temperature = peewee.FloatField(null=True)
+    precip_probability = peewee.FloatField(null=True)
+    humidity = peewee.FloatField(null=True)
+    wind_speed = peewee.FloatField(null=True)
+    tz_offset = peewee.FloatField(null=True)  # hours from UTC to the local time of the location
+
+    class Meta:
+        indexes = (
+            (('location', 'time'), True),
+            (('location', 'date'), False),
+        )
+
+
+MODELS = (WeatherCategory, Forecast, HourlyForecast)
+
+
+def get_weather_categories() -> list[dict]:
+    """Rows of the WeatherCategory table built from ICONS_DATA."""
+    return [{
+        'code': code,
+        'name': name,
+        'icon_path': get_norm_and_joined_path(ICONS_PATH, ICONS_DATA[name][ICON_FILE_NAME])
+        if ICONS_DATA[name][ICON_FILE_NAME] else '',
+        'colors': ICONS_DATA[name][COLOR],
+    } for name, code in WEATHER_CATEGORY_CODES.items()]
+
+
+def setup_database(db: peewee.SqliteDatabase = database) -> None:
+    """Creates the tables, converts the tables of previous versions in place and fills the lookup table.
+
+    :param db: the database to set up, its file is created if it does not exist
+    """
+    from migrations import migrate_data, migrate_schema
+
+    with db.bind_ctx(MODELS):
+        migrate_schema(db)
+        with db.atomic('IMMEDIATE'):  # take the write lock at once, a read transaction is not upgraded
+            db.create_tables(MODELS)
+        bulk_upsert(WeatherCategory, get_weather_categories(), WeatherCategory.code)
+        migrate_data(db)
+    _set_up_databases.add(db)
+
+
+_set_up_databases = weakref.WeakSet()  # the databases set up by this process
+_setup_lock = threading.Lock()  # the threads using a database for the first time set it up once
+
+
+def ensure_database(db: Optional[peewee.SqliteDatabase] = None) -> peewee.SqliteDatabase:
+    """Sets up the database on its first use in the process, the tables are not touched on import.
+
+    :param db: the database, the one the models are bound to if it is None
+    :return: the database
+    """
+    db = db if db is not None else Forecast._meta.database
+    if db not in _set_up_databases:
+        with _setup_lock:
+            if db not in _set_up_databases:  # set up by another thread while this one waited
+                setup_database(db)
+    return db
+
+
+def bulk_upsert(model: type[BaseTable], rows: list[dict],
+                conflict_target: Union[peewee.Field, tuple[peewee.Field, ...]]) -> int:
+    """Inserts rows or updates the existing ones with multi-row inserts in one transaction.
 
+    Rows are inserted in chunks small enough to stay under the SQLite limit of variables per query.
 
-database.create_tables([Forecast])
+    :param model: the table to write to
+    :param rows: dicts of field values, all of them with the same keys
+    :param conflict_target: the unique field or the fields of a unique index identifying the existing rows
+    :return: count of written rows
+    """
+    if not rows:
+        return 0
+    conflict_target = conflict_target if isinstance(conflict_target, tuple) else (conflict_target,)
+    fields = [model._meta.fields[name] for name in rows[0]]
+    chunk_size = max(1, SQLITE_MAX_VARIABLES // len(fields))
+    preserve = [field for field in fields if not any(field is target for target in conflict_target)]
+    with model._meta.database.atomic('IMMEDIATE'):  # take the write lock at once, waiting for it if needed
+        for chunk in peewee.chunked(rows, chunk_size):
+            model.insert_many(chunk).on_conflict(conflict_target=conflict_target, preserve=preserve).execute()
+    return len(rows)
+
+
+class ForecastRecord(NamedTuple):
+    """Forecast prepared for a postcard, the icon is decoded on the first access to the icon property only."""
+    weather_type: str
+    date: str  # in DATE_FORMAT_ON_POSTCARD format
+    temperature: str
+    icon_path: Optional[str]  # None if there is no icon for the weather
+    color: tuple[int, int, int]
+    day: Optional[datetime.date] = None  # the date of the forecast, for the year in the postcard file name
+
+    @property
+    def icon(self) -> Optional['ndarray']:
+        """The icon resized for the postcard, shared by all the records with the same icon path."""
+        from assets import get_assets
+
+        return get_assets().icon(self.icon_path) if self.icon_path else None
 
 
 class DatabaseUpdater:
-    """Class updates database: inserts and extracts data."""
+    """Class updates database: inserts and extracts data.
+
+    The database the models are bound to is set up when the first updater is created.
+    """
 
     def __init__(self):
-        self.conn = sqlite3.connect(DATABASE_NAME)
-        self.conn.text_factory = bytes
+        ensure_database()
 
-    def get_data_from_db(self, starts_from: datetime.date = None, to: datetime.date = None):
+    def get_data_from_db(self, starts_from: datetime.date = None, to: datetime.date = None,
+                         location: str = DEFAULT_LOCATION) -> list[ForecastRecord]:
         """Extracts data from database in dates range from date_range param and returns it.
 
         :param starts_from: first date of diapason used to get forecast
         :param to: last date of diapason used to get forecast
-        :rtype: list[tuple[str, str, str, Optional[ndarray], tuple[int, int, int]]]
+        :param location: coordinates of the forecasts location
+        """
+        return list(self.iter_data_from_db(starts_from, to, location))
+
+    def iter_data_from_db(self, starts_from: datetime.date = None, to: datetime.date = None,
+                          location: str = DEFAULT_LOCATION) -> Iterator[ForecastRecord]:
+        """Streams data from database in dates range ordered by date, row by row without caching the rows.
+
+        Icons are not decoded here, the records keep their paths, so memory does not depend on the range length.
+
+        :param starts_from: first date of diapason used to get forecast
+        :param to: last date of diapason used to get forecast
+        :param location: coordinates of the forecasts location
         """
         first_day = starts_from or datetime.date.today() - datetime.timedelta(weeks=1)
         last_day = to or datetime.date.today() + datetime.timedelta(days=10)
-        res = Forecast.select().where(
-            Forecast.date.between(
-                first_day - datetime.timedelta(days=1), last_day - datetime.timedelta(days=1))
-        )
-        self.conn.close()
-        return [self.__unpack_data((
-            field.weather_type, field.date, field.temperature, field.icon_path, field.colors
-        ))
-            for field in res]
+        return self.__iter_records((Forecast.location == location) & Forecast.date.between(
+            first_day - datetime.timedelta(days=1), last_day - datetime.timedelta(days=1)))
+
+    def iter_data_for_dates(self, dates: Iterable[datetime.date],
+                            location: str = DEFAULT_LOCATION) -> Iterator[ForecastRecord]:
+        """Streams data from database for the dates ordered by date, the dates without forecast are skipped.
+
+        :param dates: dates of the forecasts
+        :param location: coordinates of the forecasts location
+        """
+        return self.__iter_records((Forecast.location == location) & Forecast.date.in_(list(dates)))
+
+    def __iter_records(self, condition: peewee.Expression) -> Iterator[ForecastRecord]:
+        """Streams the forecasts matching the condition ordered by date."""
+        categories = {
+            code: (icon_path or None, tuple(map(int, colors.split(','))))
+            for code, icon_path, colors in WeatherCategory.select(
+                WeatherCategory.code, WeatherCategory.icon_path, WeatherCategory.colors).tuples()
+        }
+        res = Forecast.select(
+            Forecast.weather_type, Forecast.date, Forecast.temperature, Forecast.weather_category
+        ).where(condition).order_by(Forecast.date).tuples()
+        fields, metrics = res.iterator(), get_metrics()
+        while True:
+            started = time.perf_counter()  # the reading of the row and its preparation are timed
+            field = next(fields, None)
+            if field is None:
+                return
+            record = self.__unpack_data(field, categories)
+            metrics.observe('load', time.perf_counter() - started)
+            yield record
+
+    def get_forecasts(self, starts_from: datetime.date, to: datetime.date,
+                      location: str = DEFAULT_LOCATION) -> list[dict]:
+        """Extracts the stored forecasts for the days from starts_from up to but not including to.
+
+        :param starts_from: first date of diapason used to get forecast
+        :param to: the date following the last date of diapason
+        :param location: coordinates of the forecasts location
+        :return: dicts with the date, temperature, weather type, weather category code and name and fetch time
+            ordered by date
+        """
+        return list(Forecast.select(
+            Forecast.date, Forecast.temperature, Forecast.weather_type, Forecast.weather_category,
+            WeatherCategory.name.alias('weather_category_name'), Forecast.fetched_at
+        ).join(WeatherCategory).where(
+            (Forecast.location == location) & (Forecast.date >= starts_from) & (Forecast.date < to)
+        ).order_by(Forecast.date).dicts())
+
+    def get_dates_to_sync(self, dates: list[datetime.date], now: Optional[datetime.datetime] = None,
+                          ttl: float = SYNC_TTL, location: str = DEFAULT_LOCATION) -> list[datetime.date]:
+        """Finds the dates without forecast in database or with a stale one.
+
+        The forecast is up-to-date if it was fetched after the end of its day or less than ttl seconds ago.
+
+        :param dates: dates to check
+        :param now: the current time, datetime.datetime.now() by default
+        :param ttl: seconds to keep the forecasts fetched before the end of their days
+        :param location: coordinates of the forecasts location
+        :return: the dates to fetch in the order of the dates param
+        """
+        if not dates:
+            return []
+        now = now or datetime.datetime.now()
+        up_to_date = set()
+        rows = Forecast.select(Forecast.date, Forecast.fetched_at).where(
+            (Forecast.location == location) & Forecast.date.between(min(dates), max(dates)))
+        for row in rows:
+            if row.fetched_at is None:
+                continue
+            fetched_after_day = row.fetched_at.date() > row.date
+            if fetched_after_day or (now - row.fetched_at).total_seconds() < ttl:
+                up_to_date.add(row.date)
+        return [day for day in dates if day not in up_to_date]
 
     def save_weather_to_db(self, forecast: list[dict]):
         """Executes updating (if some fields exists yet)
         or inserting data to database.
 
         :param forecast: forecasts collected by parser"""
+        fetched_at = datetime.datetime.now()
+        with get_metrics().timer('store'):
+            bulk_upsert(Forecast, [dict(day_weather, fetched_at=fetched_at) for day_weather in forecast],
+                        (Forecast.location, Forecast.date))
+        get_metrics().count('forecasts_stored', len(forecast))
+
+    def save_changed_weather_to_db(self, forecast: list[dict]) -> list[dict]:
+        """Saves the forecasts like save_weather_to_db and finds the ones which differ from the stored forecasts.
+
+        :param forecast: forecasts collected by parser
+        :return: the forecasts of the days without forecast in database or with another weather type,
+            temperature or weather category
+        """
+        dates_of_locations = defaultdict(set)
         for day_weather in forecast:
-            Forecast.insert(**day_weather).on_conflict(
-                conflict_target=(Forecast.date,),
-                update=day_weather
-            ).execute()
-        self.conn.commit()
+            dates_of_locations[day_weather.get('location', DEFAULT_LOCATION)].add(day_weather['date'])
+        # nothing can be written by other connections between the comparison and the saving
+        with Forecast._meta.database.atomic('IMMEDIATE'):
+            stored = {}
+            for location, dates in dates_of_locations.items():
+                rows = Forecast.select(
+                    Forecast.date, Forecast.weather_type, Forecast.temperature, Forecast.weather_category
+                ).where((Forecast.location == location) & Forecast.date.in_(list(dates))).tuples()
+                stored.update(((location, day), values) for day, *values in rows)
+            changed = [day_weather for day_weather in forecast if stored.get(
+                (day_weather.get('location', DEFAULT_LOCATION), day_weather['date'])
+            ) != [day_weather[WEATHER_TYPE], day_weather['temperature'], day_weather[WEATHER_CATEGORY]]]
+            self.save_weather_to_db(forecast)
+        return changed
+
+    def save_hourly_to_db(self, hourly_forecast: list[dict]):
+        """Executes updating (if some hours exist yet) or inserting hourly forecasts to database.
+
+        :param hourly_forecast: hourly forecasts collected by parser"""
+        with get_metrics().timer('store'):
+            bulk_upsert(HourlyForecast, hourly_forecast, (HourlyForecast.location, HourlyForecast.time))
+        get_metrics().count('hourly_forecasts_stored', len(hourly_forecast))
+
+    def get_hourly_from_db(self, starts_from: datetime.date, to: datetime.date,
+                           location: str = DEFAULT_LOCATION) -> list[dict]:
+        """Extracts hourly forecasts for the days from starts_from up to but not including to.
+
+        :param starts_from: first date of diapason used to get forecast
+        :param to: the date following the last date of diapason
+        :param location: coordinates of the forecasts location
+        :return: dicts of HourlyForecast fields ordered by time
+        """
+        return list(HourlyForecast.select().where(
+            (HourlyForecast.location == location) & (HourlyForecast.date >= starts_from) & (HourlyForecast.date < to)
+        ).order_by(HourlyForecast.time).dicts())
 
     @staticmethod
-    def __unpack_data(data: tuple) -> tuple[str, str, str, Optional[ndarray], tuple[int, ...]]:
+    def __unpack_data(data: tuple, categories: dict) -> ForecastRecord:
         """Prepares data from database and returns it.
 
-        :param data: field of Forecast table contains weather type and temp at this date, icon path and color
+        :param data: field of Forecast table contains weather type, date, temperature and weather category code
+        :param categories: icon path and BGR color by weather category code
         :return: prepared data. For example convert date - datetime.date(2021, 11, 7) -> 'Sun, 7 Nov' """
-        weather_type, _date, temp, icon_path, color = data
-        date = str(_date.strftime(DATE_FORMAT_ON_POSTCARD))
-        temp = temp.split('.')[0]
-        icon = cv2.imread(icon_path, -1) if icon_path else None
-        color = tuple(map(int, color.split(',')))
-        return weather_type, date, temp, icon, color
+        weather_type, _date, temperature, category = data
+        icon_path, color = categories[category]
+        date = _date.strftime(DATE_FORMAT_ON_POSTCARD)
+        temp = str(int(temperature)) if temperature is not None else NO_TEMPERATURE
+        return ForecastRecord(weather_type, date, temp, icon_path, color, _date)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Batch postcard rendering spread across a pool of worker processes.
+
+Every worker loads the postcard assets once, then renders and JPEG-encodes the postcards it gets.
+The encoded postcards are written by the calling process in the order of the forecast,
+so the files are the same as the ones saved by ``ImageMaker.save_postcard`` one by one.
+With a render manifest the postcards whose inputs have not changed since they were saved are skipped
+before they are sent to the workers. A resident caller keeps one pool from ``create_render_pool`` for all its
+renders, so the workers load the assets once for the life of the pool instead of once per call.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+from assets import get_assets
+from constants import TEMPLATE_PATH
+from manifest import RenderManifest
+from metrics import enable_metrics, get_metrics
+from postcard import ImageMaker, get_forecast_day
+
+PENDING_POSTCARDS_PER_WORKER = 8  # forecasts taken from the iterable at once, bounds the memory for long ranges
+
+_worker_image_maker: Optional[ImageMaker] = None
+
+
+def _init_worker(path_to_template: str, collect_metrics: bool = False) -> None:
+    """Loads the assets and creates the image maker of a worker process."""
+    global _worker_image_maker
+    if collect_metrics:
+        enable_metrics()
+    get_assets(path_to_template)
+    _worker_image_maker = ImageMaker('', path_to_template)
+
+
+def _encode_in_worker(data: tuple) -> tuple[bytes, Optional[dict]]:
+    """Encodes the postcard, returns it with the metrics collected since the previous postcard if they are enabled."""
+    encoded_postcard = _worker_image_maker.encode_postcard(data)
+    metrics = get_metrics()
+    return encoded_postcard, metrics.pop_snapshot() if metrics.enabled else None
+
+
+def create_render_pool(workers: int, path_to_template: str = TEMPLATE_PATH) -> ProcessPoolExecutor:
+    """Creates the pool of processes rendering postcards, which can be shared by several render_postcards calls.
+
+    The processes are started on the first render and collect the metrics if they are enabled at the creation.
+
+    :param workers: count of worker processes
+    :param path_to_template: the path to the postcard's template file
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(path_to_template, get_metrics().enabled))
+
+
+def _skip_current(forecast: Iterable[tuple], image_maker: ImageMaker,
+                  manifest: Optional[RenderManifest]) -> Iterator[tuple[tuple, Optional[str]]]:
+    """Yields the forecasts with the digests of their inputs, leaving out the ones saved from the same inputs."""
+    for data in forecast:
+        if manifest is None:
+            yield data, None
+            continue
+        digest = manifest.get_digest(data)
+        if not manifest.is_current(image_maker.get_postcard_path(data[1], get_forecast_day(data)), digest):
+            yield data, digest
+        else:
+            get_metrics().count('postcards_skipped')
+
+
+def render_postcards(forecast: Iterable[tuple], path_to_save: str, workers: int = 1,
+                     path_to_template: str = TEMPLATE_PATH, manifest: Optional[RenderManifest] = None,
+                     executor: Optional[ProcessPoolExecutor] = None) -> int:
+    """Render, encode and save postcards for every forecast using a pool of processes.
+
+    :param forecast: database fields prepared by DatabaseUpdater, consumed lazily
+    :param path_to_save: the directory where weather postcards will be stored
+    :param workers: count of worker processes, postcards are rendered in this process if it is 1 and there is
+        no executor
+    :param path_to_template: the path to the postcard's template file
+    :param manifest: the render manifest of path_to_save, all the postcards are rendered if it is None
+    :param executor: the pool created by create_render_pool with the same template, it is left running;
+        a pool of workers processes is created for the call if it is None
+    :return: count of saved postcards
+    """
+    image_maker = ImageMaker(path_to_save, path_to_template)
+    pending = _skip_current(forecast, image_maker, manifest)
+    count_of_postcards = 0
+
+    def save(data: tuple, digest: Optional[str], encoded_postcard: bytes) -> None:
+        nonlocal count_of_postcards
+        postcard_path = image_maker.write_postcard(data[1], encoded_postcard, get_forecast_day(data))
+        if manifest is not None:
+            manifest.record(postcard_path, digest)
+        get_metrics().count('postcards_rendered')
+        count_of_postcards += 1
+
+    try:
+        if workers <= 1 and executor is None:
+            for data, digest in pending:
+                save(data, digest, image_maker.encode_postcard(data))
+            return count_of_postcards
+
+        chunk = list(islice(pending, workers * PENDING_POSTCARDS_PER_WORKER))
+        if not chunk:  # the workers are not started if every postcard is current
+            return count_of_postcards
+        metrics = get_metrics()
+        with nullcontext(executor) if executor is not None else create_render_pool(workers, path_to_template) as pool:
+            while chunk:
+                encoded_postcards = pool.map(_encode_in_worker, [data for data, _ in chunk])
+                for (data, digest), (encoded_postcard, worker_metrics) in zip(chunk, encoded_postcards):
+                    if worker_metrics is not None:
+                        metrics.merge(worker_metrics)
+                    save(data, digest, encoded_postcard)
+                chunk = list(islice(pending, workers * PENDING_POSTCARDS_PER_WORKER))
+        return count_of_postcards
+    finally:
+        if manifest is not None:
+            manifest.save()
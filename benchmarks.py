@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite of the project stages: startup, fetch, parse, store, load and render.
+
+Every benchmark runs without the live site: pages are fetched from a local server of the saved HTML samples,
+forecasts are generated, postcards are rendered from templates of several sizes. Where the stage had
+a previous implementation, it is measured next to the current one. The startup of the entry points is measured
+in new interpreters with the ``python -X importtime`` report of the imported modules.
+
+Results are printed as a table and can be written as JSON. Given a baseline written by a previous run,
+the benchmarks slower than the baseline by more than the threshold are reported as regressions
+and the exit status is 1.
+
+Run it from the project root::
+
+    python benchmarks.py --json baseline.json
+    python benchmarks.py --stages parse render --baseline baseline.json --threshold 0.25
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, Optional
+
+import cv2
+import numpy as np
+import peewee
+from bs4 import BeautifulSoup
+
+from assets import get_assets
+from base import MODELS, DatabaseUpdater, Forecast, WeatherCategory, bulk_upsert, create_database, \
+    get_weather_categories
+from constants import ICONS_DATA, COLOR, ICON_FILE_NAME, ICONS_PATH, PATH_TO_HTML_SAMPLES, DATE_HOUR_FORMAT, \
+    WEATHER_TYPE, WEATHER_CATEGORY, WEATHER_CATEGORY_CODES, SUN, RAIN, SNOW, CLOUD, NO_DATA, TEMPLATE_PATH, \
+    DATE_FORMAT_ON_POSTCARD
+from extractor import extract_hours
+from fetcher import AsyncForecastFetcher
+from gradient import draw_gradient, draw_gradient_by_lines, get_gradient
+from overlay import overlay_icon_by_masks
+from postcard import ImageMaker
+from utils import get_norm_and_joined_path
+from weather_forecast import WeatherMaker
+
+STAGES = ('startup', 'fetch', 'parse', 'store', 'load', 'render')
+STARTUP_MODULES = ('manager', 'daemon', 'api')  # the entry points
+HEAVY_MODULES = ('cv2', 'numpy', 'requests', 'bs4', 'peewee')  # reported if an entry point imports them
+POSTCARD_SIDES = (300, 600, 1000)
+ROW_COUNTS = (10_000, 100_000)
+FETCH_LOCATIONS = 10  # every sample page is fetched for this count of locations
+REPEATS = 20
+REGRESSION_THRESHOLD = .25  # share by which a benchmark may be slower than its baseline
+
+Measurement = dict  # median_ms, min_ms, repeats and optional extra values of a benchmark
+
+
+def measure(func: Callable[[], object], repeats: int = REPEATS, number: int = 1) -> Measurement:
+    """Times the function.
+
+    :param func: the benchmarked function
+    :param repeats: count of timings, the median and the minimum of them are reported
+    :param number: count of calls per timing, the time of a call is reported
+    :return: the median and the minimum milliseconds per call and the count of timings
+    """
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+    return {'median_ms': round(statistics.median(timings) * 1000, 4), 'min_ms': round(min(timings) * 1000, 4),
+            'repeats': repeats}
+
+
+def load_html_samples() -> list[tuple[datetime.date, str]]:
+    """Load the saved details pages, named by their dates in yyyy-mm-dd format."""
+    samples = []
+    for name in sorted(os.listdir(PATH_TO_HTML_SAMPLES)):
+        with open(get_norm_and_joined_path(PATH_TO_HTML_SAMPLES, name), encoding='utf-8') as page:
+            samples.append((datetime.date.fromisoformat(os.path.splitext(name)[0]), page.read()))
+    return samples
+
+
+def parse_importtime(report: str) -> dict[str, tuple[int, int]]:
+    """Parses the report of ``python -X importtime``.
+
+    :param report: the stderr of the interpreter
+    :return: the own and the cumulative microseconds of the import of every module by its name
+    """
+    times = {}
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(own), int(cumulative)
+    return times
+
+
+def bench_startup(repeats: int = 5, modules: tuple = STARTUP_MODULES) -> Iterator[tuple[str, Measurement]]:
+    """Startup of the entry points: a new interpreter importing the module, with the import time of the module,
+    the heavy dependencies it loads and the modules slowest to import."""
+    code = 'import sys, {module}; print(",".join(name for name in {heavy} if name in sys.modules))'
+    for module in modules:
+        timings, import_times, times = [], [], {}
+        for _ in range(repeats):
+            started = time.perf_counter()
+            process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                      code.format(module=module, heavy=HEAVY_MODULES)],
+                                     capture_output=True, text=True, check=True)
+            timings.append(time.perf_counter() - started)
+            times = parse_importtime(process.stderr)
+            import_times.append(times[module][1])
+        slowest = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:5]
+        yield f'startup, import {module}', {
+            'median_ms': round(statistics.median(timings) * 1000, 4), 'min_ms': round(min(timings) * 1000, 4),
+            'repeats': repeats, 'import_ms': round(statistics.median(import_times) / 1000, 3),
+            'heavy_modules': [name for name in process.stdout.strip().split(',') if name],
+            'slowest_imports_ms': {name: round(own / 1000, 3) for name, (own, _) in slowest},
+        }
+
+
+class SamplesHandler(BaseHTTPRequestHandler):
+    """Answers the request of a details page with the saved sample page of the day."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        page = self.server.pages.get(self.path.split('/')[-3])
+        body = page.encode() if page is not None else b''
+        self.send_response(200 if page is not None else 404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SamplesServer(ThreadingHTTPServer):
+    """Local forecasts site serving the saved sample pages, started in a background thread."""
+    daemon_threads = True
+
+    def __init__(self, samples: list[tuple[datetime.date, str]]):
+        super().__init__(('127.0.0.1', 0), SamplesHandler)
+        self.pages = {str(day): html for day, html in samples}
+        self.base_url = f'http://127.0.0.1:{self.server_address[1]}/details'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def bench_fetch(repeats: int = REPEATS) -> Iterator[tuple[str, Measurement]]:
+    """Fetching and parsing the sample pages from a local server through the pool of connections."""
+    samples = load_html_samples()
+    server = SamplesServer(samples)
+    pairs = [(f'{latitude}.0,30.0', day) for latitude in range(FETCH_LOCATIONS) for day, _ in samples]
+    try:
+        with AsyncForecastFetcher(base_url=server.base_url, rate=None) as fetcher:  # the local server is not limited
+            fetcher.get_pairs_data(pairs[:1])  # the connections are opened before the timings
+            yield f'fetch {len(pairs)} pages, local server', measure(lambda: fetcher.get_pairs_data(pairs), repeats)
+    finally:
+        server.stop()
+
+
+def _parse_page_by_soup(day: datetime.date, html: str) -> tuple[str, str]:
+    """The previous parsing: the document tree, a regex over all its scripts and the 16:00 hour hunt."""
+    weather_data = BeautifulSoup(html, features='html.parser').find_all('script')
+    date_for_searching = int(time.mktime(time.strptime(str(day) + '-16', DATE_HOUR_FORMAT)))
+    source = re.findall(f'{date_for_searching}.*?"time"', str(weather_data))
+    temperature_source = str(re.findall(r'"temperature":.*?,', str(source[0]))[0])
+    temperature = str(re.findall(r':\d*.?\d*', temperature_source)[0])[1:]
+    weather_match = re.findall(r'"summary":"[\w*\s?]*"', str(source[0]))
+    return str(weather_match[0]).split('":"')[1][:-1], temperature
+
+
+def bench_parse(repeats: int = REPEATS) -> Iterator[tuple[str, Measurement]]:
+    """Parsing of the saved pages as in WeatherMaker.run, by BeautifulSoup and regexes and by the JSON extractor."""
+    samples = load_html_samples()
+
+    def by_soup():
+        for day, html in samples:
+            _parse_page_by_soup(day, html)
+
+    def by_extractor():
+        for day, html in samples:
+            WeatherMaker.parse_page(day, html)
+
+    def all_hours():
+        for _, html in samples:
+            extract_hours(html)
+
+    yield f'parse {len(samples)} pages, BeautifulSoup and regex', measure(by_soup, repeats)
+    yield f'parse {len(samples)} pages, JSON extractor', measure(by_extractor, repeats)
+    yield f'parse {len(samples)} pages, all hours only', measure(all_hours, repeats)
+
+
+def make_forecast_rows(count: int, first_date: datetime.date = datetime.date(1990, 1, 1)) -> list[dict]:
+    """Generate forecasts of consecutive days in the format of the parser, the same for the same arguments."""
+    weather_keys = (SUN, RAIN, SNOW, CLOUD, NO_DATA)
+    fetched_at = datetime.datetime(2023, 3, 15, 16)
+    rows = []
+    for i in range(count):
+        key = weather_keys[i % len(weather_keys)]
+        rows.append({
+            WEATHER_TYPE: ICONS_DATA[key][WEATHER_TYPE],
+            'date': first_date + datetime.timedelta(days=i),
+            'temperature': round((i * 7.3) % 50 - 20, 2),
+            WEATHER_CATEGORY: WEATHER_CATEGORY_CODES[key],
+            'fetched_at': fetched_at,
+        })
+    return rows
+
+
+def _save_row_by_row(rows: list[dict]) -> None:
+    """The previous saving: a separate autocommitted upsert per day."""
+    for day_weather in rows:
+        Forecast.insert(**day_weather).on_conflict(conflict_target=(Forecast.location, Forecast.date),
+                                                   update=day_weather).execute()
+
+
+def _in_empty_database(func: Callable[[], object], repeats: int) -> Measurement:
+    """Times the function run against a new empty database every time."""
+    timings = []
+    for _ in range(max(1, repeats)):
+        with tempfile.TemporaryDirectory() as database_dir:
+            database = create_database(os.path.join(database_dir, 'benchmark.db'))
+            with database.bind_ctx(MODELS):
+                database.create_tables(MODELS)
+                bulk_upsert(WeatherCategory, get_weather_categories(), WeatherCategory.code)
+                timings.append(measure(func, repeats=1)['median_ms'])
+            database.close()
+    return {'median_ms': round(statistics.median(timings), 4), 'min_ms': round(min(timings), 4),
+            'repeats': len(timings)}
+
+
+def bench_store(repeats: int = 3, row_counts: tuple = ROW_COUNTS) -> Iterator[tuple[str, Measurement]]:
+    """Saving the generated forecasts to an empty database, by an upsert per row and by save_weather_to_db."""
+    db_updater = DatabaseUpdater()
+    for count in row_counts:
+        rows = make_forecast_rows(count)
+        if count <= ROW_COUNTS[0]:  # the previous saving takes minutes for the longer ranges
+            yield f'save {count} rows, upsert per row', _in_empty_database(lambda: _save_row_by_row(rows), 1)
+        yield f'save {count} rows, save_weather_to_db', \
+            _in_empty_database(lambda: db_updater.save_weather_to_db(rows), repeats)
+
+
+def bench_load(repeats: int = 3, count: int = ROW_COUNTS[-1]) -> Iterator[tuple[str, Measurement]]:
+    """Reading the generated forecasts by get_data_from_db and by streaming, with the peak memory of the reading."""
+    rows = make_forecast_rows(count)
+    db_updater = DatabaseUpdater()
+    first_day, last_day = rows[0]['date'], rows[-1]['date'] + datetime.timedelta(days=2)
+    with tempfile.TemporaryDirectory() as database_dir:
+        database = create_database(os.path.join(database_dir, 'benchmark.db'))
+        with database.bind_ctx(MODELS):
+            database.create_tables(MODELS)
+            bulk_upsert(WeatherCategory, get_weather_categories(), WeatherCategory.code)
+            db_updater.save_weather_to_db(rows)
+            for name, read in (('get_data_from_db', lambda: db_updater.get_data_from_db(first_day, last_day)),
+                               ('stream', lambda: collections.deque(
+                                   db_updater.iter_data_from_db(first_day, last_day), maxlen=0))):
+                result = measure(read, repeats)
+                tracemalloc.start()
+                read()
+                result['peak_mib'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+                tracemalloc.stop()
+                yield f'load {count} rows, {name}', result
+        database.close()
+
+
+def _make_templates(directory: str, sides: tuple) -> dict[int, str]:
+    """Writes the postcard template resized to every side, returns the paths of the templates by the sides."""
+    template = cv2.imread(TEMPLATE_PATH)
+    paths = {}
+    for side in sides:
+        paths[side] = os.path.join(directory, f'template_{side}.png')
+        cv2.imwrite(paths[side], cv2.resize(template, (side, side)))
+    return paths
+
+
+def bench_render(repeats: int = REPEATS, sides: tuple = POSTCARD_SIDES) -> Iterator[tuple[str, Measurement]]:
+    """Drawing of the gradient, overlaying of the icon and drawing of whole postcards for several postcard sizes."""
+    colors = [tuple(map(int, data[COLOR].split(','))) for data in ICONS_DATA.values()]
+    icon_paths = [get_norm_and_joined_path(ICONS_PATH, data[ICON_FILE_NAME])
+                  for data in ICONS_DATA.values() if data[ICON_FILE_NAME]]
+    forecast = [(data[WEATHER_TYPE], datetime.date(2022, 6, 16).strftime(DATE_FORMAT_ON_POSTCARD), '21',
+                 get_norm_and_joined_path(ICONS_PATH, data[ICON_FILE_NAME]) if data[ICON_FILE_NAME] else None,
+                 tuple(map(int, data[COLOR].split(','))))
+                for data in ICONS_DATA.values()]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for side, path_to_template in _make_templates(temp_dir, sides).items():
+            background = np.zeros((side, side, 3), dtype=np.uint8)
+
+            def by_lines():
+                for color in colors:
+                    draw_gradient_by_lines(background, color, side, side)
+
+            def vectorized():
+                for color in colors:
+                    draw_gradient(background, color, side, side)
+
+            get_gradient.cache_clear()
+            yield f'gradient {side}px, cv2.line per column', measure(by_lines, repeats)
+            yield f'gradient {side}px, numpy (cold cache)', measure(vectorized, repeats=1)
+            yield f'gradient {side}px, numpy (warm cache)', measure(vectorized, repeats)
+
+            assets = get_assets(path_to_template)
+            icons = [assets.icon(icon_path) for icon_path in icon_paths]
+            x, y = assets.postcard_side // 4, assets.postcard_side // 2
+
+            def by_masks():
+                for icon in icons:
+                    overlay_icon_by_masks(background, icon, x, y)
+
+            image_maker = ImageMaker(os.path.join(temp_dir, str(side)), path_to_template)
+            image_maker.render_postcard(forecast[0])  # the postcard size is kept by the image maker
+
+            def compare_background_and_icon():
+                for icon, color in zip(icons, colors):
+                    image_maker.compare_background_and_icon(assets.template.copy(), icon, color)
+
+            def draw_postcards():
+                for data in forecast:
+                    image_maker.draw_postcard(data)
+
+            def encode_postcards():
+                for data in forecast:
+                    image_maker.encode_postcard(data)
+
+            yield f'overlay {side}px, masks on every call', measure(by_masks, repeats)
+            yield f'compare_background_and_icon {side}px', measure(compare_background_and_icon, repeats)
+            yield f'draw_postcard {side}px, {len(forecast)} postcards', measure(draw_postcards, repeats)
+            yield f'encode_postcard {side}px, {len(forecast)} postcards', measure(encode_postcards, repeats)
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'fetch': bench_fetch,
+    'parse': bench_parse,
+    'store': bench_store,
+    'load': bench_load,
+    'render': bench_render,
+}
+
+
+def run_benchmarks(stages: tuple = STAGES, repeats: Optional[int] = None,
+                   report: Optional[Callable[[str, Measurement], None]] = None) -> dict:
+    """Runs the benchmarks of the stages.
+
+    :param stages: names of the stages from STAGES
+    :param repeats: count of timings of every benchmark, the default one of the stage if it is None
+    :param report: called with the name and the measurement of every finished benchmark
+    :return: the environment of the run and the measurements by the names of the benchmarks
+    """
+    results = {}
+    for stage in stages:
+        benchmarks = BENCHMARKS[stage]() if repeats is None else BENCHMARKS[stage](repeats)
+        for name, measurement in benchmarks:
+            results[name] = dict(measurement, stage=stage)
+            if report is not None:
+                report(name, results[name])
+    return {
+        'environment': {
+            'python': platform.python_version(), 'platform': platform.platform(), 'numpy': np.__version__,
+            'opencv': cv2.__version__, 'peewee': peewee.__version__, 'sqlite': peewee.sqlite3.sqlite_version,
+            'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> list[dict]:
+    """Compares the median times of the benchmarks present in both runs.
+
+    :param results: the measurements by the names of the benchmarks of the current run
+    :param baseline: the measurements by the names of the benchmarks of the baseline run
+    :param threshold: share by which a benchmark may be slower than its baseline
+    :return: the comparisons with the ratio of the current median time to the baseline one
+        and whether it is a regression, in the order of the results
+    """
+    comparisons = []
+    for name, measurement in results.items():
+        if name not in baseline or not baseline[name]['median_ms']:
+            continue
+        ratio = measurement['median_ms'] / baseline[name]['median_ms']
+        comparisons.append({'name': name, 'median_ms': measurement['median_ms'],
+                            'baseline_ms': baseline[name]['median_ms'], 'ratio': round(ratio, 3),
+                            'regression': ratio > 1 + threshold})
+    return comparisons
+
+
+def _print_measurement(name: str, measurement: Measurement) -> None:
+    details = ''
+    if 'peak_mib' in measurement:
+        details = f' {measurement["peak_mib"]:>10.2f} MiB peak'
+    if 'import_ms' in measurement:
+        details = f' {measurement["import_ms"]:>10.3f} ms import, loads {", ".join(measurement["heavy_modules"])}'
+    print(f'{name:<50} {measurement["median_ms"]:>12.3f} ms{details}')
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    """Runs the benchmarks, returns 1 if there are regressions against the baseline and 0 otherwise."""
+    parser = argparse.ArgumentParser(description='Measure the stages of the project')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to measure')
+    parser.add_argument('--repeats', type=int, help='count of timings of every benchmark')
+    parser.add_argument('--json', type=str, metavar='PATH', help='write the results as JSON, "-" for stdout')
+    parser.add_argument('--baseline', type=str, metavar='PATH', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='share by which a benchmark may be slower than its baseline')
+    params = parser.parse_args(args)
+
+    to_stdout = params.json == '-'
+    run = run_benchmarks(tuple(params.stages), params.repeats, None if to_stdout else _print_measurement)
+    comparisons = []
+    if params.baseline:
+        with open(params.baseline, encoding='utf-8') as baseline_file:
+            comparisons = compare_with_baseline(run['results'], json.load(baseline_file)['results'], params.threshold)
+        run['comparisons'] = comparisons
+    if to_stdout:
+        json.dump(run, sys.stdout, indent=2)
+        print()
+    elif params.json:
+        with open(params.json, 'w', encoding='utf-8') as results_file:
+            json.dump(run, results_file, indent=2)
+
+    regressions = [comparison for comparison in comparisons if comparison['regression']]
+    if comparisons and not to_stdout:
+        print(f'\n{len(comparisons)} benchmarks compared with {params.baseline}, {len(regressions)} regressions')
+        for comparison in regressions:
+            print(f'{comparison["name"]:<50} {comparison["baseline_ms"]:>10.3f} -> {comparison["median_ms"]:.3f} ms '
+                  f'(x{comparison["ratio"]})')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
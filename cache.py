@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of the forecast pages of https://darksky.net.
+
+A page is kept per (coordinates, date, units) key as a gzip-compressed JSON file with the page text and
+the validators of the response. Pages downloaded after their day had ended everywhere never expire,
+the other pages are forecasts: they expire after the TTL and are revalidated with a conditional request
+if the site returned validators for them.
+"""
+import calendar
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import time
+from typing import NamedTuple, Optional
+
+from constants import CACHE_PATH, CACHE_TTL, FORECAST_UNITS, DEFAULT_LOCATION
+from utils import get_norm_and_joined_path
+
+LATEST_TIME_ZONE_OFFSET = 12 * 60 * 60  # seconds a day lasts after its end in UTC, in the UTC-12 time zone
+
+
+class CachedResponse(NamedTuple):
+    """A page stored in the cache."""
+    body: str
+    fetched_at: float  # unix time of the download or of the last successful revalidation
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def get_validators(self) -> dict:
+        """Headers of a conditional request for the page."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """Stores forecast pages on disk.
+
+    Args:
+        path: The directory of the cache.
+        ttl: Seconds to keep pages of today and future days.
+        units: The units of the forecasts on the pages.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttl: float = CACHE_TTL, units: str = FORECAST_UNITS):
+        self.path = path
+        self.ttl = ttl
+        self.units = units
+
+    def _get_file_path(self, day: datetime.date, coords: str) -> str:
+        return get_norm_and_joined_path(self.path, f'{coords.replace(",", "_")}_{day}_{self.units}.json.gz')
+
+    def get(self, day: datetime.date, coords: str = DEFAULT_LOCATION) -> Optional[CachedResponse]:
+        """Returns the stored page for the day, expired or not, or None if there is no page."""
+        try:
+            with gzip.open(self._get_file_path(day, coords), 'rt', encoding='utf-8') as cache_file:
+                return CachedResponse(**json.load(cache_file))
+        except (OSError, ValueError, TypeError):  # no page or a broken file
+            return None
+
+    @staticmethod
+    def is_final(day: datetime.date, response: CachedResponse) -> bool:
+        """Checks if the page was downloaded after the day had ended in every time zone, so it is not a forecast."""
+        day_end = calendar.timegm((day + datetime.timedelta(days=1)).timetuple()) + LATEST_TIME_ZONE_OFFSET
+        return response.fetched_at >= day_end
+
+    def is_fresh(self, day: datetime.date, response: CachedResponse, now: Optional[float] = None) -> bool:
+        """Checks if the stored page for the day can be used without asking the site."""
+        if self.is_final(day, response):
+            return True
+        return (now or time.time()) - response.fetched_at < self.ttl
+
+    def put(self, day: datetime.date, body: str, etag: Optional[str] = None, last_modified: Optional[str] = None,
+            coords: str = DEFAULT_LOCATION) -> CachedResponse:
+        """Stores the page for the day, replacing the previous one."""
+        response = CachedResponse(body, time.time(), etag, last_modified)
+        os.makedirs(self.path, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as raw_file, \
+                    gzip.open(raw_file, 'wt', encoding='utf-8') as cache_file:
+                json.dump(response._asdict(), cache_file)
+            os.replace(temp_path, self._get_file_path(day, coords))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return response
+
+    def refresh(self, day: datetime.date, response: CachedResponse, coords: str = DEFAULT_LOCATION) -> CachedResponse:
+        """Marks the stored page as fresh after the site confirmed it has not changed."""
+        return self.put(day, response.body, response.etag, response.last_modified, coords)
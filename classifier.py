@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Classification of the weather summaries of https://darksky.net into the weather categories of the postcards.
+
+The patterns of all the categories are compiled into one regex scanning a summary once. If a summary matches
+several categories, the first one of CATEGORY_PATTERNS wins: "Rain and Snow" is rain, "Clear and Breezy" is sun.
+The site uses a few dozens of distinct summaries, so the results are memoized per summary.
+"""
+import re
+from functools import lru_cache
+from typing import Iterable
+
+from constants import SUN, RAIN, SNOW, CLOUD, NO_DATA, SUNNY_PATTERN, RAINY_PATTERN, SNOW_PATTERN, CLOUDY_PATTERN, \
+    ICONS_DATA, ICONS_PATH, ICON_FILE_NAME, COLOR
+from utils import get_norm_and_joined_path
+
+CATEGORY_PATTERNS = ((SUN, SUNNY_PATTERN), (RAIN, RAINY_PATTERN), (SNOW, SNOW_PATTERN), (CLOUD, CLOUDY_PATTERN))
+CLASSIFIER_CACHE_SIZE = 1024  # distinct summaries kept
+
+_COMBINED_PATTERN = re.compile('|'.join(f'(?P<c{priority}>{pattern.pattern})'
+                                        for priority, (_, pattern) in enumerate(CATEGORY_PATTERNS)))
+# icon path and BGR color string of every category, built once instead of per forecast
+ICON_PATHS_AND_COLORS = {
+    key: (get_norm_and_joined_path(ICONS_PATH, data[ICON_FILE_NAME]), data[COLOR]) for key, data in ICONS_DATA.items()
+}
+
+
+@lru_cache(maxsize=CLASSIFIER_CACHE_SIZE)
+def classify_weather_type(weather_type: str) -> str:
+    """Finds the category of the weather summary.
+
+    :param weather_type: the summary of the forecast in any case, e.g. "Possible Light Snow"
+    :return: the key of ICONS_DATA, NO_DATA if the summary matches no category
+    """
+    priorities = [int(match.lastgroup[1:]) for match in _COMBINED_PATTERN.finditer(weather_type.lower())]
+    return CATEGORY_PATTERNS[min(priorities)][0] if priorities else NO_DATA
+
+
+def classify_weather_types(weather_types: Iterable[str]) -> list[str]:
+    """Finds the categories of a batch of summaries, every distinct summary is classified once.
+
+    :param weather_types: the summaries of the forecasts
+    :return: the keys of ICONS_DATA in the order of the summaries
+    """
+    weather_types = list(weather_types)
+    categories = {weather_type: classify_weather_type(weather_type) for weather_type in set(weather_types)}
+    return [categories[weather_type] for weather_type in weather_types]
@@ -10,13 +10,18 @@ WEATHER_TYPE = 'weather_type'
 CLEAR, RAIN = 'Clear', 'rain'
 SUN, SNOW = 'sun', 'snow'
 CLOUD, NO_DATA = 'cloud', 'no data'
+NO_TEMPERATURE = '?'  # shown for a forecast stored without temperature
 
 # paths
 TEMPLATE_PATH = 'external_data/template.jpg'
 PATH_TO_SAVE_TEST_POSTCARDS = 'external_data/test_postcards'
 PATH_TO_POSTCARD_SAMPLES = 'external_data/postcard_samples'
+PATH_TO_HTML_SAMPLES = 'external_data/html_samples'
 DEFAULT_PATH_TO_SAVE_POSTCARD = 'external_data/weather_postcards'
 ICONS_PATH = 'external_data/weather_img'
+POSTCARD_EXTENSION = '.jpg'
+SHEET_COLUMNS = 7  # postcards in a row of a sheet, a week per row
+TIMELAPSE_FPS = 2.  # postcards per second of a timelapse video
 
 # icons paths
 SUN_ICON_PATH = 'sun.png'
@@ -27,12 +32,46 @@ CLOUD_ICON_PATH = 'cloud.png'
 # RegEx
 SUNNY_PATTERN = re.compile(r'clear|sun')
 RAINY_PATTERN = re.compile(r'drizzle|rain')
-SNOW_PATTERN = re.compile(r'snow')
+SNOW_PATTERN = re.compile(r'snow|flurries')
 CLOUDY_PATTERN = re.compile(r'overcast|cloud|foggy')
 
 # url data
 BASE_URL = "https://darksky.net/details"
 SPB_COORDS = '59.9343,30.3351'
+DEFAULT_LOCATION = SPB_COORDS  # forecasts location if no locations are given
+FORECAST_UNITS = 'ca24'  # °C, km/h and 24-hour time
+FORECAST_LANGUAGE = 'en'
+
+# fetching
+FETCH_CONCURRENCY = 8  # simultaneous requests to the site
+FETCH_TIMEOUT = 10  # seconds per request
+FETCH_RETRIES = 3  # extra attempts after a failed request
+FETCH_BACKOFF = .5  # seconds before the first retry, doubled for every next one
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+FETCH_RATE = 20.  # requests per second to the site, halved on every throttling or server error answer
+FETCH_BURST = 16  # requests sent at once after a pause
+FETCH_BREAKER_FAILURES = 10  # failed requests in a row stopping the requests to the site
+FETCH_BREAKER_RESET = 30.  # seconds before the requests to the failing site are tried again
+FETCH_RETRY_ROUNDS = 1  # later rounds for the dates which failed with a temporary error
+FETCH_RETRY_DELAY = 5.  # seconds before a round of the failed dates
+
+# incremental sync
+SYNC_TTL = 3 * 60 * 60  # seconds after which stored forecasts for today and future days are fetched again
+
+# daemon mode
+DAEMON_INTERVAL = 60 * 60  # seconds between refreshes of the near-term forecasts
+DAEMON_DAYS_AHEAD = 10  # days starting from today refreshed by the daemon
+DAEMON_HOST = '127.0.0.1'  # the status endpoint is served for local clients only
+DAEMON_PORT = 8765
+
+# local HTTP API
+API_HOST = '127.0.0.1'
+API_PORT = 8766
+API_CACHE_BYTES = 64 * 1024 * 1024  # total size of the encoded postcards kept in memory
+
+# responses cache
+CACHE_PATH = 'external_data/http_cache'
+CACHE_TTL = 3 * 60 * 60  # seconds to keep the forecast pages, pages downloaded after their day never expire
 
 # COLORS
 COLOR = 'color'
@@ -43,6 +82,10 @@ DATE_FORMAT = '%Y-%m-%d'  # 2021-10-15
 DATE_HOUR_FORMAT = f'{DATE_FORMAT}-%H'  # 2023-03-15-16
 DATE_FORMAT_ON_POSTCARD = '%a, %d %b'  # Wed, 15 Mar
 
+# weather categories codes stored in the database
+WEATHER_CATEGORY = 'weather_category'
+WEATHER_CATEGORY_CODES = {NO_DATA: 0, SUN: 1, RAIN: 2, SNOW: 3, CLOUD: 4}
+
 # icons data
 ICONS_DATA = {
     SUN: {
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""Resident service refreshing the near-term forecasts on a schedule.
+
+The postcard assets, the database connection, the pool of connections to the forecasts site and the pool of
+processes rendering postcards are set up once and kept for the life of the service. Every refresh fetches
+the forecasts of the coming days which are missing or stale in the database and re-renders the postcards
+of the days whose forecasts changed only.
+
+The state of the service is served as JSON for local clients: ``GET /health`` answers 200 if the last refresh
+succeeded and 503 otherwise, ``GET /status`` returns the counters of the refreshes. With ``--metrics``
+the timings of the stages are collected and ``GET /metrics`` serves them in the Prometheus text format.
+
+Usage: python daemon.py [--interval SECONDS] [--days N] [--port PORT] [--locations LAT,LON ...] [-j N] [--metrics]
+"""
+import argparse
+import datetime
+import json
+import signal
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from assets import get_assets
+from base import DatabaseUpdater, Forecast
+from batch import create_render_pool, render_postcards
+from cache import ResponseCache
+from constants import DEFAULT_PATH_TO_SAVE_POSTCARD, BASE_URL, CACHE_PATH, FETCH_CONCURRENCY, DAEMON_INTERVAL, \
+    DAEMON_DAYS_AHEAD, DAEMON_HOST, DAEMON_PORT
+from fetcher import AsyncForecastFetcher
+from locations import parse_location, read_locations, unique_locations
+from manager import Manager
+from manifest import RenderManifest
+from metrics import enable_metrics, get_metrics
+
+
+class ForecastDaemon:
+    """Refreshes the forecasts and the postcards of the coming days until it is stopped.
+
+    Args:
+        locations: The coordinates of the locations, the default location if it is None.
+        path_to_save: The directory for the postcards, with a subdirectory per location if there are several.
+        interval: Seconds between the starts of the refreshes.
+        days_ahead: Count of days starting from today to refresh.
+        base_url: The url of the forecasts site.
+        cache_path: The directory of the downloaded pages cache, pages are not cached if it is None.
+        concurrency: The maximum count of simultaneous requests to the site.
+        workers: Count of processes rendering postcards.
+        status_address: The host and the port of the status endpoint, it is not served if the address is None.
+    """
+
+    def __init__(self, locations: Optional[list[str]] = None, path_to_save: str = DEFAULT_PATH_TO_SAVE_POSTCARD,
+                 interval: float = DAEMON_INTERVAL, days_ahead: int = DAEMON_DAYS_AHEAD, base_url: str = BASE_URL,
+                 cache_path: Optional[str] = CACHE_PATH, concurrency: int = FETCH_CONCURRENCY, workers: int = 1,
+                 status_address: Optional[tuple[str, int]] = (DAEMON_HOST, DAEMON_PORT)):
+        self.manager = Manager(path_to_save=path_to_save, base_url=base_url, cache_path=cache_path,
+                               locations=locations, concurrency=concurrency)
+        self.db_updater = DatabaseUpdater()
+        self.interval = interval
+        self.days_ahead = days_ahead
+        self.workers = workers
+        self.status_address = status_address
+        self.fetcher: Optional[AsyncForecastFetcher] = None
+        self.status_server: Optional[StatusServer] = None
+        self.render_pool: Optional[ProcessPoolExecutor] = None
+
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {
+            'started_at': None, 'refresh_count': 0, 'failed_refresh_count': 0, 'last_refresh_at': None,
+            'last_refresh_seconds': None, 'last_error': None, 'next_refresh_at': None,
+            'fetched': 0, 'changed': 0, 'rendered': 0, 'failed_dates': [],
+        }
+
+    def start(self) -> None:
+        """Decodes the assets, opens the database connection, the pool of connections to the site
+        and the pool of rendering processes, and starts serving the status."""
+        get_assets()
+        Forecast._meta.database.connect(reuse_if_open=True)
+        cache = ResponseCache(self.manager.cache_path, ttl=self.interval) if self.manager.cache_path else None
+        self.fetcher = AsyncForecastFetcher(concurrency=self.manager.concurrency, base_url=self.manager.base_url,
+                                            cache=cache)
+        if self.workers > 1:
+            self.render_pool = create_render_pool(self.workers)
+        if self.status_address is not None:
+            self.status_server = StatusServer(self.status_address, self)
+            threading.Thread(target=self.status_server.serve_forever, name='status', daemon=True).start()
+        self._update_status(started_at=time.time())
+
+    def stop(self) -> None:
+        """Asks the service to stop after the current refresh, safe to call from a signal handler."""
+        self._stop_event.set()
+
+    def shutdown(self) -> None:
+        """Stops serving the status, closes the connections and stops the rendering processes."""
+        if self.status_server is not None:
+            self.status_server.shutdown()
+            self.status_server.server_close()
+            self.status_server = None
+        if self.fetcher is not None:
+            self.fetcher.close()
+            self.fetcher = None
+        if self.render_pool is not None:
+            self.render_pool.shutdown()
+            self.render_pool = None
+        Forecast._meta.database.close()
+
+    def run_forever(self) -> None:
+        """Refreshes the forecasts every interval until stop is called, then shuts the service down."""
+        self.start()
+        try:
+            while not self._stop_event.is_set():
+                started = time.monotonic()
+                self.refresh_safely()
+                delay = max(0., self.interval - (time.monotonic() - started))
+                self._update_status(next_refresh_at=time.time() + delay)
+                self._stop_event.wait(delay)
+        finally:
+            self.shutdown()
+
+    def refresh_safely(self) -> bool:
+        """Refreshes the forecasts, a failed refresh is recorded in the status instead of stopping the service.
+
+        :return: whether the refresh succeeded
+        """
+        started = time.monotonic()
+        try:
+            with get_metrics().timer('refresh'):
+                fetched, changed, rendered = self.refresh()
+        except Exception as error:
+            with self._lock:
+                self._status['failed_refresh_count'] += 1
+                self._status['last_error'] = f'{type(error).__name__}: {error}'
+            return False
+        with self._lock:
+            self._status['refresh_count'] += 1
+            self._status['fetched'] += fetched
+            self._status['changed'] += changed
+            self._status['rendered'] += rendered
+            self._status.update(last_refresh_at=time.time(), last_refresh_seconds=time.monotonic() - started,
+                                last_error=None)
+        return True
+
+    def refresh(self) -> tuple[int, int, int]:
+        """Fetches the missing and stale forecasts of the coming days, saves them and renders the changed days.
+
+        :return: the counts of fetched forecasts, of changed forecasts and of rendered postcards
+        """
+        today = datetime.date.today()
+        dates = self.manager.get_dates(today, today + datetime.timedelta(days=self.days_ahead))
+        # forecasts saved by the previous refresh are stale for this one
+        pairs = [(location, day) for location in self.manager.locations
+                 for day in self.db_updater.get_dates_to_sync(dates, ttl=self.interval / 2, location=location)]
+        forecast = self.fetcher.get_pairs_data(pairs) if pairs else []
+        self._update_status(failed_dates=[{'location': error.location, 'date': str(error.day), 'reason': error.reason}
+                                          for error in (self.fetcher.errors if pairs else [])])
+        changed = self.db_updater.save_changed_weather_to_db(forecast)
+        return len(forecast), len(changed), self.render(changed)
+
+    def render(self, changed: list[dict]) -> int:
+        """Renders and saves the postcards of the changed forecasts, skipping the ones drawn the same as before.
+
+        :param changed: forecast dicts in the format of the parser
+        :return: count of saved postcards
+        """
+        dates_of_locations = defaultdict(list)
+        for day_weather in changed:
+            dates_of_locations[day_weather['location']].append(day_weather['date'])
+        count_of_postcards = 0
+        for location, dates in dates_of_locations.items():
+            path_to_save = self.manager.get_path_to_save(location)
+            count_of_postcards += render_postcards(self.db_updater.iter_data_for_dates(dates, location), path_to_save,
+                                                   self.workers, manifest=RenderManifest(path_to_save),
+                                                   executor=self.render_pool)
+        return count_of_postcards
+
+    def get_status(self) -> dict:
+        """The counters of the refreshes and the settings of the service."""
+        with self._lock:
+            status = dict(self._status)
+        status.update(
+            healthy=self.is_healthy(), locations=self.manager.locations, interval=self.interval,
+            days_ahead=self.days_ahead,
+            uptime_seconds=time.time() - status['started_at'] if status['started_at'] is not None else None,
+        )
+        return status
+
+    def is_healthy(self) -> bool:
+        """Whether the last refresh succeeded or there was no refresh yet."""
+        with self._lock:
+            return self._status['last_error'] is None
+
+    def _update_status(self, **values) -> None:
+        with self._lock:
+            self._status.update(values)
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Serves the state of the service as JSON."""
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/health':
+            healthy = service.is_healthy()
+            self.send_json(200 if healthy else 503, {'status': 'ok' if healthy else 'failing'})
+        elif self.path == '/status':
+            self.send_json(200, service.get_status())
+        elif self.path == '/metrics' and get_metrics().enabled:
+            body = get_metrics().to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {'error': f'{self.path} is not found'})
+
+    def send_json(self, status_code: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StatusServer(ThreadingHTTPServer):
+    """HTTP server of the status endpoint of a running service."""
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: ForecastDaemon):
+        super().__init__(address, StatusHandler)
+        self.service = service
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    """Runs the service until SIGINT or SIGTERM."""
+    parser = argparse.ArgumentParser(description='Refresh the forecasts and the postcards on a schedule')
+    parser.add_argument('--interval', type=float, default=DAEMON_INTERVAL, help='seconds between refreshes')
+    parser.add_argument('--days', type=int, default=DAEMON_DAYS_AHEAD, help='count of days from today to refresh')
+    parser.add_argument('--host', type=str, default=DAEMON_HOST, help='host of the status endpoint')
+    parser.add_argument('--port', type=int, default=DAEMON_PORT, help='port of the status endpoint')
+    parser.add_argument('--locations', nargs='+', type=parse_location, metavar='LAT,LON',
+                        help='coordinates of the locations to get forecasts for')
+    parser.add_argument('--locations-file', type=str, metavar='PATH',
+                        help='file with the coordinates of a location per line')
+    parser.add_argument('--concurrency', type=int, default=FETCH_CONCURRENCY,
+                        help='maximum count of simultaneous requests to the site')
+    parser.add_argument('-j', type=int, default=1, metavar='N', help='render postcards using N processes')
+    parser.add_argument('--no-cache', action='store_true', help='do not cache the downloaded pages')
+    parser.add_argument('--metrics', action='store_true', help='time the stages and serve the timings at /metrics')
+    params = parser.parse_args(args)
+
+    if params.metrics:
+        enable_metrics()
+
+    locations = read_locations(params.locations_file) if params.locations_file else []
+    service = ForecastDaemon(
+        locations=unique_locations(locations + (params.locations or [])) or None, interval=params.interval,
+        days_ahead=params.days, cache_path=None if params.no_cache else CACHE_PATH,
+        concurrency=params.concurrency, workers=params.j, status_address=(params.host, params.port),
+    )
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: service.stop())
+    service.run_forever()
+
+
+if __name__ == '__main__':
+    main()
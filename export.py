@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""Bulk export of the stored forecasts for analytics.
+
+The Forecast table is read in chunks of rows and written column by column: the date as a date, the temperature
+as a float, the weather category as its code and name. Only a chunk is held in memory, so the memory does not depend
+on the count of exported rows.
+
+Formats:
+  - ``csv``: a header and a line per forecast, ISO dates and times, empty fields for the missing fetch times;
+  - ``parquet``: a row group per chunk, the weather category name is dictionary encoded;
+  - ``arrow``: the Arrow IPC stream format with a record batch per chunk, read by ``pyarrow.ipc.open_stream``.
+
+The columnar formats need pyarrow. The file is written next to the destination and replaces it when complete,
+so a reader never sees a partial export.
+
+Usage: python export.py forecasts.parquet [--format parquet] [--from 2022-01-01] [--to 2023-01-01]
+    [--location 59.9343,30.3351] [--chunk-size 10000]
+"""
+import argparse
+import csv
+import datetime
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional, TextIO
+
+from base import Forecast, WeatherCategory, ensure_database
+from locations import parse_location
+from metrics import get_metrics
+
+EXPORT_FORMATS = ('csv', 'parquet', 'arrow')
+EXPORT_COLUMNS = ('location', 'date', 'temperature', 'weather_type', 'weather_category', 'weather_category_name',
+                  'fetched_at')
+EXPORT_CHUNK_SIZE = 10000  # rows read and written at once
+TEXT_COLUMNS = ('date', 'fetched_at')  # columns kept by SQLite as ISO text
+
+
+def iter_forecast_chunks(starts_from: Optional[datetime.date] = None, to: Optional[datetime.date] = None,
+                         location: Optional[str] = None, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[list[tuple]]:
+    """Streams the stored forecasts ordered by location and date in chunks of rows.
+
+    The rows are read from the cursor as SQLite keeps them, without converting every value to a Python object:
+    the dates and the fetch times are ISO text, the fetch time is None if unknown.
+
+    :param starts_from: first date of the exported forecasts, the earliest one if None
+    :param to: the date following the last exported date, no limit if None
+    :param location: coordinates of the forecasts location, all locations if None
+    :param chunk_size: maximum count of rows in a chunk
+    :return: lists of rows with the values of EXPORT_COLUMNS
+    """
+    db = ensure_database()
+    query = Forecast.select(
+        Forecast.location, Forecast.date, Forecast.temperature, Forecast.weather_type, Forecast.weather_category,
+        WeatherCategory.name, Forecast.fetched_at
+    ).join(WeatherCategory).order_by(Forecast.location, Forecast.date)
+    if starts_from is not None:
+        query = query.where(Forecast.date >= starts_from)
+    if to is not None:
+        query = query.where(Forecast.date < to)
+    if location is not None:
+        query = query.where(Forecast.location == location)
+
+    cursor, metrics = db.execute(query), get_metrics()
+    try:
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                return
+            metrics.count('forecasts_exported', len(chunk))
+            yield chunk
+    finally:
+        cursor.close()
+
+
+def write_csv(chunks: Iterable[list[tuple]], csv_file: TextIO) -> int:
+    """Writes the chunks to the text file as CSV with a header, returns the count of written rows."""
+    writer = csv.writer(csv_file, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    written = 0
+    for chunk in chunks:
+        writer.writerows(chunk)
+        written += len(chunk)
+    return written
+
+
+def get_arrow_schema():
+    """Types of the exported columns in Arrow."""
+    import pyarrow
+
+    return pyarrow.schema([
+        ('location', pyarrow.string()),
+        ('date', pyarrow.date32()),
+        ('temperature', pyarrow.float64()),
+        ('weather_type', pyarrow.string()),
+        ('weather_category', pyarrow.int8()),
+        ('weather_category_name', pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+        ('fetched_at', pyarrow.timestamp('us')),
+    ])
+
+
+def write_columnar(chunks: Iterable[list[tuple]], path: str, export_format: str) -> int:
+    """Writes the chunks to the Parquet or the Arrow IPC stream file, a row group or a record batch per chunk.
+
+    :return: count of written rows
+    :raise ImportError: if pyarrow is not installed
+    """
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    schema = get_arrow_schema()
+    if export_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression='zstd')
+    else:
+        writer = pyarrow.ipc.new_stream(path, schema)
+    written = 0
+    try:
+        for chunk in chunks:
+            # the text of the dates and the times is parsed by Arrow, the other columns are built with their types
+            columns = [pyarrow.array(values).cast(field.type) if field.name in TEXT_COLUMNS
+                       else pyarrow.array(values, type=field.type) for field, values in zip(schema, zip(*chunk))]
+            batch = pyarrow.record_batch(columns, schema=schema)
+            if export_format == 'parquet':
+                writer.write_batch(batch, row_group_size=len(chunk))
+            else:
+                writer.write_batch(batch)
+            written += batch.num_rows
+    finally:
+        writer.close()
+    return written
+
+
+@contextmanager
+def _replacing(path: str) -> Iterator[str]:
+    """Path of a temporary file in the directory of the path, moved to the path when the block succeeds.
+
+    The file gets the permissions of a file created by open, mkstemp creates it readable by the owner only.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+        yield temp_path
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def export_forecasts(path: str, export_format: str = 'csv', starts_from: Optional[datetime.date] = None,
+                     to: Optional[datetime.date] = None, location: Optional[str] = None,
+                     chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+    """Exports the stored forecasts to the file.
+
+    :param path: the path to the file, '-' to write CSV to the standard output
+    :param export_format: one of EXPORT_FORMATS
+    :param starts_from: first date of the exported forecasts, the earliest one if None
+    :param to: the date following the last exported date, no limit if None
+    :param location: coordinates of the forecasts location, all locations if None
+    :param chunk_size: count of rows read and written at once
+    :return: count of exported forecasts
+    :raise ValueError: for an unknown format or a columnar format written to the standard output
+    :raise ImportError: if pyarrow needed by the format is not installed
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {export_format!r}, expected one of {", ".join(EXPORT_FORMATS)}')
+    chunks = iter_forecast_chunks(starts_from, to, location, chunk_size)
+    if path == '-':
+        if export_format != 'csv':
+            raise ValueError('Only CSV can be written to the standard output')
+        return write_csv(chunks, sys.stdout)
+    if export_format != 'csv':
+        import pyarrow  # noqa: F401, fails before the file is created
+    with _replacing(path) as temp_path:
+        if export_format == 'csv':
+            with open(temp_path, 'w', encoding='utf-8', newline='') as csv_file:
+                return write_csv(chunks, csv_file)
+        return write_columnar(chunks, temp_path, export_format)
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Export the stored forecasts to a CSV, Parquet or Arrow file')
+    parser.add_argument('path', type=str, help="path to the exported file, '-' for CSV to the standard output")
+    parser.add_argument('--format', dest='export_format', choices=EXPORT_FORMATS,
+                        help='format of the file, guessed by the extension of the path if not given')
+    parser.add_argument('--from', dest='starts_from', type=datetime.date.fromisoformat,
+                        help='first exported date in yyyy-mm-dd format')
+    parser.add_argument('--to', type=datetime.date.fromisoformat,
+                        help='the date following the last exported date in yyyy-mm-dd format')
+    parser.add_argument('--location', type=parse_location, metavar='LAT,LON',
+                        help='coordinates of the exported location, all locations if not given')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='count of rows read at once')
+    params = parser.parse_args(args)
+
+    export_format = params.export_format
+    if export_format is None:
+        extension = os.path.splitext(params.path)[1].lstrip('.').lower()
+        export_format = {'parquet': 'parquet', 'arrow': 'arrow', 'arrows': 'arrow'}.get(extension, 'csv')
+    try:
+        exported = export_forecasts(params.path, export_format, params.starts_from, params.to, params.location,
+                                    params.chunk_size)
+    except ImportError:
+        parser.exit(2, f'The {export_format} format needs pyarrow: pip install pyarrow\n')
+    if params.path != '-':
+        print(f'{exported} forecasts exported to {params.path}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Extraction of the hourly forecast embedded in the pages of https://darksky.net.
+
+The details page keeps the whole day's hourly series as a JSON array assigned to ``hours`` in a script.
+The array is found with one regex search and parsed once, without building the document tree.
+The times of the hours are unix timestamps, ``tz_offset`` assigned next to the array is the offset of the local time
+of the location from UTC in hours.
+"""
+import json
+import re
+from typing import Optional
+
+HOURS_PATTERN = re.compile(r'hours\s*=\s*(?=\[)')  # word boundary is checked apart, \b slows the search
+TZ_OFFSET_PATTERN = re.compile(r'(?<![\w$])tz_offset\s*=\s*(-?\d+(?:\.\d+)?)')
+TIME_KEY, SUMMARY_KEY, TEMPERATURE_KEY = 'time', 'summary', 'temperature'
+
+_json_decoder = json.JSONDecoder()
+
+
+class PageLayoutError(ValueError):
+    """The page has no hourly forecast in the expected format."""
+
+
+def _is_identifier_char(char: str) -> bool:
+    return char.isalnum() or char in '_$'
+
+
+def extract_hours(html: str) -> list[dict]:
+    """Extracts every hour's forecast from the page.
+
+    :param html: the text of the details page
+    :return: hourly forecast dicts with 'time' (unix timestamp), 'summary', 'temperature' and other keys
+    :raise PageLayoutError: if there is no hourly forecast on the page
+    """
+    match = next((match for match in HOURS_PATTERN.finditer(html)
+                  if not match.start() or not _is_identifier_char(html[match.start() - 1])), None)
+    if match is None:
+        raise PageLayoutError('There is no hourly forecast on the page')
+    try:
+        hours, _ = _json_decoder.raw_decode(html, match.end())
+    except json.JSONDecodeError as error:
+        raise PageLayoutError(f'Hourly forecast can not be parsed: {error}') from error
+    if not isinstance(hours, list) or not all(isinstance(hour, dict) and TIME_KEY in hour for hour in hours):
+        raise PageLayoutError('Hourly forecast has unexpected format')
+    return hours
+
+
+def extract_tz_offset(html: str) -> Optional[float]:
+    """Extracts the offset of the local time of the forecast location from UTC.
+
+    :param html: the text of the details page
+    :return: the offset in hours or None if there is no offset on the page
+    """
+    match = TZ_OFFSET_PATTERN.search(html)
+    return float(match.group(1)) if match is not None else None
+
+
+def find_hour(hours: list[dict], timestamp: int) -> Optional[dict]:
+    """Finds the forecast for the hour starting at the timestamp.
+
+    :param hours: hourly forecast dicts returned by extract_hours
+    :param timestamp: unix timestamp of the hour
+    :return: the forecast dict or None if there is no such hour
+    """
+    return next((hour for hour in hours if hour[TIME_KEY] == timestamp), None)
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""Asynchronous collecting of weather forecasts from https://darksky.net.
+
+Pages are downloaded through one pooled ``requests.Session`` shared by all the requests. Blocking calls run in
+a thread pool of the concurrency size, asyncio bounds the count of simultaneous requests and retries failures.
+Every location and date pair is a separate page, the pairs of all the locations are taken by the same workers.
+If a ResponseCache is given, it is checked before going to the site and stale pages are revalidated.
+
+The requests are spaced out by a token bucket slowing down on the throttling and server error answers,
+and a circuit breaker fails them at once while the site is down. The pairs which failed with a temporary error
+are queued and fetched again in a later round, the reason of every pair left without forecast is kept in
+``errors``.
+"""
+import asyncio
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from typing import Awaitable, Callable, Iterable, NamedTuple, Optional, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import ResponseCache
+from constants import BASE_URL, DEFAULT_LOCATION, FETCH_CONCURRENCY, FETCH_TIMEOUT, FETCH_RETRIES, FETCH_BACKOFF, \
+    RETRY_STATUS_CODES, FETCH_RATE, FETCH_BURST, FETCH_BREAKER_FAILURES, FETCH_BREAKER_RESET, FETCH_RETRY_ROUNDS, \
+    FETCH_RETRY_DELAY
+from extractor import extract_hours, extract_tz_offset, PageLayoutError
+from metrics import get_metrics
+from throttle import CircuitBreaker, TokenBucket, parse_retry_after
+from weather_forecast import WeatherMaker
+
+T = TypeVar('T')
+THROTTLING_STATUS_CODE = 429  # the site is up, but asks to slow down
+
+
+class FetchError(NamedTuple):
+    """A location and date pair left without forecast."""
+    location: str
+    day: datetime.date
+    reason: str  # e.g. 'HTTP 503', 'ReadTimeout', 'circuit open' or the page layout error
+    retryable: bool  # whether the error is temporary and a later attempt may succeed
+
+
+class AsyncForecastFetcher:
+    """Collects forecasts for a range of dates in a set of locations with a bounded count of simultaneous requests.
+
+    Args:
+        concurrency: The maximum count of simultaneous requests, also the size of the connection pool.
+        timeout: Seconds to wait for the site per request.
+        retries: Count of extra attempts for a date after a timeout, a connection error or a retryable status.
+        backoff: Seconds before the first retry, doubled for every next one.
+        base_url: The url of the forecasts site.
+        cache: The cache checked before going to the site, pages are not cached if it is None.
+        rate: Requests per second to the site while it answers well, the requests are not limited if it is None.
+        breaker_failures: Count of failed requests in a row after which the requests fail at once.
+        breaker_reset: Seconds before the requests are sent to the failing site again.
+        retry_rounds: Count of later rounds for the pairs which failed with a temporary error.
+        retry_delay: Seconds before a round, at least until the circuit breaker lets the requests through.
+    """
+
+    def __init__(self, concurrency: int = FETCH_CONCURRENCY, timeout: float = FETCH_TIMEOUT,
+                 retries: int = FETCH_RETRIES, backoff: float = FETCH_BACKOFF, base_url: str = BASE_URL,
+                 cache: Optional[ResponseCache] = None, rate: Optional[float] = FETCH_RATE,
+                 breaker_failures: int = FETCH_BREAKER_FAILURES, breaker_reset: float = FETCH_BREAKER_RESET,
+                 retry_rounds: int = FETCH_RETRY_ROUNDS, retry_delay: float = FETCH_RETRY_DELAY):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.base_url = base_url
+        self.cache = cache
+        self.rate_limiter = TokenBucket(rate, max(FETCH_BURST, concurrency)) if rate else None
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.retry_rounds = retry_rounds
+        self.retry_delay = retry_delay
+        self.errors: list[FetchError] = []  # the pairs left without forecast by the last collecting
+        self._errors: dict[tuple[str, datetime.date], tuple[str, bool]] = {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fetcher')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        """Closes the pooled connections and stops the threads."""
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _get(self, url: str, headers: dict) -> requests.Response:
+        with get_metrics().timer('fetch'):
+            return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    @staticmethod
+    def _parse_page(html: str, convert: Callable[[datetime.date, list[dict], str, Optional[float]], T],
+                    day: datetime.date, location: str) -> T:
+        with get_metrics().timer('parse'):
+            hours, tz_offset = extract_hours(html), extract_tz_offset(html)
+        return convert(day, hours, location, tz_offset)
+
+    def _fail(self, day: datetime.date, location: str, reason: str, retryable: bool) -> None:
+        """Keeps the reason why the pair is left without forecast."""
+        self._errors[location, day] = reason, retryable
+
+    async def fetch_page(self, day: datetime.date, semaphore: asyncio.Semaphore,
+                         location: str = DEFAULT_LOCATION) -> Optional[tuple[str, Optional[requests.Response]]]:
+        """Gets the page with the forecast for the day from the cache or downloads it, retrying with a backoff.
+
+        Args:
+            day: The day of the forecast.
+            semaphore: The semaphore bounding the count of simultaneous requests.
+            location: The coordinates of the forecast location.
+
+        Returns:
+            The text of the page with the downloaded response, which is cached once the page is parsed, or with None
+            for a page from the cache. None if the site did not return the page, the reason is kept for the errors.
+        """
+        loop = asyncio.get_running_loop()
+        cached = None
+        if self.cache is not None:
+            cached = await loop.run_in_executor(self._executor, self.cache.get, day, location)
+            if cached is not None and self.cache.is_fresh(day, cached):
+                get_metrics().count('pages_cached')
+                return cached.body, None
+
+        url = WeatherMaker.get_url(day, self.base_url, location)
+        headers = cached.get_validators() if cached is not None else {}
+        reason, retryable = 'no attempts', True
+        for attempt in range(self.retries + 1):
+            if attempt:
+                get_metrics().count('fetch_retries')
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            if not self.breaker.allow():
+                reason = 'circuit open'
+                break
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            async with semaphore:
+                try:
+                    response = await loop.run_in_executor(self._executor, self._get, url, headers)
+                except requests.RequestException as error:
+                    self.breaker.record_failure()
+                    reason = type(error).__name__
+                    continue
+            if response.status_code in RETRY_STATUS_CODES:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.slow_down(parse_retry_after(response.headers.get('Retry-After')))
+                if response.status_code != THROTTLING_STATUS_CODE:
+                    self.breaker.record_failure()
+                reason = f'HTTP {response.status_code}'
+                continue
+            self.breaker.record_success()
+            if self.rate_limiter is not None:
+                self.rate_limiter.speed_up()
+            if response.status_code == 304 and cached is not None:
+                get_metrics().count('pages_not_modified')
+                await loop.run_in_executor(self._executor, self.cache.refresh, day, cached, location)
+                return cached.body, None
+            if response.status_code == 200:
+                get_metrics().count('pages_fetched')
+                return response.text, response
+            reason, retryable = f'HTTP {response.status_code}', False
+            break
+        get_metrics().count('pages_failed')
+        return self._fail(day, location, reason, retryable)
+
+    async def fetch_hours(self, day: datetime.date, semaphore: asyncio.Semaphore, location: str,
+                          convert: Callable[[datetime.date, list[dict], str, Optional[float]], T]) -> Optional[T]:
+        """Downloads the page for the day and converts its hourly forecast.
+
+        A downloaded page is cached only if its forecast is converted, a page of the site under maintenance
+        or with a broken forecast is asked again.
+
+        Args:
+            convert: Builds the result from the day, the hourly forecast dicts of the page, the location
+                and the offset of the local time from UTC in hours, raises PageLayoutError for a broken forecast.
+
+        Returns:
+            The converted forecast or None if the page was not downloaded or has no forecast.
+        """
+        page = await self.fetch_page(day, semaphore, location)
+        if page is None:
+            return None
+        (html, response), loop = page, asyncio.get_running_loop()
+        try:
+            forecast = await loop.run_in_executor(self._executor, self._parse_page, html, convert, day, location)
+        except PageLayoutError as error:
+            return self._fail(day, location, str(error), retryable=False)
+        if response is not None and self.cache is not None:
+            await loop.run_in_executor(self._executor, self.cache.put, day, html, response.headers.get('ETag'),
+                                       response.headers.get('Last-Modified'), location)
+        return forecast
+
+    async def fetch_day(self, day: datetime.date, semaphore: asyncio.Semaphore,
+                        location: str = DEFAULT_LOCATION) -> Optional[dict]:
+        """Downloads and parses the forecast for the day.
+
+        Returns:
+            A forecast dict in the format of WeatherMaker or None if the page was not downloaded.
+        """
+        return await self.fetch_hours(day, semaphore, location, WeatherMaker.make_day_forecast)
+
+    async def fetch_hourly_day(self, day: datetime.date, semaphore: asyncio.Semaphore,
+                               location: str = DEFAULT_LOCATION) -> Optional[list[dict]]:
+        """Downloads the page for the day and converts its hourly forecast to the HourlyForecast table fields.
+
+        Returns:
+            Hourly forecast dicts or None if the page was not downloaded or has no forecast.
+        """
+        return await self.fetch_hours(day, semaphore, location, WeatherMaker.make_hourly_forecast)
+
+    async def schedule(self, fetch: Callable[..., Awaitable[Optional[T]]],
+                       pairs: Iterable[tuple[str, datetime.date]]) -> list[Optional[T]]:
+        """Runs the fetch for every location and date pair by a fixed count of workers.
+
+        The workers take the next pair when they are done with the previous one, so the count of pending
+        coroutines does not grow with the count of locations and dates, the requests are bounded by the semaphore.
+        The pairs failed with a temporary error are fetched again in up to retry_rounds later rounds,
+        the pairs left without result are kept in errors.
+
+        Args:
+            fetch: The coroutine function called with the day, the semaphore and the location.
+            pairs: The location and date pairs.
+
+        Returns:
+            The results in the order of the pairs, None for the pairs in errors.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results, failed = {}, {}
+        self._errors = {}
+
+        async def run_round(queue: Iterable[tuple[int, tuple[str, datetime.date]]]):
+            queue = iter(queue)
+
+            async def worker():
+                for index, (location, day) in queue:  # the iterator is shared, every pair is taken by one worker
+                    results[index] = await fetch(day, semaphore, location)
+                    if results[index] is None:
+                        failed[index] = location, day
+                    else:
+                        failed.pop(index, None)
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        def get_error(location: str, day: datetime.date) -> FetchError:
+            return FetchError(location, day, *self._errors.get((location, day), ('no forecast', False)))
+
+        await run_round(enumerate(pairs))
+        for _ in range(self.retry_rounds):
+            queued = [(index, pair) for index, pair in sorted(failed.items()) if get_error(*pair).retryable]
+            if not queued:
+                break
+            get_metrics().count('pairs_requeued', len(queued))
+            await asyncio.sleep(max(self.retry_delay, self.breaker.retry_in()))
+            await run_round(queued)
+        self.errors = [get_error(*pair) for _, pair in sorted(failed.items())]
+        return [results[index] for index in range(len(results))]
+
+    async def fetch_range(self, days: Iterable[datetime.date],
+                          locations: Iterable[str] = (DEFAULT_LOCATION,)) -> list[dict]:
+        """Collects forecasts for all the days in all the locations at once.
+
+        Returns:
+            Forecast dicts ordered by locations, then by days, the days without forecast are skipped.
+        """
+        return await self.fetch_pairs(product(locations, days))
+
+    async def fetch_pairs(self, pairs: Iterable[tuple[str, datetime.date]]) -> list[dict]:
+        """Collects forecasts for the location and date pairs.
+
+        Returns:
+            Forecast dicts in the order of the pairs, the pairs without forecast are skipped.
+        """
+        forecasts = await self.schedule(self.fetch_day, pairs)
+        return [forecast for forecast in forecasts if forecast is not None]
+
+    async def fetch_hourly_range(self, days: Iterable[datetime.date],
+                                 locations: Iterable[str] = (DEFAULT_LOCATION,)) -> list[dict]:
+        """Collects every hour's forecast for all the days in all the locations at once.
+
+        Returns:
+            Hourly forecast dicts in the format of the HourlyForecast table, ordered by locations, then by days.
+        """
+        return await self.fetch_hourly_pairs(product(locations, days))
+
+    async def fetch_hourly_pairs(self, pairs: Iterable[tuple[str, datetime.date]]) -> list[dict]:
+        """Collects every hour's forecast for the location and date pairs.
+
+        Returns:
+            Hourly forecast dicts in the format of the HourlyForecast table, in the order of the pairs.
+        """
+        pages = await self.schedule(self.fetch_hourly_day, pairs)
+        return [hour for hours in pages if hours is not None for hour in hours]
+
+    def get_weather_data(self, days: Iterable[datetime.date],
+                         locations: Iterable[str] = (DEFAULT_LOCATION,)) -> list[dict]:
+        """Collects forecasts for the days in the locations, blocking until all of them are done.
+
+        Returns:
+            Forecast dicts ordered by locations, then by days, the days without forecast are skipped.
+        """
+        return asyncio.run(self.fetch_range(days, locations))
+
+    def get_hourly_data(self, days: Iterable[datetime.date],
+                        locations: Iterable[str] = (DEFAULT_LOCATION,)) -> list[dict]:
+        """Collects every hour's forecast for the days in the locations, blocking until all of them are done.
+
+        Returns:
+            Hourly forecast dicts in the format of the HourlyForecast table, ordered by locations, then by days.
+        """
+        return asyncio.run(self.fetch_hourly_range(days, locations))
+
+    def get_pairs_data(self, pairs: Iterable[tuple[str, datetime.date]], hourly: bool = False) -> list[dict]:
+        """Collects forecasts for the location and date pairs, blocking until all of them are done.
+
+        Args:
+            pairs: The location and date pairs.
+            hourly: Whether every hour's forecasts should be collected instead of the daily ones.
+
+        Returns:
+            Forecast dicts or hourly forecast dicts in the order of the pairs.
+        """
+        return asyncio.run(self.fetch_hourly_pairs(pairs) if hourly else self.fetch_pairs(pairs))
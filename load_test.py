@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Load test of the local HTTP API: requests per second and latency percentiles.
+
+Every client thread keeps one connection to the server and requests the paths in turn. With ``--etag`` the clients
+send the ETag of the previous answer for the same path, measuring the 304 answers.
+
+Usage: python load_test.py [--url http://127.0.0.1:8766] [--clients 8] [--requests 2000] [--days 10] [--etag]
+"""
+import argparse
+import datetime
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from typing import Optional
+
+from constants import API_HOST, API_PORT
+
+
+def get_default_paths(days: int, location: Optional[str] = None) -> list[str]:
+    """Paths of the postcards of the next days and of their forecast."""
+    today = datetime.date.today()
+    query = f'?location={location}' if location else ''
+    paths = [f'/postcard/{today + datetime.timedelta(days=day)}{query}' for day in range(days)]
+    paths.append(f'/forecast?from={today}&to={today + datetime.timedelta(days=days)}'
+                 + (f'&location={location}' if location else ''))
+    return paths
+
+
+def percentile(sorted_values: list[float], share: float) -> float:
+    """The value below which the share of the sorted values falls, by the nearest rank."""
+    if not sorted_values:
+        return 0.
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(share * len(sorted_values))) - 1))]
+
+
+def run_load_test(url: str, paths: list[str], clients: int, requests_count: int, use_etag: bool = False) -> dict:
+    """Requests the paths from the server by the clients in parallel.
+
+    :param url: the url of the server
+    :param paths: paths requested by every client in turn
+    :param clients: count of client threads, each with its own keep-alive connection
+    :param requests_count: total count of requests
+    :param use_etag: whether the ETags of the previous answers should be sent
+    :return: the count of requests, requests per second, latency percentiles in ms and counts of status codes
+    """
+    address = urllib.parse.urlsplit(url)
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+    counts = [requests_count // clients + (client < requests_count % clients) for client in range(clients)]
+
+    def client(client_number: int):
+        connection = http.client.HTTPConnection(address.hostname, address.port, timeout=30)
+        etags, client_latencies, client_statuses = {}, [], Counter()
+        for i in range(counts[client_number]):
+            path = paths[(client_number + i) % len(paths)]
+            headers = {'If-None-Match': etags[path]} if use_etag and path in etags else {}
+            started = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                client_statuses['error'] += 1
+                connection.close()
+                continue
+            client_latencies.append(time.perf_counter() - started)
+            client_statuses[response.status] += 1
+            if response.getheader('ETag'):
+                etags[path] = response.getheader('ETag')
+        connection.close()
+        with lock:
+            latencies.extend(client_latencies)
+            statuses.update(client_statuses)
+
+    threads = [threading.Thread(target=client, args=(client_number,)) for client_number in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'seconds': round(seconds, 3),
+        'rps': round(len(latencies) / seconds, 1) if seconds else 0.,
+        'p50_ms': round(percentile(latencies, .5) * 1000, 3),
+        'p90_ms': round(percentile(latencies, .9) * 1000, 3),
+        'p99_ms': round(percentile(latencies, .99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+    }
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Measure requests per second and latency of the HTTP API')
+    parser.add_argument('--url', type=str, default=f'http://{API_HOST}:{API_PORT}', help='url of the server')
+    parser.add_argument('--clients', type=int, default=8, help='count of concurrent keep-alive clients')
+    parser.add_argument('--requests', type=int, default=2000, help='total count of requests')
+    parser.add_argument('--days', type=int, default=10, help='count of days of the requested postcards')
+    parser.add_argument('--location', type=str, help='coordinates of the location, the default one if not given')
+    parser.add_argument('--path', action='append', dest='paths', help='path to request instead of the default ones')
+    parser.add_argument('--etag', action='store_true', help='send the ETags of the previous answers')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    params = parser.parse_args(args)
+
+    paths = params.paths or get_default_paths(params.days, params.location)
+    results = run_load_test(params.url, paths, params.clients, params.requests, params.etag)
+    if params.json:
+        print(json.dumps(results))
+        return
+    print(f'{results["requests"]} requests in {results["seconds"]} s: {results["rps"]} requests/s')
+    print(f'latency p50 {results["p50_ms"]} ms, p90 {results["p90_ms"]} ms, p99 {results["p99_ms"]} ms, '
+          f'max {results["max_ms"]} ms')
+    print('statuses: ' + ', '.join(f'{status}: {count}' for status, count in results['statuses'].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Locations of the forecasts.
+
+A location is given by its coordinates in the format of https://darksky.net urls: "latitude,longitude",
+for example "59.9343,30.3351". Locations come from the command line or from a file with a location per line,
+empty lines and lines starting with # are skipped.
+"""
+import re
+from typing import Iterable
+
+from constants import DEFAULT_LOCATION
+
+LOCATION_PATTERN = re.compile(r'\s*(-?\d{1,2}(?:\.\d+)?)\s*,\s*(-?\d{1,3}(?:\.\d+)?)\s*')
+
+
+def parse_location(text: str) -> str:
+    """Checks the coordinates and returns them in the format of the site urls.
+
+    :param text: latitude and longitude separated by a comma, spaces around the numbers are allowed
+    :return: the location, e.g. "59.9343,30.3351"
+    :raise ValueError: if the text is not coordinates
+    """
+    match = LOCATION_PATTERN.fullmatch(text)
+    if match is None:
+        raise ValueError(f'{text!r} is not "latitude,longitude" coordinates')
+    latitude, longitude = match.groups()
+    if abs(float(latitude)) > 90 or abs(float(longitude)) > 180:
+        raise ValueError(f'{text!r} coordinates are out of range')
+    return f'{latitude},{longitude}'
+
+
+def read_locations(path: str) -> list[str]:
+    """Reads the locations from a file with a location per line.
+
+    :param path: the path to the file
+    :return: the locations in the order of the file, without repeats
+    :raise ValueError: if a line is not coordinates
+    """
+    with open(path, encoding='utf-8') as locations_file:
+        lines = [line.strip() for line in locations_file]
+    return unique_locations(line for line in lines if line and not line.startswith('#'))
+
+
+def unique_locations(locations: Iterable[str]) -> list[str]:
+    """Parses the locations and drops the repeated ones, keeping the order."""
+    return list(dict.fromkeys(parse_location(location) for location in locations))
+
+
+def get_location_dir_name(location: str = DEFAULT_LOCATION) -> str:
+    """Name of the directory with the postcards or the files of the location."""
+    return location.replace(',', '_')
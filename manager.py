@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
-"""This module contains the Manager class for managing all processes of the weather forecast project."""
+"""This module contains the Manager class for managing all processes of the weather forecast project.
+
+The modules of the fetching (requests) and of the drawing (OpenCV and NumPy) are imported by the stages
+which need them, so a run which only prints the stored forecasts does not load them.
+"""
 import argparse
-import threading
+import sys
+from collections import defaultdict
+from itertools import product
 from datetime import datetime, timedelta
-from typing import Iterable, Optional
+from typing import TYPE_CHECKING, Iterable, Optional
 
 from base import DatabaseUpdater
-from constants import DEFAULT_PATH_TO_SAVE_POSTCARD, DATE_FORMAT
-from postcard import ImageMaker
+from constants import DEFAULT_PATH_TO_SAVE_POSTCARD, DATE_FORMAT, BASE_URL, CACHE_PATH, DEFAULT_LOCATION, \
+    FETCH_CONCURRENCY, SHEET_COLUMNS, TIMELAPSE_FPS
+from extractor import PageLayoutError
+from locations import parse_location, read_locations, unique_locations, get_location_dir_name
+from metrics import enable_metrics, disable_metrics, get_metrics
+from utils import get_norm_and_joined_path
 from weather_forecast import WeatherMaker
 
+if TYPE_CHECKING:
+    from fetcher import AsyncForecastFetcher, FetchError
+    from manifest import RenderManifest
+    from postcard import ImageMaker
+
 
 class Manager:
     """The base class that manages the entire weather forecast process, including:
@@ -29,17 +44,23 @@ class Manager:
     Parameters:
     ----------
     parameters : str, optional
-        The string of command line parameters in the format "-f day1 -l day2 -c -p"
+        The string of command line parameters in the format "-f day1 -l day2 -c -p -j N"
         where "day1" and "day2" are dates in the format "yyyy-mm-dd", and "-c" and "-p"
-        indicate whether to print weather to the console and display postcards, respectively
+        indicate whether to print weather to the console and display postcards, respectively.
+        "-j N" saves postcards in batch mode with N processes instead of displaying them one by one,
+        "--locations" and "--locations-file" give the coordinates of the locations to get forecasts for,
+        "--sheet [COLUMNS]" and "--timelapse [FPS]" save the postcards of the range as one tiled image or video
     path_to_save : str, optional
-        The directory path for saving images of postcards
+        The directory path for saving images of postcards, the postcards of every location are saved
+        to a subdirectory if there are several locations
     """
 
     COUNT_OF_DAYS = 10
     COUNT_OF_WEEKDAYS = 7
 
-    def __init__(self, parameters: str = '', path_to_save: str = DEFAULT_PATH_TO_SAVE_POSTCARD):
+    def __init__(self, parameters: str = '', path_to_save: str = DEFAULT_PATH_TO_SAVE_POSTCARD,
+                 base_url: str = BASE_URL, cache_path: Optional[str] = CACHE_PATH,
+                 locations: Optional[list[str]] = None, concurrency: int = FETCH_CONCURRENCY):
         """
         Initialize a Manager object with default or given parameters.
 
@@ -51,10 +72,23 @@ class Manager:
             indicate whether to print weather to the console and display postcards, respectively
         path_to_save : str, optional
             The directory path for saving images of postcards
+        base_url : str, optional
+            The url of the forecasts site
+        cache_path : str, optional
+            The directory of the downloaded pages cache, pages are not cached if it is None
+        locations : list of str, optional
+            The coordinates of the locations to get forecasts for, the default location if it is None
+        concurrency : int, optional
+            The maximum count of simultaneous requests to the forecasts site for all the locations
         """
         self.weather_data = []
+        self.fetch_errors: list['FetchError'] = []
         self.parameters = parameters
         self.path_to_save = path_to_save
+        self.base_url = base_url
+        self.cache_path = cache_path
+        self.locations = unique_locations(locations) if locations else [DEFAULT_LOCATION]
+        self.concurrency = concurrency
 
     @staticmethod
     def next_day_gen(date: datetime.date, n: int) -> Iterable[datetime.date]:
@@ -76,8 +110,8 @@ class Manager:
             date += timedelta(days=1)
 
     def get_weather_data(self, first_date: Optional[datetime.date] = None,
-                         last_date: Optional[datetime.date] = None):
-        """Generate a list of dates to get forecasts for and start getting forecast data using threads.
+                         last_date: Optional[datetime.date] = None, dates: Optional[list[datetime.date]] = None):
+        """Generate a list of dates to get forecasts for and get forecast data for them.
 
         Parameters:
         ----------
@@ -85,40 +119,221 @@ class Manager:
             The first date of the date range for which to generate forecasts
         last_date : datetime.date, optional
             The last date of the date range for which to generate forecasts
+        dates : list of datetime.date, optional
+            The dates to get forecasts for instead of the date range
 
         Notes:
         -----
         If no dates are specified, the method will use the default date range (10 days + 7 weekdays)
-        starting from today's date. The method uses threads to get forecast data for each date in the range.
+        starting from today's date. The method downloads forecast data for the dates in the range in all the locations
+        concurrently, through a pool of connections shared by all the requests.
         """
-        date_start_from = first_date or datetime.today() - timedelta(weeks=1)
-        count_of_days = (last_date - first_date).days if last_date else self.COUNT_OF_DAYS + self.COUNT_OF_WEEKDAYS
-        lock = threading.Lock()
+        dates = self.get_dates(first_date, last_date) if dates is None else dates
+        self.fetch_pairs(product(self.locations, dates))
+
+    def get_hourly_weather_data(self, db_updater: DatabaseUpdater, first_date: Optional[datetime.date] = None,
+                                last_date: Optional[datetime.date] = None,
+                                dates: Optional[list[datetime.date]] = None):
+        """Get every hour's forecast data for the dates, store it and derive the daily forecasts from it.
+
+        Parameters:
+        ----------
+        db_updater : DatabaseUpdater
+            The database to store hourly forecasts to
+        first_date : datetime.date, optional
+            The first date of the date range for which to generate forecasts
+        last_date : datetime.date, optional
+            The last date of the date range for which to generate forecasts
+        dates : list of datetime.date, optional
+            The dates to get forecasts for instead of the date range
+
+        Notes:
+        -----
+        Each page is downloaded once: the daily forecasts are derived from the stored hours without refetching,
+        the same way as WeatherMaker does it for a page.
+        """
+        dates = self.get_dates(first_date, last_date) if dates is None else dates
+        self.fetch_pairs(product(self.locations, dates), db_updater)
+
+    def fetch_pairs(self, pairs: Iterable[tuple[str, datetime.date]], db_updater: Optional[DatabaseUpdater] = None):
+        """Get forecast data for the location and date pairs.
+
+        Parameters:
+        ----------
+        pairs : iterable of (str, datetime.date)
+            The locations and the dates to get forecasts for
+        db_updater : DatabaseUpdater, optional
+            The database to store hourly forecasts to, only the daily forecasts are collected if it is None
+
+        Notes:
+        -----
+        The pairs of all the locations are fetched by the same pool of requests, so the time depends on the
+        count of pairs and the concurrency, not on the count of locations. The pairs left without forecast
+        are reported with the reason and kept in fetch_errors.
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return
+        with self.get_fetcher() as fetcher:
+            if db_updater is None:
+                self.weather_data.extend(fetcher.get_pairs_data(pairs))
+            else:
+                db_updater.save_hourly_to_db(fetcher.get_pairs_data(pairs, hourly=True))
+            self.report_fetch_errors(fetcher.errors)
+        if db_updater is None:
+            return
+
+        dates_of_locations = defaultdict(set)
+        for location, day in pairs:
+            dates_of_locations[location].add(day)
+        for location, dates in dates_of_locations.items():
+            hours_of_days = defaultdict(list)
+            for hour in db_updater.get_hourly_from_db(min(dates), max(dates) + timedelta(days=1), location):
+                if hour['date'] in dates:
+                    hours_of_days[hour['date']].append(hour)
+            for day, hours in hours_of_days.items():
+                try:
+                    forecast = WeatherMaker.make_day_forecast(day, hours, location, hours[0]['tz_offset'])
+                except PageLayoutError:
+                    continue
+                self.weather_data.append(forecast)
+
+    def report_fetch_errors(self, errors: list['FetchError']):
+        """Print the location and date pairs left without forecast with the reasons and keep them in fetch_errors.
+
+        Parameters:
+        ----------
+        errors : list of FetchError
+            The pairs left without forecast by the fetcher
+        """
+        self.fetch_errors.extend(errors)
+        for error in errors:
+            print(f'No forecast for {error.day} at {error.location}: {error.reason}', file=sys.stderr)
 
-        dates = [day for day in self.next_day_gen(n=count_of_days, date=date_start_from)]
-        predictors = [WeatherMaker(lock, day=day, weather_data=self.weather_data) for day in dates]
-        for predictor in predictors:
-            predictor.start()
-        for predictor in predictors:
-            predictor.join()
+    def sync_weather_data(self, db_updater: DatabaseUpdater, first_date: datetime.date, last_date: datetime.date,
+                          hourly: bool = False) -> tuple[int, int]:
+        """Get forecast data only for the dates of the range which are missing in the database or stale there.
 
-    def __parse_the_dates_range(self) -> tuple[tuple[datetime.date, ...], bool, bool]:
+        Parameters:
+        ----------
+        db_updater : DatabaseUpdater
+            The database to check the stored forecasts in
+        first_date : datetime.date
+            The first date of the date range for which to generate forecasts
+        last_date : datetime.date
+            The last date of the date range for which to generate forecasts
+        hourly : bool, optional
+            Whether every hour's forecast should be stored
+
+        Returns:
+        -------
+        The count of fetched location and date pairs and the count of skipped up-to-date pairs
+        """
+        dates = self.get_dates(first_date, last_date)
+        pairs = [(location, day) for location in self.locations
+                 for day in db_updater.get_dates_to_sync(dates, location=location)]
+        count_of_stored = len(self.weather_data)
+        self.fetch_pairs(pairs, db_updater if hourly else None)
+        return len(self.weather_data) - count_of_stored, len(dates) * len(self.locations) - len(pairs)
+
+    def get_fetcher(self) -> 'AsyncForecastFetcher':
+        """Create a fetcher of the forecasts site, using the pages cache if it is enabled."""
+        from cache import ResponseCache
+        from fetcher import AsyncForecastFetcher
+
+        cache = ResponseCache(self.cache_path) if self.cache_path else None
+        return AsyncForecastFetcher(concurrency=self.concurrency, base_url=self.base_url, cache=cache)
+
+    def get_path_to_save(self, location: str) -> str:
+        """Get the directory for the postcards of the location, a subdirectory of path_to_save
+        if there are several locations."""
+        if len(self.locations) == 1:
+            return self.path_to_save
+        return get_norm_and_joined_path(self.path_to_save, get_location_dir_name(location))
+
+    @staticmethod
+    def draw_changed_postcard(image_maker: 'ImageMaker', forecast_data: tuple,
+                              manifest: Optional['RenderManifest'] = None) -> bool:
+        """Draw, display and save the postcard unless the manifest has its file saved from the same forecast.
+
+        Returns:
+        Whether the postcard was drawn, it is always drawn without a manifest.
+        """
+        from postcard import get_forecast_day
+
+        postcard_path = image_maker.get_postcard_path(forecast_data[1], get_forecast_day(forecast_data))
+        digest = manifest.get_digest(forecast_data) if manifest is not None else None
+        if manifest is not None and manifest.is_current(postcard_path, digest):
+            get_metrics().count('postcards_skipped')
+            return False
+        image_maker.draw_postcard(forecast_data, show=True)
+        if manifest is not None:
+            manifest.record(postcard_path, digest)
+        return True
+
+    def get_dates(self, first_date: Optional[datetime.date] = None,
+                  last_date: Optional[datetime.date] = None) -> list[datetime.date]:
+        """Get the dates from first_date up to but not including last_date.
+
+        Notes:
+        -----
+        If no dates are specified, the method will use the default date range (10 days + 7 weekdays)
+        starting from the day a week ago.
+        """
+        date_start_from = first_date or datetime.today().date() - timedelta(weeks=1)
+        count_of_days = (last_date - first_date).days if last_date else self.COUNT_OF_DAYS + self.COUNT_OF_WEEKDAYS
+        return [day for day in self.next_day_gen(n=count_of_days, date=date_start_from)]
+
+    def __parse_the_dates_range(self) -> tuple[tuple[datetime.date, ...], argparse.Namespace]:
         """
         Parses user input for date range and other parameters using argparse.
 
         Returns:
-        Tuple containing the date range as a tuple of datetime.date objects, a boolean indicating whether postcards
-        should be printed and saved, and a boolean indicating whether forecast data should be printed to console.
+        Tuple containing the date range as a tuple of datetime.date objects and the parsed parameters:
+        p - whether postcards should be printed and saved, c - whether forecast data should be printed to console,
+        j - the count of processes to render postcards in batch mode (None if postcards should be displayed),
+        i - whether only missing and stale dates should be fetched, hourly - whether every hour's forecast
+        should be stored, no_cache - whether cached pages should be ignored, locations and locations_file -
+        the coordinates of the locations and the file with them, concurrency - the count of simultaneous requests,
+        sheet - the count of postcards in a row of the sheet of the range, timelapse - the frame rate of the video
+        of the range (None if they should not be saved).
         """
         parser = argparse.ArgumentParser()
         parser.add_argument('-f', type=str, help='Enter first date of diapason to get forecast in yyyy-mm-dd format')
         parser.add_argument('-l', type=str, help='Enter last date of diapason to get forecast in yyyy-mm-dd format')
         parser.add_argument('-p', action='store_true', help='indicate param to print and save postcards')
         parser.add_argument('-c', action='store_true', help='indicate param to print forecasts in console')
+        parser.add_argument('-j', type=int, metavar='N',
+                            help='save postcards in batch mode using N processes, without displaying them')
+        parser.add_argument('-i', action='store_true',
+                            help='fetch only the dates missing in the database or with stale forecasts')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='download all the pages again instead of using the cached ones')
+        parser.add_argument('--hourly', action='store_true',
+                            help='store every hour\'s forecast and derive the daily ones from the stored hours')
+        parser.add_argument('--locations', nargs='+', type=parse_location, metavar='LAT,LON',
+                            help='coordinates of the locations to get forecasts for')
+        parser.add_argument('--locations-file', type=str, metavar='PATH',
+                            help='file with the coordinates of a location per line')
+        parser.add_argument('--concurrency', type=int, metavar='N',
+                            help='maximum count of simultaneous requests to the site for all the locations')
+        parser.add_argument('--force', action='store_true',
+                            help='draw all the postcards, even the ones saved from the same forecasts; without it '
+                                 'the unchanged postcards are neither drawn nor displayed again')
+        parser.add_argument('--sheet', type=int, nargs='?', const=SHEET_COLUMNS, metavar='COLUMNS',
+                            help='save the postcards of the range as one image with COLUMNS postcards in a row')
+        parser.add_argument('--timelapse', type=float, nargs='?', const=TIMELAPSE_FPS, metavar='FPS',
+                            help='save the postcards of the range as an MJPEG video with FPS postcards per second')
+        parser.add_argument('--metrics', action='store_true',
+                            help='time the stages of the run and print their summary at the end')
+        parser.add_argument('--metrics-export', type=str, metavar='PATH',
+                            help='write the metrics of the run to the file, implies --metrics')
+        parser.add_argument('--metrics-format', choices=('prometheus', 'jsonl'), default='prometheus',
+                            help='format of the exported metrics: Prometheus text or JSON lines')
         import datetime
         dates = parser.parse_args() if not self.parameters else parser.parse_args(self.parameters.split())
         dates_range = tuple(datetime.datetime.strptime(date, DATE_FORMAT).date() for date in (dates.f, dates.l))
-        return dates_range, dates.p, dates.c
+        return dates_range, dates
 
     def run(self):
         """
@@ -129,21 +344,73 @@ class Manager:
         None
         """
         db_updater = DatabaseUpdater()
-        (first_date, last_date), need_postcards, need_forecast = self.__parse_the_dates_range()
+        (first_date, last_date), params = self.__parse_the_dates_range()
+        need_postcards, need_forecast, workers = params.p, params.c, params.j
         assert (last_date - first_date).days > 0
+        assert workers is None or workers > 0
+        assert params.sheet is None or params.sheet > 0
+        assert params.timelapse is None or params.timelapse > 0
 
-        self.get_weather_data(first_date, last_date)
-        db_updater.save_weather_to_db(self.weather_data)
-        forecast = db_updater.get_data_from_db(first_date, last_date)
-        for forecast_data in forecast:
-            forecast_text = 'On {weekday} weather is {weather_type}, {temp} degrees'.format(
-                weekday=forecast_data[1], weather_type=forecast_data[0].lower(), temp=forecast_data[2]
-            )
+        metrics = enable_metrics() if params.metrics or params.metrics_export else None
+        try:
+            if params.no_cache:
+                self.cache_path = None
+            if params.concurrency is not None:
+                assert params.concurrency > 0
+                self.concurrency = params.concurrency
+            if params.locations or params.locations_file:
+                file_locations = read_locations(params.locations_file) if params.locations_file else []
+                self.locations = unique_locations(file_locations + (params.locations or []))
+            if params.i:
+                fetched, skipped = self.sync_weather_data(db_updater, first_date, last_date, params.hourly)
+                print(f'Fetched {fetched} dates, skipped {skipped} up-to-date dates')
+            elif params.hourly:
+                self.get_hourly_weather_data(db_updater, first_date, last_date)
+            else:
+                self.get_weather_data(first_date, last_date)
+            db_updater.save_weather_to_db(self.weather_data)
             if need_postcards:
-                print(forecast_text)
+                from batch import render_postcards
+                from manifest import RenderManifest
+                from postcard import ImageMaker
+            if params.sheet or params.timelapse:
+                from sheet import save_sheet, save_timelapse
 
-            if need_postcards:
-                ImageMaker(self.path_to_save).draw_postcard(forecast_data)
+            for location in self.locations:
+                path_to_save = self.get_path_to_save(location)
+                image_maker = ImageMaker(path_to_save) if need_postcards and workers is None else None
+                manifest = RenderManifest(path_to_save) if need_postcards and not params.force else None
+                for forecast_data in db_updater.iter_data_from_db(first_date, last_date, location):
+                    forecast_text = 'On {weekday} weather is {weather_type}, {temp} degrees'.format(
+                        weekday=forecast_data[1], weather_type=forecast_data[0].lower(), temp=forecast_data[2]
+                    )
+                    if len(self.locations) > 1:
+                        forecast_text = f'{location}: {forecast_text}'
+                    if need_forecast:
+                        print(forecast_text)
+
+                    if image_maker is not None:
+                        self.draw_changed_postcard(image_maker, forecast_data, manifest)
+                if image_maker is not None and manifest is not None:
+                    manifest.save()
+
+                if need_postcards and workers is not None:
+                    render_postcards(db_updater.iter_data_from_db(first_date, last_date, location), path_to_save,
+                                     workers, manifest=manifest)
+                if params.sheet:
+                    save_sheet(db_updater.iter_data_from_db(first_date, last_date, location), path_to_save,
+                               params.sheet)
+                if params.timelapse:
+                    save_timelapse(db_updater.iter_data_from_db(first_date, last_date, location), path_to_save,
+                                   params.timelapse)
+
+            if metrics is not None:
+                print(metrics.format_summary())
+                if params.metrics_export:
+                    metrics.export(params.metrics_export, params.metrics_format)
+        finally:
+            if metrics is not None:
+                disable_metrics()  # the metrics of the run are not collected by the next runs in the process
 
 
 if __name__ == "__main__":
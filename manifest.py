@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Manifest of the rendered postcards.
+
+Every postcard is identified by the digest of everything drawn on it: the weather type, the temperature,
+the date text, the icon, the colour, the template and the version of the drawing code. The manifest keeps the digest
+and the size of every postcard file of a directory, a postcard with the same digest as its file on disk
+is neither rendered nor encoded again.
+
+The manifest is a JSON file in the directory of the postcards, it is written by the process saving the postcards.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+from typing import Optional
+
+from numpy import ndarray
+
+from constants import TEMPLATE_PATH, POSTCARD_EXTENSION
+from utils import get_norm_and_joined_path
+
+MANIFEST_FILE_NAME = '.render_manifest.json'
+RENDER_VERSION = 1  # bump on every change of the drawing of the postcards
+
+
+@lru_cache(maxsize=None)
+def _get_file_digest(path: str) -> str:
+    """Digest of the content of a template or an icon file, read once per process."""
+    try:
+        with open(path, 'rb') as asset_file:
+            return hashlib.sha1(asset_file.read()).hexdigest()
+    except OSError:
+        return ''
+
+
+def _get_icon_digest(icon) -> Optional[str]:
+    if icon is None:
+        return None
+    if isinstance(icon, ndarray):
+        return hashlib.sha1(repr(icon.shape).encode() + icon.tobytes()).hexdigest()
+    return _get_file_digest(os.path.normpath(icon))
+
+
+def get_postcard_digest(data: tuple, path_to_template: str = TEMPLATE_PATH) -> str:
+    """Digest of the inputs of the postcard.
+
+    :param data: database field contains weather type and temp at this date, icon path and color to draw gradient
+    :param path_to_template: the path to the postcard's template file
+    :return: the hex digest
+    """
+    weather_type, date, temp, icon, color = data[:5]
+    inputs = (RENDER_VERSION, POSTCARD_EXTENSION, _get_file_digest(os.path.normpath(path_to_template)),
+              weather_type, date, str(temp), _get_icon_digest(icon), tuple(color) if color is not None else None)
+    return hashlib.sha1(repr(inputs).encode()).hexdigest()
+
+
+class RenderManifest:
+    """Digests and sizes of the postcard files of a directory.
+
+    Args:
+        path_to_save: The directory of the postcards.
+        path_to_template: The path to the postcard's template file.
+    """
+
+    def __init__(self, path_to_save: str, path_to_template: str = TEMPLATE_PATH):
+        self.path_to_save = path_to_save
+        self.path_to_template = path_to_template
+        self.path = get_norm_and_joined_path(path_to_save, MANIFEST_FILE_NAME)
+        self._entries = self._load()
+        self._is_changed = False
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, encoding='utf-8') as manifest_file:
+                entries = json.load(manifest_file)
+        except (OSError, ValueError):  # no manifest or a broken file
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def get_digest(self, data: tuple) -> str:
+        return get_postcard_digest(data, self.path_to_template)
+
+    def is_current(self, postcard_path: str, digest: str) -> bool:
+        """Checks if the file was saved from the inputs with the digest and was not replaced since."""
+        entry = self._entries.get(os.path.basename(postcard_path))
+        if not entry or entry[0] != digest:
+            return False
+        try:
+            return os.path.getsize(postcard_path) == entry[1]
+        except OSError:
+            return False
+
+    def record(self, postcard_path: str, digest: str) -> None:
+        """Remembers the digest of the inputs of a saved postcard."""
+        self._entries[os.path.basename(postcard_path)] = [digest, os.path.getsize(postcard_path)]
+        self._is_changed = True
+
+    def save(self) -> None:
+        """Writes the manifest if it has changed, replacing the previous one at once."""
+        if not self._is_changed:
+            return
+        os.makedirs(self.path_to_save, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.path_to_save, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w', encoding='utf-8') as manifest_file:
+                json.dump(self._entries, manifest_file, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self._is_changed = False
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Timers, counters and latency histograms of the stages of the pipeline.
+
+The stages are timed where they run: ``fetch`` (a request to the site), ``parse`` (extracting the forecast from
+a page), ``store`` (upserts), ``load`` (reading and preparing a forecast for a postcard), ``decode_icon``,
+``render`` (drawing a postcard) and ``encode`` (JPEG encoding). The counters count the items: fetched, cached,
+not modified and failed pages, stored forecasts, rendered and skipped postcards.
+
+Metrics are off by default: ``get_metrics()`` returns a registry whose timers and counters do nothing,
+so the instrumented code costs a function call per item. ``enable_metrics()`` installs a collecting registry
+for the process. The collected metrics are printed as a summary or exported in the Prometheus text format
+or as JSON lines.
+"""
+import bisect
+import json
+import threading
+import time
+from typing import Optional
+
+# upper bounds of the latency histogram buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+METRICS_PREFIX = 'weather_parser'
+
+
+class _Timer:
+    """Context manager adding the time of its block to a stage."""
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics: 'Metrics', stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """Thread-safe registry of the stage latencies and the item counters.
+
+    Args:
+        buckets: Upper bounds of the latency histogram buckets in seconds.
+    """
+    enabled = True
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._stages: dict[str, dict] = {}
+        self._counters: dict[str, int] = {}
+
+    def timer(self, stage: str) -> _Timer:
+        """Times the block of the with statement as an item of the stage."""
+        return _Timer(self, stage)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Adds an item of the stage which took the seconds."""
+        with self._lock:
+            stage_data = self._stages.get(stage)
+            if stage_data is None:
+                stage_data = self._stages[stage] = {'count': 0, 'sum': 0., 'max': 0.,
+                                                    'buckets': [0] * (len(self.buckets) + 1)}
+            stage_data['count'] += 1
+            stage_data['sum'] += seconds
+            stage_data['max'] = max(stage_data['max'], seconds)
+            stage_data['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Adds the value to the counter of the items."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        """Copy of the collected metrics: the stages with their counts, total and maximum seconds and bucket counts,
+        and the counters."""
+        with self._lock:
+            stages = {stage: dict(data, buckets=list(data['buckets'])) for stage, data in self._stages.items()}
+            return {'stages': stages, 'counters': dict(self._counters)}
+
+    def merge(self, snapshot: dict) -> None:
+        """Adds the metrics collected by another registry with the same buckets, e.g. in a worker process."""
+        with self._lock:
+            for stage, data in snapshot['stages'].items():
+                stage_data = self._stages.setdefault(stage, {'count': 0, 'sum': 0., 'max': 0.,
+                                                             'buckets': [0] * (len(self.buckets) + 1)})
+                stage_data['count'] += data['count']
+                stage_data['sum'] += data['sum']
+                stage_data['max'] = max(stage_data['max'], data['max'])
+                stage_data['buckets'] = [a + b for a, b in zip(stage_data['buckets'], data['buckets'])]
+            for name, value in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def pop_snapshot(self) -> dict:
+        """The collected metrics, the registry is emptied."""
+        with self._lock:
+            snapshot = {'stages': self._stages, 'counters': self._counters}
+            self._stages, self._counters = {}, {}
+        return snapshot
+
+    def get_percentile(self, stage: str, share: float) -> Optional[float]:
+        """Upper bound of the bucket of the item of the stage below which the share of the items falls,
+        the maximum time for the unbounded bucket."""
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                return None
+            rank, seen = share * data['count'], 0
+            for bound, count in zip(self.buckets, data['buckets']):
+                seen += count
+                if seen >= rank:
+                    return min(bound, data['max'])
+            return data['max']
+
+    def format_summary(self) -> str:
+        """Table of the stages and the counters for the end of a run."""
+        snapshot = self.snapshot()
+        lines = [f'{"stage":<12} {"count":>8} {"total s":>10} {"mean ms":>10} {"p50 ms":>10} {"p95 ms":>10} '
+                 f'{"max ms":>10}']
+        for stage, data in snapshot['stages'].items():
+            lines.append(f'{stage:<12} {data["count"]:>8} {data["sum"]:>10.3f} '
+                         f'{data["sum"] / data["count"] * 1000:>10.3f} {self.get_percentile(stage, .5) * 1000:>10.3f} '
+                         f'{self.get_percentile(stage, .95) * 1000:>10.3f} {data["max"] * 1000:>10.3f}')
+        if snapshot['counters']:
+            lines.append(', '.join(f'{name}: {value}' for name, value in snapshot['counters'].items()))
+        return '\n'.join(lines)
+
+    def to_prometheus(self, prefix: str = METRICS_PREFIX) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        name = f'{prefix}_stage_seconds'
+        lines = [f'# HELP {name} Time spent in the stages of the pipeline.', f'# TYPE {name} histogram']
+        for stage, data in snapshot['stages'].items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), data['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {data["sum"]!r}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {data["count"]}')
+        for counter, value in snapshot['counters'].items():
+            lines.extend((f'# TYPE {prefix}_{counter}_total counter', f'{prefix}_{counter}_total {value}'))
+        return '\n'.join(lines) + '\n'
+
+    def to_json_lines(self) -> str:
+        """The metrics as JSON lines: a line per stage and a line per counter."""
+        snapshot, timestamp = self.snapshot(), round(time.time(), 3)
+        lines = [json.dumps({'type': 'stage', 'stage': stage, 'timestamp': timestamp, 'count': data['count'],
+                             'sum_seconds': data['sum'], 'max_seconds': data['max'],
+                             'buckets': dict(zip(map(str, self.buckets + (float('inf'),)), data['buckets']))})
+                 for stage, data in snapshot['stages'].items()]
+        lines.extend(json.dumps({'type': 'counter', 'name': name, 'timestamp': timestamp, 'value': value})
+                     for name, value in snapshot['counters'].items())
+        return ''.join(line + '\n' for line in lines)
+
+    def export(self, path: str, metrics_format: str = 'prometheus') -> None:
+        """Writes the metrics to the file in the 'prometheus' or the 'jsonl' format."""
+        text = self.to_json_lines() if metrics_format == 'jsonl' else self.to_prometheus()
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(text)
+
+
+class NullMetrics(Metrics):
+    """Registry of disabled metrics: the timers and the counters do nothing."""
+    enabled = False
+
+    def timer(self, stage: str) -> _NullTimer:
+        return _NULL_TIMER
+
+    def observe(self, stage: str, seconds: float) -> None:
+        pass
+
+    def count(self, name: str, value: int = 1) -> None:
+        pass
+
+    def merge(self, snapshot: dict) -> None:
+        pass
+
+
+_metrics: Metrics = NullMetrics()
+
+
+def get_metrics() -> Metrics:
+    """The registry of the process, collecting nothing unless the metrics are enabled."""
+    return _metrics
+
+
+def enable_metrics(metrics: Optional[Metrics] = None) -> Metrics:
+    """Starts collecting the metrics of the process into the given or a new registry and returns it."""
+    global _metrics
+    _metrics = metrics if metrics is not None else Metrics()
+    return _metrics
+
+
+def disable_metrics() -> None:
+    """Stops collecting the metrics of the process."""
+    global _metrics
+    _metrics = NullMetrics()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Conversion of the databases created by previous versions to the current schema.
+
+The forecasts of the first versions were kept with text temperatures and with the icon path and the colors
+repeated in every row. They are converted in place to typed columns referencing the WeatherCategory table,
+a row whose temperature text is not a number is kept without temperature.
+The forecasts and the hourly forecasts stored before locations were added are moved to the default location.
+The nullable columns added to the models later, e.g. the time zone of the hourly forecasts, are added to the tables.
+The file is vacuumed after a conversion to give back the space of the old tables.
+
+The version of the stored data is kept in ``PRAGMA user_version``. Version 1: the forecasts of snow saved
+by the previous classifier in the rain category are moved to the snow category. Version 2: every forecast
+whose category differs from the one of the current classifier is moved to it.
+
+Usage: python migrations.py [path to the database file]
+"""
+import datetime
+import os
+import re
+import sys
+from collections import defaultdict
+from typing import Callable, Optional
+
+import peewee
+
+from classifier import classify_weather_types
+from constants import WEATHER_CATEGORY_CODES, ICONS_DATA, ICON_FILE_NAME, COLOR, NO_DATA, DEFAULT_LOCATION
+
+LEGACY_TABLE_SUFFIX = '_legacy'
+LEGACY_COLUMN = 'colors'  # the column of the first schema which is absent in the current one
+LOCATION_COLUMN = 'location'  # the column absent in the schemas before locations were added
+TEMPERATURE_PATTERN = re.compile(r'-?\d+(\.\d+)?')
+DATA_VERSION = 2
+
+
+def _get_legacy_category(icon_path: Optional[str], colors: Optional[str]) -> int:
+    """Finds the code of the weather category by the icon file name, then by the colors of a legacy row."""
+    icon_name = os.path.basename(icon_path or '')
+    normalized_colors = (colors or '').replace(' ', '')
+    for name, code in WEATHER_CATEGORY_CODES.items():
+        if icon_name and icon_name == ICONS_DATA[name][ICON_FILE_NAME]:
+            return code
+    for name, code in WEATHER_CATEGORY_CODES.items():
+        if normalized_colors and normalized_colors == ICONS_DATA[name][COLOR].replace(' ', ''):
+            return code
+    return WEATHER_CATEGORY_CODES[NO_DATA]
+
+
+def convert_legacy_row(row: dict) -> dict:
+    """Converts a row of the legacy forecast table to fields of the Forecast table.
+
+    :param row: the legacy row with text date and temperature, icon path, colors and optional fetched_at
+    :return: the converted fields, the temperature is None if it can not be parsed
+    """
+    match = TEMPERATURE_PATTERN.search(str(row['temperature']))
+    converted = {
+        'location': DEFAULT_LOCATION,
+        'date': datetime.date.fromisoformat(str(row['date'])[:10]),
+        'temperature': float(match.group()) if match is not None else None,
+        'weather_type': row['weather_type'],
+        'weather_category': _get_legacy_category(row['icon_path'], row['colors']),
+    }
+    if 'fetched_at' in row:
+        converted['fetched_at'] = row['fetched_at']
+    return converted
+
+
+def add_default_location(row: dict) -> dict:
+    """Moves a row stored before locations were added to the default location."""
+    return dict(row, location=DEFAULT_LOCATION)
+
+
+def _get_unique_fields(model: type[peewee.Model]) -> tuple[peewee.Field, ...]:
+    """Fields of the primary key or of the first unique index identifying the rows of the model."""
+    primary_key = model._meta.primary_key
+    if isinstance(primary_key, peewee.CompositeKey):
+        names = primary_key.field_names
+    else:
+        names = next(columns for columns, unique in model._meta.indexes if unique)
+    return tuple(model._meta.fields[name] for name in names)
+
+
+def _copy_rows(db: peewee.SqliteDatabase, table_name: str, model: type[peewee.Model],
+               convert_row: Callable[[dict], dict]) -> int:
+    """Copies the rows of the old table converted to the fields of the model, returns the count of copied rows."""
+    from base import bulk_upsert
+
+    cursor = db.execute_sql(f'SELECT * FROM "{table_name}"')
+    names = [description[0] for description in cursor.description]
+    rows = [convert_row(dict(zip(names, values))) for values in cursor.fetchall()]
+    bulk_upsert(model, rows, _get_unique_fields(model))
+    return len(rows)
+
+
+def _add_new_columns(db: peewee.SqliteDatabase, model: type[peewee.Model], columns: set[str]) -> None:
+    """Adds the nullable columns of the model which are absent in its table, the stored rows get NULL values."""
+    from playhouse.migrate import SqliteMigrator, migrate
+
+    migrator = SqliteMigrator(db)
+    operations = [migrator.add_column(model._meta.table_name, field.column_name, field)
+                  for field in model._meta.sorted_fields if field.null and field.column_name not in columns]
+    if operations:
+        with db.atomic('IMMEDIATE'):
+            migrate(*operations)
+
+
+def migrate_schema(db: peewee.SqliteDatabase) -> int:
+    """Converts the tables of the previous versions in the database in place, does nothing for the current schema.
+
+    The old tables are renamed, the current ones are created and filled with the converted rows,
+    then the old tables are dropped. The models have to be bound to the database.
+
+    :param db: the database to convert
+    :return: count of converted rows
+    """
+    from base import MODELS, Forecast, HourlyForecast, WeatherCategory, bulk_upsert, get_weather_categories
+
+    tables = db.get_tables()
+    conversions = []
+    for model in (Forecast, HourlyForecast):
+        table_name = model._meta.table_name
+        if table_name not in tables:
+            continue
+        columns = {column.name for column in db.get_columns(table_name)}
+        if LOCATION_COLUMN in columns:
+            _add_new_columns(db, model, columns)
+            continue
+        conversions.append((model, convert_legacy_row if LEGACY_COLUMN in columns else add_default_location))
+    if not conversions:
+        return 0
+
+    converted = 0
+    with db.atomic('IMMEDIATE'):  # the write lock is taken before the legacy tables are renamed
+        for model, _ in conversions:
+            table_name = model._meta.table_name
+            for index in db.get_indexes(table_name):  # the names are taken by the indexes of the current tables
+                if index.sql:  # the indexes of constraints go away with the table
+                    db.execute_sql(f'DROP INDEX "{index.name}"')
+            db.execute_sql(f'ALTER TABLE "{table_name}" RENAME TO "{table_name}{LEGACY_TABLE_SUFFIX}"')
+        db.create_tables(MODELS)
+        bulk_upsert(WeatherCategory, get_weather_categories(), WeatherCategory.code)
+        for model, convert_row in conversions:
+            legacy_table_name = model._meta.table_name + LEGACY_TABLE_SUFFIX
+            converted += _copy_rows(db, legacy_table_name, model, convert_row)
+            db.execute_sql(f'DROP TABLE "{legacy_table_name}"')
+    db.execute_sql('VACUUM')  # can not be run inside a transaction
+    return converted
+
+
+def reclassify_forecasts() -> int:
+    """Moves every stored forecast whose weather category differs from the one of the current classifier
+    to that category, e.g. the forecasts of snow put by the previous classifier in the rain category
+    or left without category.
+
+    :return: count of updated forecasts
+    """
+    from base import Forecast
+
+    weather_types = [weather_type for weather_type, in Forecast.select(Forecast.weather_type).distinct().tuples()]
+    weather_types_of_codes = defaultdict(list)
+    for weather_type, key in zip(weather_types, classify_weather_types(weather_types)):
+        weather_types_of_codes[WEATHER_CATEGORY_CODES[key]].append(weather_type)
+    return sum(Forecast.update(weather_category=code).where(
+        Forecast.weather_type.in_(weather_types_of_codes[code]) & (Forecast.weather_category != code)
+    ).execute() for code in weather_types_of_codes)
+
+
+def migrate_data(db: peewee.SqliteDatabase) -> int:
+    """Brings the stored data to DATA_VERSION, does nothing for the current data.
+
+    The models have to be bound to the database and the tables have to be created.
+
+    :param db: the database to update
+    :return: count of updated rows
+    """
+    if db.pragma('user_version') >= DATA_VERSION:
+        return 0
+    with db.atomic('IMMEDIATE'):  # the write lock is taken before the forecasts are read
+        if db.pragma('user_version') >= DATA_VERSION:  # updated by another connection meanwhile
+            return 0
+        updated = reclassify_forecasts()
+        db.pragma('user_version', DATA_VERSION)
+    return updated
+
+
+if __name__ == '__main__':
+    from base import DATABASE_NAME, create_database, setup_database
+
+    setup_database(create_database(sys.argv[1] if len(sys.argv) > 1 else DATABASE_NAME))
@@ -1,12 +1,22 @@
+import datetime
 import os
+from typing import BinaryIO, Optional
 
 import cv2
 from numpy.core.multiarray import ndarray
 
+from assets import get_assets
 from constants import *
+from gradient import draw_gradient
+from metrics import get_metrics
 from utils import viewImage, get_norm_and_joined_path
 
 
+def get_forecast_day(data: tuple) -> Optional[datetime.date]:
+    """The date of the forecast prepared by DatabaseUpdater, None for the data without a year."""
+    return data[5] if len(data) > 5 else None
+
+
 class ImageMaker:
     """"A class for creating weather postcards.
 
@@ -36,44 +46,73 @@ class ImageMaker:
         """
         self.__draw_gradient(background, colour)
         x, y = self.__width // 4, self.__height // 2
-        b, g, r, a = cv2.split(icon)
-        overlay_color = cv2.merge((b, g, r))
-
-        mask = cv2.medianBlur(a, 5)
-        h, w, _ = overlay_color.shape
-        roi = background[y:y + h, x:x + w]
+        return get_assets(self.path_to_template).overlay(icon).blend(background, x, y)
 
-        # Black-out the area behind the logo in our original ROI
-        img1_bg = cv2.bitwise_and(roi.copy(), roi.copy(), mask=cv2.bitwise_not(mask))
-        # Mask out the logo from the logo image.
-        img2_fg = cv2.bitwise_and(overlay_color, overlay_color, mask=mask)
-        background[y:y + h, x:x + w] = cv2.add(img1_bg, img2_fg)
+    def draw_postcard(self, data: tuple, show: bool = False):
+        """Draws picture with colored background, degrees, date and weather type caption and saves it.
+        Displays result postcard if it is asked.
 
-        return background
+        :param data: database field contains weather type and temp at this date, icon path and color to draw gradient
+        :param show: display the postcard in a window and wait for a key press before saving it
+        """
+        background = self.render_postcard(data)
+        if show:
+            viewImage(background, 'postcard')
+        self.save_postcard(data[1], background, get_forecast_day(data))
 
-    def draw_postcard(self, data: tuple):
-        """Draws picture with colored background, degrees, date and weather type caption.
-        Displays result postcard and saves it.
+    def encode_postcard(self, data: tuple) -> bytes:
+        """Draws the postcard and encodes it to JPEG without any GUI calls.
 
         :param data: database field contains weather type and temp at this date, icon path and color to draw gradient
+        :return: the JPEG bytes of the postcard
         """
-        postcard_template = cv2.imread(self.path_to_template)
-        weather_type, date, temp, icon, color = data
+        postcard = self.render_postcard(data)
+        with get_metrics().timer('encode'):
+            is_encoded, encoded_postcard = cv2.imencode(POSTCARD_EXTENSION, postcard)
+        if not is_encoded:
+            raise ValueError(f'Postcard for {data[1]} can not be encoded')
+        return encoded_postcard.tobytes()
 
-        postcard_side = max(postcard_template.shape[:2])
-        resized_icon_shape = int(postcard_side * .4)
+    def export_postcard(self, data: tuple, sink: BinaryIO) -> int:
+        """Draws the postcard and writes its JPEG bytes to a binary sink without any GUI calls.
 
-        postcard_background = cv2.resize(postcard_template, (postcard_side, postcard_side))
+        :param data: database field contains weather type and temp at this date, icon path and color to draw gradient
+        :param sink: a binary file-like object, e.g. an opened file, a socket file or io.BytesIO
+        :return: count of written bytes
+        """
+        encoded_postcard = self.encode_postcard(data)
+        sink.write(encoded_postcard)
+        return len(encoded_postcard)
 
-        self.__width, self.__height = postcard_background.shape[:2]
-        background = postcard_background
-        if icon is not None:
-            resized_icon = cv2.resize(icon, (resized_icon_shape, resized_icon_shape))
-            background = self.compare_background_and_icon(postcard_background, resized_icon, color)
+    def render_postcard(self, data: tuple, out: Optional[ndarray] = None) -> ndarray:
+        """Draws picture with colored background, degrees, date and weather type caption without displaying it.
 
-        self.__place_text_on_image(background, weather_type, temp, date)
-        viewImage(background, 'postcard')
-        self.save_postcard(date, background)
+        :param data: database field contains weather type and temp at this date, icon path and color to draw gradient
+        :param out: the matrix of the template's shape to draw in instead of a copy of the template,
+            e.g. a tile of a sheet or a reused video frame
+        :return: the postcard matrix, out if it is given
+        """
+        assets = get_assets(self.path_to_template)
+        weather_type, date, temp, icon, color = data[:5]
+        if isinstance(icon, str):  # records streamed from the database keep icon paths, not decoded icons
+            icon = assets.icon(icon)
+
+        with get_metrics().timer('render'):
+            if out is None:
+                postcard_background = assets.template.copy()
+            elif out.shape != assets.template.shape:
+                raise ValueError(f'Postcard of shape {assets.template.shape} can not be drawn in {out.shape}')
+            else:
+                out[...] = assets.template
+                postcard_background = out
+
+            self.__width, self.__height = postcard_background.shape[:2]
+            background = postcard_background
+            if icon is not None:
+                background = self.compare_background_and_icon(postcard_background, assets.fit_icon(icon), color)
+
+            self.__place_text_on_image(background, weather_type, temp, date)
+        return background
 
     def __place_text_on_image(self, background: ndarray, weather_type: str, temp: str, date: str) -> None:
         """Adds text to the input background image, indicating the weather type, temperature, and date.
@@ -97,24 +136,48 @@ class ImageMaker:
         second_line_coord = int(self.__width * .2), int(self.__height * .4)
         cv2.putText(text=date, org=second_line_coord, **common_params)
 
-    def save_postcard(self, date: str, postcard: ndarray):
+    def save_postcard(self, date: str, postcard: ndarray, day: Optional[datetime.date] = None):
         """Save a postcard image to the given directory.
 
         :param date: the date in text format to be used in the filename
         :param postcard: the image of the postcard to be saved
+        :param day: the date of the forecast, its year is added to the filename
+        """
+        metrics = get_metrics()
+        with metrics.timer('encode'):  # imwrite encodes the postcard and writes the file
+            cv2.imwrite(self.get_postcard_path(date, day), postcard)
+        metrics.count('postcards_rendered')
+
+    def write_postcard(self, date: str, encoded_postcard: bytes, day: Optional[datetime.date] = None) -> str:
+        """Save an already encoded postcard image to the given directory.
+
+        :param date: the date in text format to be used in the filename
+        :param encoded_postcard: the JPEG bytes of the postcard
+        :param day: the date of the forecast, its year is added to the filename
+        :return: the path of the saved file
+        """
+        postcard_path = self.get_postcard_path(date, day)
+        with get_metrics().timer('write'), open(postcard_path, 'wb') as postcard_file:
+            postcard_file.write(encoded_postcard)
+        return postcard_path
+
+    def get_postcard_path(self, date: str, day: Optional[datetime.date] = None) -> str:
+        """Get the path of the postcard file, creating the directory to save postcards if needed.
+
+        :param date: the date in text format to be used in the filename
+        :param day: the date of the forecast, its year is added to the filename
+        :return: the path of the JPEG file
         """
         file_name = "_".join(date.split()[1:]).lower()  # dd_mmm (01_jan, 30_oct, etc.)
+        if day is not None:
+            file_name = f'{file_name}_{day.year}'  # dd_mmm_yyyy (01_jan_2022)
         if not os.path.exists(self.path_to_save):
             os.makedirs(self.path_to_save)
-        image_path = get_norm_and_joined_path(self.path_to_save, f'{file_name}.jpg')
-        cv2.imwrite(image_path, postcard)
+        return get_norm_and_joined_path(self.path_to_save, f'{file_name}{POSTCARD_EXTENSION}')
 
     def __draw_gradient(self, background: ndarray, color: tuple) -> None:
         """Draw a gradient on the given picture, from the given color to white.
 
         :param background: the image to draw the gradient on
         :param color: the starting color of the gradient"""
-        color_shifts = [(255 - c) / self.__width for c in color]
-        for indent in range(self.__width):
-            cv2.line(background, (indent, 0), (indent, self.__height), color, 1)
-            color = [rgb_value + shift for rgb_value, shift in zip(color, color_shifts)]  # next line color
+        draw_gradient(background, color, self.__width, self.__height)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Postcards of a range of days saved as one file: a tiled sheet image or an MJPEG timelapse video.
+
+A sheet is allocated once for all its tiles, every postcard is drawn straight into its tile, and the sheet
+is encoded and written once, instead of an encoding and a file per day. A timelapse reuses one frame buffer
+for all the postcards and writes them as the frames of a video with ``cv2.VideoWriter``.
+"""
+import os
+from typing import Iterable, Optional
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from assets import get_assets
+from constants import TEMPLATE_PATH, POSTCARD_EXTENSION, SHEET_COLUMNS, TIMELAPSE_FPS
+from metrics import get_metrics
+from postcard import ImageMaker, get_forecast_day
+from utils import get_norm_and_joined_path
+
+SHEET_BACKGROUND = 255  # level of the empty tiles of the last row
+TIMELAPSE_EXTENSION = '.avi'
+TIMELAPSE_FOURCC = 'MJPG'
+
+
+def get_range_file_name(prefix: str, forecast: list[tuple], extension: str) -> str:
+    """Name of the file of the postcards of the forecast, e.g. sheet_01_jun_2022-30_jun_2022.jpg.
+
+    :param prefix: the kind of the file
+    :param forecast: database fields prepared by DatabaseUpdater, ordered by date
+    :param extension: the extension of the file with the dot
+    """
+    def get_day_name(data: tuple) -> str:
+        day = get_forecast_day(data)
+        name = "_".join(data[1].split()[1:]).lower()  # dd_mmm as in the names of the postcards
+        return f'{name}_{day.year}' if day is not None else name
+
+    return f'{prefix}_{get_day_name(forecast[0])}-{get_day_name(forecast[-1])}{extension}'
+
+
+def render_sheet(forecast: Iterable[tuple], columns: int = SHEET_COLUMNS,
+                 path_to_template: str = TEMPLATE_PATH) -> Optional[ndarray]:
+    """Draws the postcards of the forecast as the tiles of one image, row by row.
+
+    :param forecast: database fields prepared by DatabaseUpdater
+    :param columns: count of postcards in a row of the sheet
+    :param path_to_template: the path to the postcard's template file
+    :return: the sheet matrix, None if there is no forecast
+    """
+    forecast = list(forecast)
+    if not forecast:
+        return None
+    tile_height, tile_width, channels = get_assets(path_to_template).template.shape
+    columns = min(columns, len(forecast))
+    rows = -(-len(forecast) // columns)
+    sheet = np.full((rows * tile_height, columns * tile_width, channels), SHEET_BACKGROUND, dtype=np.uint8)
+
+    image_maker = ImageMaker('', path_to_template)
+    for i, data in enumerate(forecast):
+        row, column = divmod(i, columns)
+        tile = sheet[row * tile_height:(row + 1) * tile_height, column * tile_width:(column + 1) * tile_width]
+        image_maker.render_postcard(data, out=tile)
+    return sheet
+
+
+def save_sheet(forecast: Iterable[tuple], path_to_save: str, columns: int = SHEET_COLUMNS,
+               path_to_template: str = TEMPLATE_PATH) -> Optional[str]:
+    """Draws the postcards of the forecast as one sheet and saves it with a single encoding.
+
+    :param forecast: database fields prepared by DatabaseUpdater, ordered by date
+    :param path_to_save: the directory where the sheet will be stored
+    :param columns: count of postcards in a row of the sheet
+    :param path_to_template: the path to the postcard's template file
+    :return: the path of the saved file, None if there is no forecast
+    """
+    forecast = list(forecast)
+    sheet = render_sheet(forecast, columns, path_to_template)
+    if sheet is None:
+        return None
+    os.makedirs(path_to_save, exist_ok=True)
+    sheet_path = get_norm_and_joined_path(path_to_save, get_range_file_name('sheet', forecast, POSTCARD_EXTENSION))
+    with get_metrics().timer('encode'):
+        if not cv2.imwrite(sheet_path, sheet):
+            raise OSError(f'Sheet {sheet_path} can not be written')
+    return sheet_path
+
+
+def save_timelapse(forecast: Iterable[tuple], path_to_save: str, fps: float = TIMELAPSE_FPS,
+                   path_to_template: str = TEMPLATE_PATH) -> Optional[str]:
+    """Writes the postcards of the forecast as the frames of an MJPEG video, a postcard per frame.
+
+    :param forecast: database fields prepared by DatabaseUpdater, ordered by date
+    :param path_to_save: the directory where the video will be stored
+    :param fps: count of postcards shown per second
+    :param path_to_template: the path to the postcard's template file
+    :return: the path of the saved file, None if there is no forecast
+    """
+    forecast = list(forecast)
+    if not forecast:
+        return None
+    os.makedirs(path_to_save, exist_ok=True)
+    video_path = get_norm_and_joined_path(path_to_save,
+                                          get_range_file_name('timelapse', forecast, TIMELAPSE_EXTENSION))
+    frame = np.empty_like(get_assets(path_to_template).template)
+    height, width = frame.shape[:2]
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*TIMELAPSE_FOURCC), fps, (width, height))
+    if not writer.isOpened():
+        raise OSError(f'Timelapse {video_path} can not be written')
+
+    image_maker, metrics = ImageMaker('', path_to_template), get_metrics()
+    try:
+        for data in forecast:
+            image_maker.render_postcard(data, out=frame)
+            with metrics.timer('encode'):
+                writer.write(frame)
+    finally:
+        writer.release()
+    return video_path
@@ -1,36 +1,193 @@
+import asyncio
+import calendar
+import csv
 import datetime
+import importlib.util
+import io
+import json
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import Mock
+import urllib.error
+import urllib.request
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Union
+from unittest.mock import Mock, patch
 
-from base import database, DatabaseUpdater
+import cv2
+import numpy as np
+
+from api import APIServer, PostcardCache
+from assets import AssetRegistry, get_assets
+from base import database, create_database, setup_database, ensure_database, DatabaseUpdater, Forecast, \
+    HourlyForecast, MODELS, ForecastRecord
+from batch import render_postcards
+from benchmarks import load_html_samples, make_forecast_rows, run_benchmarks, compare_with_baseline, main as run_suite
+from cache import CachedResponse, ResponseCache
+from classifier import classify_weather_type, classify_weather_types
+from daemon import ForecastDaemon
 from constants import *
+from export import export_forecasts, iter_forecast_chunks, EXPORT_COLUMNS, main as export_main
+from extractor import extract_hours, extract_tz_offset, PageLayoutError
+from fetcher import AsyncForecastFetcher, FetchError
 from postcard import ImageMaker
+from sheet import render_sheet, save_sheet, save_timelapse
+from throttle import CircuitBreaker, TokenBucket
 from utils import get_norm_and_joined_path, TEST_POSTCARDS_DATA, get_count_of_postcards
-from weather import Manager
+from gradient import draw_gradient, draw_gradient_by_lines
+from load_test import run_load_test
+from locations import parse_location, read_locations
+from manager import Manager
+from manifest import RenderManifest
+from migrations import DATA_VERSION
+from metrics import Metrics, enable_metrics, disable_metrics, get_metrics
+from overlay import IconOverlay, overlay_icon_by_masks
 from weather_forecast import WeatherMaker
 
 
+STUB_TZ_OFFSET = 3  # hours from UTC to the local time of the stub locations, as on the saved pages
+
+
+def make_forecast_page(day: datetime.date, summary: str = 'Clear', temperature: Union[float, str] = 12.5,
+                       tz_offset: float = STUB_TZ_OFFSET) -> str:
+    """Builds a page in the format of https://darksky.net/details with the hourly forecast for the day.
+
+    The hours start at the midnight of the location, the temperature grows by 0.1 an hour,
+    a text temperature is given as is for every hour.
+    """
+    first_hour = calendar.timegm(day.timetuple()) - round(tz_offset * 3600)
+    hours = [{'time': first_hour + hour * 3600, 'summary': summary, 'icon': 'clear-day', 'precipProbability': 0,
+              'temperature': temperature if isinstance(temperature, str) else temperature + hour / 10,
+              'windSpeed': 3.2}
+             for hour in range(24)]
+    return ('<html><head><script>var lang = "en";</script></head><body>'
+            f'<script>var hours = {json.dumps(hours, separators=(",", ":"))}, startHour = 0, '
+            f'tz_offset = {tz_offset};</script></body></html>')
+
+
+@contextmanager
+def time_zone(name: str):
+    """Sets the local time zone of the process for the block."""
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = name
+    time.tzset()
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = previous
+        time.tzset()
+
+
+class StubForecastHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        location, day = self.path.split('/')[-4], datetime.date.fromisoformat(self.path.split('/')[-3])
+        with server.lock:
+            server.requests_count += 1
+            server.location_requests[location] += 1
+            server.day_requests[day] += 1
+            server.request_times.append(time.monotonic())
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failures = server.failures.get(day, 0)
+            server.failures[day] = failures - 1
+            throttled = server.throttled.get(day, 0)
+            server.throttled[day] = throttled - 1
+        time.sleep(server.delay)
+
+        body, etag = b'', f'"{day}-{server.summaries.get(day)}"'
+        if day in server.missing_days:
+            self.send_response(404)
+        elif server.unavailable or failures > 0:
+            self.send_response(503)
+        elif throttled > 0:
+            self.send_response(429)
+            self.send_header('Retry-After', server.retry_after)
+        elif day in server.broken_days:
+            self.send_response(200)
+            body = b'<html><body>We are updating the site</body></html>'
+        elif self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            server.not_modified_count += 1
+        else:
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            body = make_forecast_page(day, server.summaries.get(day, 'Clear'), server.temperatures.get(day, 12.5),
+                                      server.tz_offsets.get(location, STUB_TZ_OFFSET)).encode()
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubForecastServer(ThreadingHTTPServer):
+    """Local forecasts site with injected faults.
+
+    ``failures`` and ``throttled`` map a day to the count of 503 and 429 responses before its page, ``missing_days``
+    are answered with 404, ``broken_days`` with a page without forecast and all the days with 503 if ``unavailable``.
+    ``tz_offsets`` map a location to the offset of its local time from UTC, STUB_TZ_OFFSET by default.
+    """
+
+    def __init__(self, delay: float = 0):
+        super().__init__(('127.0.0.1', 0), StubForecastHandler)
+        self.lock = threading.Lock()
+        self.delay = delay
+        self.failures, self.missing_days, self.location_requests = {}, set(), Counter()
+        self.throttled, self.retry_after, self.broken_days, self.unavailable = {}, '0', set(), False
+        self.day_requests, self.request_times = Counter(), []
+        self.summaries = {}  # summaries of the pages of the days, 'Clear' by default
+        self.temperatures = {}  # temperatures at the midnight of the days, 12.5 by default
+        self.tz_offsets = {}
+        self.requests_count = self.in_flight = self.max_in_flight = self.not_modified_count = 0
+        self.base_url = f'http://127.0.0.1:{self.server_address[1]}/details'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        pass  # the client has gone after a timeout
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
 def isolate_db(test_func):
     def wrapper(*args, **kwargs):
-        with database.atomic():
+        ensure_database(database)  # the tables created inside the transaction would be rolled back
+        with database.atomic() as transaction:
             test_func(*args, **kwargs)
-            database.rollback()
+            transaction.rollback()
 
     return wrapper
 
 
 class ForecastTest(unittest.TestCase):
     def setUp(self) -> None:
-        self.predictor = WeatherMaker(weather_data=Mock(), lock=Mock(), day=datetime.date.today())
+        self.server = StubForecastServer()
+        self.predictor = WeatherMaker(weather_data=Mock(), lock=Mock(), day=datetime.date.today(),
+                                      base_url=self.server.base_url)
         self.db_updater = DatabaseUpdater()
-        self.leader = Manager()
-        self.painter = ImageMaker()
+        self.leader = Manager(base_url=self.server.base_url, cache_path=None)
+        self.painter = ImageMaker(PATH_TO_SAVE_TEST_POSTCARDS)
 
         self.days_difference = 2
         self.test_date1 = datetime.date.today()
         self.test_date2 = self.test_date1 + datetime.timedelta(days=self.days_difference)
 
+    def tearDown(self) -> None:
+        self.server.stop()
+
     def test_connection(self):
         self.assertEqual(self.predictor.weather_resp.status_code, 200)
 
@@ -65,7 +222,7 @@ class ForecastTest(unittest.TestCase):
     def test_postcard_generation(self):
         for i, data_unit in enumerate(TEST_POSTCARDS_DATA):
             postcard_data, postcard_sample = data_unit
-            self.painter.draw_postcard(postcard_data, PATH_TO_SAVE_TEST_POSTCARDS)
+            self.painter.draw_postcard(postcard_data)
             example_postcard = get_norm_and_joined_path(PATH_TO_POSTCARD_SAMPLES, postcard_sample)
             result_postcard = get_norm_and_joined_path(PATH_TO_SAVE_TEST_POSTCARDS, postcard_sample)
 
@@ -82,7 +239,9 @@ class ForecastTest(unittest.TestCase):
         count_of_postcards = get_count_of_postcards(PATH_TO_SAVE_TEST_POSTCARDS)
 
         day1, day2 = self.test_date1.strftime(DATE_FORMAT), self.test_date2.strftime(DATE_FORMAT)
-        Manager(f'-f {day1} -l {day2} -p', PATH_TO_SAVE_TEST_POSTCARDS).run()
+        with patch('postcard.viewImage'):
+            Manager(f'-f {day1} -l {day2} -p', PATH_TO_SAVE_TEST_POSTCARDS, base_url=self.server.base_url,
+                    cache_path=None).run()
 
         new_count = get_count_of_postcards(PATH_TO_SAVE_TEST_POSTCARDS)
         count_of_created_postcards = new_count - count_of_postcards
@@ -93,5 +252,1299 @@ class ForecastTest(unittest.TestCase):
             os.remove(os.path.join(PATH_TO_SAVE_TEST_POSTCARDS, name))
 
 
+class GradientTest(unittest.TestCase):
+    def test_gradient_matches_line_drawing(self):
+        for side in (1, 57, 400):
+            for data in ICONS_DATA.values():
+                color = tuple(map(int, data[COLOR].split(',')))
+                expected = np.zeros((side, side, 3), dtype=np.uint8)
+                result = np.zeros((side, side, 3), dtype=np.uint8)
+
+                draw_gradient_by_lines(expected, color, side, side)
+                draw_gradient(result, color, side, side)
+                self.assertTrue(np.array_equal(expected, result), f'{color} at {side}px')
+
+
+class AssetRegistryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.assets = AssetRegistry()
+
+    def test_assets_are_read_only(self):
+        icon_path = get_norm_and_joined_path(ICONS_PATH, ICONS_DATA[SUN][ICON_FILE_NAME])
+        for image in (self.assets.template, self.assets.icon(icon_path)):
+            with self.assertRaises(ValueError):
+                image[0, 0] = 0
+
+    def test_icons_are_decoded_once(self):
+        icon_path = get_norm_and_joined_path(ICONS_PATH, ICONS_DATA[RAIN][ICON_FILE_NAME])
+        icon = self.assets.icon(icon_path)
+        self.assertEqual(icon.shape[:2], (self.assets.icon_side, self.assets.icon_side))
+        self.assertIs(icon.base, self.assets.icon(icon_path).base)
+        self.assertIsNone(self.assets.icon('missing.png'))
+
+    def test_overlays_of_icon_views(self):
+        icon = self.assets.icon(get_norm_and_joined_path(ICONS_PATH, ICONS_DATA[RAIN][ICON_FILE_NAME]))
+        self.assertIs(self.assets.overlay(icon), self.assets.overlay(icon.view()))
+        half = icon[:, icon.shape[1] // 2:]
+        overlay = self.assets.overlay(half)
+        self.assertEqual((overlay.height, overlay.width), half.shape[:2])
+        np.testing.assert_array_equal(overlay.foreground, IconOverlay(half).foreground)
+        np.testing.assert_array_equal(self.assets.overlay(icon[::-1]).mask, IconOverlay(icon[::-1]).mask)
+
+
+class IconOverlayTest(unittest.TestCase):
+    def test_overlay_matches_masks_per_call(self):
+        assets = AssetRegistry()
+        x, y = assets.postcard_side // 4, assets.postcard_side // 2
+        for data in ICONS_DATA.values():
+            if not data[ICON_FILE_NAME]:
+                continue
+            icon = assets.icon(get_norm_and_joined_path(ICONS_PATH, data[ICON_FILE_NAME]))
+            color = tuple(map(int, data[COLOR].split(',')))
+            expected = assets.template.copy()
+            draw_gradient(expected, color, assets.postcard_side, assets.postcard_side)
+            result = expected.copy()
+
+            overlay_icon_by_masks(expected, icon, x, y)
+            assets.overlay(icon).blend(result, x, y)
+            self.assertTrue(np.array_equal(expected, result), data[ICON_FILE_NAME])
+
+    def test_overlay_of_unregistered_icon(self):
+        icon = np.zeros((20, 20, 4), dtype=np.uint8)
+        icon[5:15, 5:15] = (10, 20, 30, 255)
+        background = np.full((40, 40, 3), 200, dtype=np.uint8)
+        expected = overlay_icon_by_masks(background.copy(), icon, 10, 10)
+        self.assertTrue(np.array_equal(expected, IconOverlay(icon).blend(background, 10, 10)))
+
+
+class BatchRenderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        assets = AssetRegistry()
+        self.forecast = [
+            (data[WEATHER_TYPE], f'Mon, {day:02} Jan', str(day),
+             assets.icon(get_norm_and_joined_path(ICONS_PATH, data[ICON_FILE_NAME])) if data[ICON_FILE_NAME] else None,
+             tuple(map(int, data[COLOR].split(','))))
+            for day, data in enumerate(ICONS_DATA.values(), start=1)
+        ]
+
+    def test_batch_matches_serial_output(self):
+        with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as batch_dir:
+            image_maker = ImageMaker(serial_dir)
+            for data in self.forecast:
+                image_maker.save_postcard(data[1], image_maker.render_postcard(data))
+            self.assertEqual(render_postcards(self.forecast, batch_dir, workers=2), len(self.forecast))
+
+            self.assertEqual(sorted(os.listdir(serial_dir)), sorted(os.listdir(batch_dir)))
+            for name in os.listdir(serial_dir):
+                with open(os.path.join(serial_dir, name), 'rb') as serial, \
+                        open(os.path.join(batch_dir, name), 'rb') as batch:
+                    self.assertEqual(serial.read(), batch.read(), name)
+
+
+class SheetRenderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.forecast = [
+            ForecastRecord(data[WEATHER_TYPE], f'Mon, {day:02} Jan', str(day),
+                           get_norm_and_joined_path(ICONS_PATH, data[ICON_FILE_NAME]) if data[ICON_FILE_NAME] else None,
+                           tuple(map(int, data[COLOR].split(','))), datetime.date(2022, 1, day))
+            for day, data in enumerate(ICONS_DATA.values(), start=1)
+        ]
+        self.image_maker = ImageMaker('')
+
+    def test_tiles_match_postcards(self):
+        sheet = render_sheet(self.forecast, columns=2)
+        side = get_assets().template.shape[0]
+        self.assertEqual(sheet.shape, (3 * side, 2 * side, 3))
+        for i, data in enumerate(self.forecast):
+            row, column = divmod(i, 2)
+            tile = sheet[row * side:(row + 1) * side, column * side:(column + 1) * side]
+            self.assertTrue(np.array_equal(tile, self.image_maker.render_postcard(data)), data.weather_type)
+        self.assertTrue((sheet[2 * side:, side:] == 255).all())
+        self.assertIsNone(render_sheet([]))
+
+        with self.assertRaises(ValueError):
+            self.image_maker.render_postcard(self.forecast[0], out=np.empty((10, 10, 3), dtype=np.uint8))
+
+    def test_sheet_and_timelapse_saved(self):
+        with tempfile.TemporaryDirectory() as path_to_save:
+            sheet_path = save_sheet(self.forecast, path_to_save)
+            self.assertEqual(os.path.basename(sheet_path), 'sheet_01_jan_2022-05_jan_2022.jpg')
+            self.assertEqual(cv2.imread(sheet_path).shape[1], len(self.forecast) * get_assets().template.shape[1])
+
+            video_path = save_timelapse(self.forecast, path_to_save, fps=5)
+            self.assertEqual(os.path.basename(video_path), 'timelapse_01_jan_2022-05_jan_2022.avi')
+            video = cv2.VideoCapture(video_path)
+            frames = []
+            while True:
+                is_read, frame = video.read()
+                if not is_read:
+                    break
+                frames.append(frame)
+            video.release()
+            self.assertEqual(len(frames), len(self.forecast))
+            self.assertEqual(frames[0].shape, get_assets().template.shape)
+            self.assertEqual(sorted(os.listdir(path_to_save)), [os.path.basename(sheet_path),
+                                                                 os.path.basename(video_path)])
+
+
+class RenderManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path_to_save = self.temp_dir.name
+        self.forecast = [
+            ForecastRecord(data[WEATHER_TYPE], day.strftime(DATE_FORMAT_ON_POSTCARD), str(number),
+                           get_norm_and_joined_path(ICONS_PATH, data[ICON_FILE_NAME]) if data[ICON_FILE_NAME] else None,
+                           tuple(map(int, data[COLOR].split(','))), day)
+            for number, (day, data) in enumerate(zip([datetime.date(2021, 10, 14), datetime.date(2022, 10, 14),
+                                                      datetime.date(2022, 10, 15)], ICONS_DATA.values()))
+        ]
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def render(self, forecast: list, workers: int = 1) -> int:
+        return render_postcards(forecast, self.path_to_save, workers, manifest=RenderManifest(self.path_to_save))
+
+    def test_unchanged_postcards_skipped(self):
+        self.assertEqual(self.render(self.forecast), 3)
+        self.assertEqual(sorted(name for name in os.listdir(self.path_to_save) if name.endswith(POSTCARD_EXTENSION)),
+                         ['14_oct_2021.jpg', '14_oct_2022.jpg', '15_oct_2022.jpg'])
+        image_maker = ImageMaker(self.path_to_save)
+        for data in self.forecast:
+            with open(image_maker.get_postcard_path(data.date, data.day), 'rb') as postcard_file:
+                self.assertEqual(postcard_file.read(), image_maker.encode_postcard(data))
+        self.assertEqual(self.render(self.forecast), 0)
+        self.assertEqual(self.render(self.forecast, workers=2), 0)
+
+        self.forecast[1] = self.forecast[1]._replace(temperature='-3')
+        self.assertEqual(self.render(self.forecast, workers=2), 1)
+        with open(image_maker.get_postcard_path(self.forecast[1].date, self.forecast[1].day), 'rb') as postcard_file:
+            self.assertEqual(postcard_file.read(), image_maker.encode_postcard(self.forecast[1]))
+
+        os.remove(image_maker.get_postcard_path(self.forecast[0].date, self.forecast[0].day))
+        with open(image_maker.get_postcard_path(self.forecast[2].date, self.forecast[2].day), 'wb') as postcard_file:
+            postcard_file.write(b'replaced')
+        self.assertEqual(self.render(self.forecast), 2)
+        self.assertEqual(self.render(self.forecast), 0)
+
+    def test_broken_manifest_renders_again(self):
+        self.assertEqual(self.render(self.forecast), 3)
+        with open(RenderManifest(self.path_to_save).path, 'w') as manifest_file:
+            manifest_file.write('{')
+        self.assertEqual(self.render(self.forecast), 3)
+        self.assertEqual(get_count_of_postcards(self.path_to_save), 3)
+
+
+class HeadlessRenderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.postcard_data = TEST_POSTCARDS_DATA[0][0]
+
+    def test_encoded_postcard_matches_saved_one(self):
+        with tempfile.TemporaryDirectory() as path_to_save:
+            image_maker = ImageMaker(path_to_save)
+            with patch('postcard.viewImage') as view_image:
+                image_maker.draw_postcard(self.postcard_data)
+            view_image.assert_not_called()
+
+            with open(image_maker.get_postcard_path(self.postcard_data[1]), 'rb') as saved_postcard:
+                self.assertEqual(saved_postcard.read(), image_maker.encode_postcard(self.postcard_data))
+
+    def test_export_to_sink(self):
+        image_maker = ImageMaker('')
+        sink = io.BytesIO()
+        size = image_maker.export_postcard(self.postcard_data, sink)
+        self.assertEqual(sink.getvalue(), image_maker.encode_postcard(self.postcard_data))
+        self.assertEqual(size, len(sink.getvalue()))
+
+
+class AsyncFetcherTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubForecastServer(delay=.02)
+        self.days = [datetime.date.today() + datetime.timedelta(days=i) for i in range(6)]
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def get_weather_data(self, **params) -> list[dict]:
+        with AsyncForecastFetcher(base_url=self.server.base_url, backoff=.01, **params) as fetcher:
+            return fetcher.get_weather_data(self.days)
+
+    def test_records_for_range(self):
+        weather_data = self.get_weather_data()
+        self.assertEqual([data['date'] for data in weather_data], self.days)
+        for day, data in zip(self.days, weather_data):
+            self.assertEqual(data, WeatherMaker.parse_page(day, make_forecast_page(day)))
+        self.assertEqual(self.server.requests_count, len(self.days))
+
+    def test_bounded_concurrency(self):
+        self.get_weather_data(concurrency=2)
+        self.assertLessEqual(self.server.max_in_flight, 2)
+
+    def test_retries(self):
+        self.server.failures = {self.days[0]: 2, self.days[1]: 5}
+        self.server.missing_days = {self.days[2]}
+        weather_data = self.get_weather_data(retries=3, retry_rounds=0)
+
+        self.assertEqual([data['date'] for data in weather_data], self.days[:1] + self.days[3:])
+        self.assertEqual(self.server.requests_count, 3 + 4 + 1 + len(self.days[3:]))
+
+    def test_timeout(self):
+        self.server.delay = .5
+        self.assertEqual(self.get_weather_data(timeout=.05, retries=1, retry_rounds=0), [])
+
+
+class FetchSchedulerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubForecastServer()
+        self.days = [datetime.date.today() + datetime.timedelta(days=i) for i in range(6)]
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def get_weather_data(self, **params) -> tuple[list[dict], list[FetchError]]:
+        params = dict(dict(backoff=.01, retry_delay=.05), **params)
+        with AsyncForecastFetcher(base_url=self.server.base_url, **params) as fetcher:
+            return fetcher.get_weather_data(self.days), fetcher.errors
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=100, burst=2)
+
+        async def acquire(count: int) -> float:
+            started = time.monotonic()
+            for _ in range(count):
+                await bucket.acquire()
+            return time.monotonic() - started
+
+        self.assertLess(asyncio.run(acquire(2)), .01)  # the burst
+        self.assertGreaterEqual(asyncio.run(acquire(10)), .08)
+        bucket.slow_down()
+        bucket.slow_down(retry_after=.1)
+        self.assertEqual(bucket.rate, 25)
+        self.assertGreaterEqual(asyncio.run(acquire(1)), .09)
+        for _ in range(20):
+            bucket.speed_up()
+        self.assertEqual(bucket.rate, 100)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=.05)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual((breaker.state, breaker.allow()), (CircuitBreaker.OPEN, False))
+        time.sleep(.06)
+        self.assertEqual((breaker.state, breaker.allow()), (CircuitBreaker.HALF_OPEN, True))
+        breaker.record_failure()  # the trial failed
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(.06)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_throttling_honours_retry_after(self):
+        self.server.throttled, self.server.retry_after = {self.days[0]: 1}, '0.2'
+        weather_data, errors = self.get_weather_data(concurrency=1, rate=100)
+        self.assertEqual([data['date'] for data in weather_data], self.days)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.server.day_requests[self.days[0]], 2)
+        self.assertGreaterEqual(self.server.request_times[1] - self.server.request_times[0], .2)
+
+    def test_breaker_fails_fast(self):
+        self.server.unavailable = True
+        weather_data, errors = self.get_weather_data(concurrency=1, retries=1, retry_rounds=0, breaker_failures=3)
+        self.assertEqual(weather_data, [])
+        self.assertEqual(self.server.requests_count, 3)
+        self.assertEqual([(error.day, error.reason, error.retryable) for error in errors],
+                         [(self.days[0], 'HTTP 503', True), (self.days[1], 'circuit open', True)]
+                         + [(day, 'circuit open', True) for day in self.days[2:]])
+
+    def test_failed_dates_retried_later(self):
+        self.server.failures = {self.days[1]: 3}
+        self.server.missing_days = {self.days[2]}
+        self.server.broken_days = {self.days[3]}
+        weather_data, errors = self.get_weather_data(retries=1, retry_rounds=1)
+
+        self.assertEqual([data['date'] for data in weather_data], self.days[:2] + self.days[4:])
+        self.assertEqual(self.server.day_requests[self.days[1]], 4)
+        self.assertEqual(self.server.day_requests[self.days[2]], 1)  # errors which are not temporary are not retried
+        self.assertEqual(self.server.day_requests[self.days[3]], 1)
+        self.assertEqual(errors[0], FetchError(DEFAULT_LOCATION, self.days[2], 'HTTP 404', False))
+        self.assertEqual(errors[1][:2], (DEFAULT_LOCATION, self.days[3]))
+        self.assertFalse(errors[1].retryable)
+        self.assertEqual(len(errors), 2)
+
+    def test_manager_reports_errors(self):
+        self.server.missing_days = {self.days[1]}
+        leader = Manager(base_url=self.server.base_url, cache_path=None)
+        with patch('sys.stderr', io.StringIO()) as stderr:
+            leader.get_weather_data(self.days[0], self.days[3])
+        self.assertEqual([data['date'] for data in leader.weather_data], [self.days[0], self.days[2]])
+        self.assertEqual(leader.fetch_errors, [FetchError(DEFAULT_LOCATION, self.days[1], 'HTTP 404', False)])
+        self.assertIn(f'No forecast for {self.days[1]} at {DEFAULT_LOCATION}: HTTP 404', stderr.getvalue())
+
+
+class BenchmarkSuiteTest(unittest.TestCase):
+    def test_results_and_baseline_comparison(self):
+        run = run_benchmarks(('parse', 'fetch'), repeats=1)
+        self.assertEqual({measurement['stage'] for measurement in run['results'].values()}, {'parse', 'fetch'})
+        for measurement in run['results'].values():
+            self.assertGreater(measurement['median_ms'], 0)
+            self.assertLessEqual(measurement['min_ms'], measurement['median_ms'])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            baseline_path = os.path.join(temp_dir, 'baseline.json')
+            with open(baseline_path, 'w') as baseline_file:
+                json.dump(run, baseline_file)
+            with patch('sys.stdout', io.StringIO()):
+                self.assertEqual(run_suite(['--stages', 'parse', '--repeats', '1', '--baseline', baseline_path,
+                                            '--threshold', '1000']), 0)
+                with open(baseline_path, 'w') as baseline_file:
+                    json.dump({'results': {name: dict(measurement, median_ms=measurement['median_ms'] / 10)
+                                           for name, measurement in run['results'].items()}}, baseline_file)
+                self.assertEqual(run_suite(['--stages', 'parse', '--repeats', '1', '--baseline', baseline_path]), 1)
+
+    def test_startup_loads_no_drawing_or_network_modules(self):
+        run = run_benchmarks(('startup',), repeats=1)
+        manager_startup = run['results']['startup, import manager']
+        self.assertEqual(manager_startup['heavy_modules'], ['peewee'])
+        self.assertGreater(manager_startup['import_ms'], 0)
+        self.assertIn('cv2', run['results']['startup, import api']['heavy_modules'])
+
+    def test_compare_with_baseline(self):
+        results = {'a': {'median_ms': 1.2}, 'b': {'median_ms': 2.}, 'new': {'median_ms': 1.}}
+        baseline = {'a': {'median_ms': 1.}, 'b': {'median_ms': 1.}, 'removed': {'median_ms': 1.}}
+        self.assertEqual(compare_with_baseline(results, baseline, threshold=.25), [
+            {'name': 'a', 'median_ms': 1.2, 'baseline_ms': 1., 'ratio': 1.2, 'regression': False},
+            {'name': 'b', 'median_ms': 2., 'baseline_ms': 1., 'ratio': 2., 'regression': True},
+        ])
+
+
+class ExtractorTest(unittest.TestCase):
+    # weather type and temperature at 16:00 of the location (UTC+3) in the saved pages
+    EXPECTED_FORECASTS = {
+        datetime.date(2021, 10, 14): ('Overcast', 9.37),
+        datetime.date(2021, 10, 16): ('Possible Light Rain', 7.34),
+        datetime.date(2021, 11, 7): ('Breezy and Partly Cloudy', 5.97),
+        datetime.date(2022, 1, 20): ('Heavy Snow', -2.97),
+        datetime.date(2022, 6, 16): ('Partly Cloudy', 24.47),
+    }
+
+    def setUp(self) -> None:
+        self.enterContext(time_zone('UTC'))  # the machine's time zone differs from the one of the location
+        self.samples = load_html_samples()
+
+    def test_all_hours_extracted(self):
+        for day, html in self.samples:
+            hours = extract_hours(html)
+            self.assertEqual(len(hours), 24)
+            self.assertEqual([hour['time'] for hour in hours], sorted(hour['time'] for hour in hours))
+            self.assertTrue(all({'summary', 'temperature'} <= hour.keys() for hour in hours), day)
+
+    def test_forecasts_of_saved_pages(self):
+        self.assertEqual(len(self.samples), len(self.EXPECTED_FORECASTS))
+        for day, html in self.samples:
+            data = WeatherMaker.parse_page(day, html)
+            self.assertEqual((data[WEATHER_TYPE], data['temperature']), self.EXPECTED_FORECASTS[day])
+            self.assertEqual(data['date'], day)
+
+    def test_time_zone_of_location(self):
+        for day, html in self.samples:
+            self.assertEqual(extract_tz_offset(html), 3, day)
+        self.assertIsNone(extract_tz_offset('<script>var hours = [], startHour = 0;</script>'))
+        self.assertEqual(extract_tz_offset(make_forecast_page(datetime.date(2022, 1, 1), tz_offset=-9.5)), -9.5)
+
+    def test_wrong_layout(self):
+        for html in ('<html><script>var lang = "en";</script></html>', '<script>var hours = [{"time":1,</script>',
+                     '<script>var startHours = [{"time":1}];</script>'):
+            with self.assertRaises(PageLayoutError):
+                extract_hours(html)
+        with self.assertRaises(PageLayoutError):
+            WeatherMaker.parse_page(datetime.date(2021, 10, 15), self.samples[0][1])
+
+
+class HourlyStorageTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubForecastServer()
+        self.first_date = datetime.date.today()
+        self.last_date = self.first_date + datetime.timedelta(days=3)
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    @isolate_db
+    def test_daily_forecasts_derived_from_stored_hours(self):
+        leader = Manager(base_url=self.server.base_url, cache_path=None)
+        db_updater = DatabaseUpdater()
+        leader.get_hourly_weather_data(db_updater, self.first_date, self.last_date)
+        self.assertEqual(self.server.requests_count, 3)
+
+        hours = db_updater.get_hourly_from_db(self.first_date, self.last_date)
+        self.assertEqual(len(hours), 3 * 24)
+        self.assertEqual(HourlyForecast.select().where(HourlyForecast.date == self.first_date).count(), 24)
+
+        days = leader.get_dates(self.first_date, self.last_date)
+        with AsyncForecastFetcher(base_url=self.server.base_url) as fetcher:
+            self.assertEqual(leader.weather_data, fetcher.get_weather_data(days))
+
+    @isolate_db
+    def test_hours_are_updated(self):
+        db_updater = DatabaseUpdater()
+        hours = extract_hours(make_forecast_page(self.first_date, temperature=1))
+        db_updater.save_hourly_to_db(WeatherMaker.make_hourly_forecast(self.first_date, hours))
+        hours = extract_hours(make_forecast_page(self.first_date, summary='Light Snow', temperature=-1))
+        db_updater.save_hourly_to_db(WeatherMaker.make_hourly_forecast(self.first_date, hours))
+
+        stored_hours = db_updater.get_hourly_from_db(self.first_date, self.first_date + datetime.timedelta(days=1))
+        self.assertEqual(len(stored_hours), 24)
+        self.assertEqual(stored_hours[0]['summary'], 'Light Snow')
+        self.assertEqual(stored_hours[0]['temperature'], -1)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubForecastServer()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        today = datetime.date.today()
+        # yesterday may not have ended in every time zone yet
+        self.past_days = [today - datetime.timedelta(days=3), today - datetime.timedelta(days=2)]
+        self.future_days = [today, today + datetime.timedelta(days=1)]
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        self.cache_dir.cleanup()
+
+    def get_weather_data(self, ttl: float = CACHE_TTL) -> list[dict]:
+        cache = ResponseCache(self.cache_dir.name, ttl=ttl)
+        with AsyncForecastFetcher(base_url=self.server.base_url, cache=cache) as fetcher:
+            return fetcher.get_weather_data(self.past_days + self.future_days)
+
+    def test_repeated_runs_use_cache(self):
+        weather_data = self.get_weather_data()
+        self.assertEqual(self.server.requests_count, 4)
+        self.assertEqual(self.get_weather_data(), weather_data)
+        self.assertEqual(self.server.requests_count, 4)
+
+    def test_expired_pages_are_revalidated(self):
+        weather_data = self.get_weather_data(ttl=0)
+        self.assertEqual(self.get_weather_data(ttl=0), weather_data)
+        self.assertEqual(self.server.requests_count, 4 + len(self.future_days))
+        self.assertEqual(self.server.not_modified_count, len(self.future_days))
+
+    def test_stored_compressed(self):
+        cache = ResponseCache(self.cache_dir.name)
+        day, page = self.past_days[0], make_forecast_page(self.past_days[0])
+        cache.put(day, page, etag='"1"')
+        file_path = os.path.join(self.cache_dir.name, os.listdir(self.cache_dir.name)[0])
+        self.assertLess(os.path.getsize(file_path), len(page) / 2)
+
+        cached = cache.get(day)
+        self.assertEqual(cached.body, page)
+        self.assertEqual(cached.get_validators(), {'If-None-Match': '"1"'})
+        self.assertTrue(cache.is_fresh(day, cached, now=time.time() + 10 * CACHE_TTL))
+        self.assertFalse(cache.is_fresh(self.future_days[0], cached, now=time.time() + 10 * CACHE_TTL))
+
+        with open(file_path, 'wb') as broken_file:
+            broken_file.write(b'broken')
+        self.assertIsNone(cache.get(day))
+        self.assertIsNone(cache.get(self.past_days[1]))
+
+    def test_past_day_cached_before_its_end_expires(self):
+        cache, day = ResponseCache(self.cache_dir.name), self.past_days[1]
+        during_day = time.mktime((day + datetime.timedelta(days=1)).timetuple()) - 3600
+        forecast = CachedResponse(make_forecast_page(day, 'Rain'), during_day, etag=f'"{day}-Rain"')
+        self.assertFalse(cache.is_final(day, forecast))
+        self.assertTrue(cache.is_fresh(day, forecast, now=during_day + 60))
+        self.assertFalse(cache.is_fresh(day, forecast))
+
+        with patch('time.time', return_value=during_day):
+            cache.put(day, forecast.body, forecast.etag)
+        with AsyncForecastFetcher(base_url=self.server.base_url, cache=cache) as fetcher:
+            self.assertEqual(fetcher.get_weather_data([day])[0][WEATHER_TYPE], 'Clear')
+        self.assertEqual(self.server.requests_count, 1)
+        self.assertTrue(cache.is_fresh(day, cache.get(day), now=time.time() + 10 * CACHE_TTL))
+
+    def test_page_without_forecast_not_cached(self):
+        self.server.broken_days = {self.past_days[0]}
+        cache = ResponseCache(self.cache_dir.name)
+        with AsyncForecastFetcher(base_url=self.server.base_url, cache=cache) as fetcher:
+            self.assertEqual(fetcher.get_weather_data(self.past_days[:1]), [])
+        self.assertIsNone(cache.get(self.past_days[0]))
+
+    def test_page_with_broken_temperature_reported_and_not_cached(self):
+        self.server.temperatures = {self.past_days[0]: 'n/a'}
+        cache = ResponseCache(self.cache_dir.name)
+        for _ in range(2):
+            with AsyncForecastFetcher(base_url=self.server.base_url, cache=cache) as fetcher:
+                self.assertEqual([data['date'] for data in fetcher.get_weather_data(self.past_days)],
+                                 self.past_days[1:])
+                error, = fetcher.errors
+            self.assertEqual((error.day, error.retryable), (self.past_days[0], False))
+            self.assertIn('can not be parsed', error.reason)
+            self.assertIsNone(cache.get(self.past_days[0]))
+        self.assertEqual(self.server.day_requests[self.past_days[0]], 2)
+
+
+class IncrementalSyncTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubForecastServer()
+        self.db_updater = DatabaseUpdater()
+        self.today = datetime.date.today()
+        self.now = datetime.datetime.now()
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def add_forecast(self, day: datetime.date, fetched_at: Optional[datetime.datetime]):
+        Forecast.insert(date=day, temperature=1.0, weather_type='Clear',
+                        weather_category=WEATHER_CATEGORY_CODES[SUN], fetched_at=fetched_at).execute()
+
+    @isolate_db
+    def test_dates_to_sync(self):
+        days = [self.today + datetime.timedelta(days=i) for i in range(-4, 2)]
+        self.add_forecast(days[0], datetime.datetime.combine(days[1], datetime.time()))  # fetched after the day
+        self.add_forecast(days[1], datetime.datetime.combine(days[1], datetime.time(12)))  # forecast for the day
+        self.add_forecast(days[2], None)  # stored before fetch times were saved
+        self.add_forecast(days[4], self.now - datetime.timedelta(seconds=SYNC_TTL / 2))
+        self.add_forecast(days[5], self.now - datetime.timedelta(seconds=SYNC_TTL * 2))
+
+        self.assertEqual(self.db_updater.get_dates_to_sync(days, now=self.now), [days[1], days[2], days[3], days[5]])
+        self.assertEqual(self.db_updater.get_dates_to_sync([]), [])
+
+    @isolate_db
+    def test_only_missing_dates_fetched(self):
+        leader = Manager(base_url=self.server.base_url, cache_path=None)
+        first_date, last_date = self.today, self.today + datetime.timedelta(days=5)
+        self.assertEqual(leader.sync_weather_data(self.db_updater, first_date, last_date), (5, 0))
+        self.db_updater.save_weather_to_db(leader.weather_data)
+
+        self.assertEqual(leader.sync_weather_data(self.db_updater, first_date, last_date + datetime.timedelta(days=2)),
+                         (2, 5))
+        self.assertEqual(self.server.requests_count, 7)
+        self.assertEqual(Forecast.select().where(Forecast.fetched_at.is_null()).count(), 0)
+
+
+class BulkUpsertTest(unittest.TestCase):
+    @isolate_db
+    def test_save_and_update_in_chunks(self):
+        db_updater = DatabaseUpdater()
+        rows = make_forecast_rows(500)
+        db_updater.save_weather_to_db(rows)
+        self.assertEqual(Forecast.select().count(), 500)
+
+        updated_rows = [dict(row, temperature=-100.0) for row in rows[100:300]]
+        db_updater.save_weather_to_db(updated_rows)
+        self.assertEqual(Forecast.select().count(), 500)
+        self.assertEqual(Forecast.select().where(Forecast.temperature == -100).count(), 200)
+        stored = Forecast.get(Forecast.date == rows[0]['date'])
+        self.assertEqual((stored.temperature, stored.weather_category_id),
+                         (rows[0]['temperature'], rows[0][WEATHER_CATEGORY]))
+
+
+class DatabaseConcurrencyTest(unittest.TestCase):
+    WRITERS, READERS, ROWS_PER_WRITE, WRITES = 4, 8, 50, 10
+
+    def setUp(self) -> None:
+        self.database_dir = tempfile.TemporaryDirectory()
+        self.database = create_database(os.path.join(self.database_dir.name, 'stress.db'))
+        with self.database.bind_ctx(MODELS):
+            self.database.create_tables(MODELS)
+        self.errors = []
+
+    def tearDown(self) -> None:
+        self.database.close()
+        self.database_dir.cleanup()
+
+    def run_in_thread(self, func, *args) -> threading.Thread:
+        def target():
+            try:
+                with self.database.connection_context():
+                    func(*args)
+            except Exception as error:
+                self.errors.append(error)
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def write(self, writer: int):
+        rows = make_forecast_rows(self.ROWS_PER_WRITE * self.WRITES, datetime.date(2000 + writer * 300, 1, 1))
+        for i in range(self.WRITES):
+            DatabaseUpdater().save_weather_to_db(rows[i * self.ROWS_PER_WRITE:(i + 1) * self.ROWS_PER_WRITE])
+
+    def read(self):
+        for _ in range(self.WRITES * 2):
+            DatabaseUpdater().get_dates_to_sync([datetime.date(2000, 1, 1), datetime.date(3000, 1, 1)])
+            Forecast.select().count()
+
+    def test_concurrent_writers_and_readers(self):
+        self.assertEqual(self.database.execute_sql('PRAGMA journal_mode').fetchone()[0], 'wal')
+        with self.database.bind_ctx(MODELS):
+            threads = [self.run_in_thread(self.write, writer) for writer in range(self.WRITERS)]
+            threads += [self.run_in_thread(self.read) for _ in range(self.READERS)]
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(self.errors, [])
+            self.assertEqual(Forecast.select().count(), self.WRITERS * self.WRITES * self.ROWS_PER_WRITE)
+
+
+class StreamingReadTest(unittest.TestCase):
+    @isolate_db
+    def test_records_streamed_without_icons(self):
+        db_updater = DatabaseUpdater()
+        rows = make_forecast_rows(20, datetime.date(2021, 10, 1))
+        db_updater.save_weather_to_db(rows)
+
+        with patch('assets.get_assets') as get_assets_in_base:
+            records = db_updater.iter_data_from_db(datetime.date(2021, 10, 2), datetime.date(2021, 10, 21))
+            self.assertNotIsInstance(records, list)
+            records = list(records)
+        get_assets_in_base.assert_not_called()
+        self.assertEqual(records, db_updater.get_data_from_db(datetime.date(2021, 10, 2), datetime.date(2021, 10, 21)))
+        self.assertEqual([record.date for record in records[:2]], ['Fri, 01 Oct', 'Sat, 02 Oct'])
+        self.assertEqual(len(records), 20)
+
+        sunny, no_data = records[0], records[4]
+        self.assertEqual((sunny.icon_path, sunny.color),
+                         (get_norm_and_joined_path(ICONS_PATH, ICONS_DATA[SUN][ICON_FILE_NAME]), (32, 165, 218)))
+        self.assertIs(sunny.icon.base, records[5].icon.base)
+        self.assertIsNone(no_data.icon_path)
+        self.assertIsNone(no_data.icon)
+
+    @isolate_db
+    def test_record_renders_as_decoded_forecast(self):
+        db_updater = DatabaseUpdater()
+        db_updater.save_weather_to_db(make_forecast_rows(2, datetime.date(2021, 10, 14)))
+        image_maker = ImageMaker('')
+        for record in db_updater.iter_data_from_db(datetime.date(2021, 10, 15), datetime.date(2021, 10, 17)):
+            decoded = record._replace(icon_path=record.icon)
+            self.assertTrue(np.array_equal(image_maker.render_postcard(record), image_maker.render_postcard(decoded)))
+
+
+class MultiLocationTest(unittest.TestCase):
+    LOCATIONS = ['59.9343,30.3351', '55.7558,37.6173', '-33.8688,151.2093']
+
+    def setUp(self) -> None:
+        self.server = StubForecastServer()
+        self.first_date = datetime.date.today()
+        self.last_date = self.first_date + datetime.timedelta(days=3)
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def test_parse_locations(self):
+        self.assertEqual(parse_location(' 59.9343 , 30.3351'), '59.9343,30.3351')
+        for text in ('59.9343', 'spb', '91,30', '59.9,181', '59.9,30.3,1'):
+            with self.assertRaises(ValueError):
+                parse_location(text)
+        with tempfile.TemporaryDirectory() as locations_dir:
+            path = os.path.join(locations_dir, 'locations.txt')
+            with open(path, 'w', encoding='utf-8') as locations_file:
+                locations_file.write('# cities\n59.9343,30.3351\n\n55.7558, 37.6173\n59.9343,30.3351\n')
+            self.assertEqual(read_locations(path), self.LOCATIONS[:2])
+
+    @isolate_db
+    def test_forecasts_stored_per_location(self):
+        leader = Manager(base_url=self.server.base_url, cache_path=None, locations=self.LOCATIONS)
+        leader.get_weather_data(self.first_date, self.last_date)
+        self.assertEqual(len(leader.weather_data), 3 * len(self.LOCATIONS))
+        self.assertEqual(self.server.location_requests, Counter(dict.fromkeys(self.LOCATIONS, 3)))
+
+        db_updater = DatabaseUpdater()
+        db_updater.save_weather_to_db(leader.weather_data)
+        for location in self.LOCATIONS:
+            records = db_updater.get_data_from_db(self.first_date, self.last_date, location)
+            self.assertEqual(len(records), 3)
+        self.assertEqual(Forecast.select().where(Forecast.date == self.first_date).count(), len(self.LOCATIONS))
+
+        leader = Manager(base_url=self.server.base_url, cache_path=None, locations=self.LOCATIONS[1:] + ['1,2'])
+        self.assertEqual(leader.sync_weather_data(db_updater, self.first_date, self.last_date), (3, 6))
+
+    @isolate_db
+    def test_hourly_forecasts_per_location(self):
+        leader = Manager(base_url=self.server.base_url, cache_path=None, locations=self.LOCATIONS[:2])
+        db_updater = DatabaseUpdater()
+        leader.get_hourly_weather_data(db_updater, self.first_date, self.last_date)
+        self.assertEqual(len(leader.weather_data), 6)
+        self.assertEqual({data['location'] for data in leader.weather_data}, set(self.LOCATIONS[:2]))
+        for location in self.LOCATIONS[:2]:
+            self.assertEqual(len(db_updater.get_hourly_from_db(self.first_date, self.last_date, location)), 3 * 24)
+
+    @isolate_db
+    def test_hour_of_location_time_zone(self):
+        locations = self.LOCATIONS[::2]
+        self.server.tz_offsets = {self.LOCATIONS[2]: 11}
+        leader = Manager(base_url=self.server.base_url, cache_path=None, locations=locations)
+        with time_zone('America/New_York'), AsyncForecastFetcher(base_url=self.server.base_url) as fetcher:
+            weather_data = fetcher.get_weather_data([self.first_date], locations)
+            leader.get_hourly_weather_data(DatabaseUpdater(), self.first_date,
+                                           self.first_date + datetime.timedelta(days=1))
+        temperature_at_16 = 12.5 + 16 / 10
+        self.assertEqual([data['temperature'] for data in weather_data], [temperature_at_16] * 2)
+        self.assertEqual([data['temperature'] for data in leader.weather_data], [temperature_at_16] * 2)
+
+    def test_pairs_share_concurrency_limit(self):
+        self.server.delay = .05
+        days = [self.first_date, self.last_date]
+        with AsyncForecastFetcher(base_url=self.server.base_url, concurrency=4) as fetcher:
+            weather_data = fetcher.get_weather_data(days, self.LOCATIONS)
+        self.assertEqual([(data['location'], data['date']) for data in weather_data],
+                         [(location, day) for location in self.LOCATIONS for day in days])
+        self.assertEqual(self.server.max_in_flight, 4)
+
+    @isolate_db
+    def test_postcards_saved_per_location(self):
+        with tempfile.TemporaryDirectory() as path_to_save:
+            day1, day2 = self.first_date.strftime(DATE_FORMAT), self.last_date.strftime(DATE_FORMAT)
+            Manager(f'-f {day1} -l {day2} -p -j 1 --locations {" ".join(self.LOCATIONS[:2])}', path_to_save,
+                    base_url=self.server.base_url, cache_path=None).run()
+            self.assertEqual(sorted(os.listdir(path_to_save)), sorted(['55.7558_37.6173', '59.9343_30.3351']))
+            for name in os.listdir(path_to_save):
+                self.assertEqual(get_count_of_postcards(os.path.join(path_to_save, name)), 3)
+
+    @isolate_db
+    def test_sheet_and_timelapse_of_range(self):
+        with tempfile.TemporaryDirectory() as path_to_save:
+            day1, day2 = self.first_date.strftime(DATE_FORMAT), self.last_date.strftime(DATE_FORMAT)
+            Manager(f'-f {day1} -l {day2} --sheet 2 --timelapse', path_to_save, base_url=self.server.base_url,
+                    cache_path=None).run()
+            names = sorted(os.listdir(path_to_save))
+            self.assertEqual([name.split('_')[0] for name in names], ['sheet', 'timelapse'])
+            self.assertEqual(get_count_of_postcards(path_to_save), 1)
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubForecastServer()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = create_database(os.path.join(self.temp_dir.name, 'daemon.db'))
+        setup_database(self.database)
+        self.binding = self.database.bind_ctx(MODELS)
+        self.binding.__enter__()
+        self.path_to_save = os.path.join(self.temp_dir.name, 'postcards')
+        self.today = datetime.date.today()
+
+    def tearDown(self) -> None:
+        self.binding.__exit__(None, None, None)
+        self.database.close()
+        self.server.stop()
+        self.temp_dir.cleanup()
+
+    def make_daemon(self, **params) -> ForecastDaemon:
+        defaults = dict(path_to_save=self.path_to_save, interval=3600, days_ahead=3, base_url=self.server.base_url,
+                        cache_path=None, status_address=None)
+        return ForecastDaemon(**dict(defaults, **params))
+
+    def get_json(self, daemon: ForecastDaemon, path: str) -> tuple[int, dict]:
+        host, port = daemon.status_server.server_address
+        try:
+            with urllib.request.urlopen(f'http://{host}:{port}{path}', timeout=5) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as error:
+            return error.code, json.load(error)
+
+    def test_only_changed_days_rendered(self):
+        daemon = self.make_daemon()
+        daemon.start()
+        try:
+            self.assertEqual(daemon.refresh(), (3, 3, 3))
+            self.assertEqual(get_count_of_postcards(self.path_to_save), 3)
+            self.assertEqual(daemon.refresh(), (0, 0, 0))  # the forecasts are up-to-date
+
+            Forecast.update(fetched_at=datetime.datetime.now() - datetime.timedelta(hours=1)).execute()
+            self.server.summaries[self.today + datetime.timedelta(days=1)] = 'Light Snow'
+            day = self.today + datetime.timedelta(days=2)
+            postcard_path = ImageMaker(self.path_to_save).get_postcard_path(day.strftime(DATE_FORMAT_ON_POSTCARD), day)
+            modified_at = os.path.getmtime(postcard_path)
+            self.assertEqual(daemon.refresh(), (3, 1, 1))
+            self.assertEqual(os.path.getmtime(postcard_path), modified_at)
+        finally:
+            daemon.shutdown()
+        self.assertEqual(self.server.requests_count, 6)
+
+    def test_render_pool_shared_by_refreshes(self):
+        locations = ['59.9343,30.3351', '55.7558,37.6173']
+        daemon = self.make_daemon(workers=2, locations=locations)
+        daemon.start()
+        render_pool = daemon.render_pool
+        try:
+            with patch('batch.create_render_pool') as create_render_pool:
+                self.assertEqual(daemon.refresh(), (6, 6, 6))
+                Forecast.update(fetched_at=datetime.datetime.now() - datetime.timedelta(hours=1)).execute()
+                self.server.summaries[self.today] = 'Light Snow'
+                self.assertEqual(daemon.refresh(), (6, 2, 2))
+            create_render_pool.assert_not_called()
+            self.assertIs(daemon.render_pool, render_pool)
+        finally:
+            daemon.shutdown()
+        self.assertIsNone(daemon.render_pool)
+        with self.assertRaises(RuntimeError):
+            render_pool.submit(int)
+
+    def test_status_and_clean_shutdown(self):
+        daemon = self.make_daemon(status_address=('127.0.0.1', 0))
+        thread = threading.Thread(target=daemon.run_forever)
+        thread.start()
+        try:
+            for _ in range(100):
+                if daemon.get_status()['refresh_count']:
+                    break
+                time.sleep(.05)
+            status_code, status = self.get_json(daemon, '/status')
+            self.assertEqual(status_code, 200)
+            self.assertEqual((status['refresh_count'], status['fetched'], status['rendered']), (1, 3, 3))
+            self.assertTrue(status['healthy'])
+            self.assertEqual(self.get_json(daemon, '/health'), (200, {'status': 'ok'}))
+            self.assertEqual(self.get_json(daemon, '/unknown')[0], 404)
+        finally:
+            daemon.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(daemon.status_server)
+
+    def test_failed_refresh_reported(self):
+        daemon = self.make_daemon(status_address=('127.0.0.1', 0))
+        daemon.start()
+        try:
+            with patch.object(daemon.db_updater, 'save_changed_weather_to_db', side_effect=OSError('disk is full')):
+                self.assertFalse(daemon.refresh_safely())
+            self.assertEqual(self.get_json(daemon, '/health'), (503, {'status': 'failing'}))
+            self.assertEqual(daemon.get_status()['last_error'], 'OSError: disk is full')
+            self.assertTrue(daemon.refresh_safely())
+            self.assertEqual(self.get_json(daemon, '/health')[0], 200)
+        finally:
+            daemon.shutdown()
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubForecastServer()
+        self.days = [datetime.date(2021, 10, 14) + datetime.timedelta(days=i) for i in range(4)]
+        self.server.missing_days = {self.days[-1]}
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = create_database(os.path.join(self.temp_dir.name, 'metrics.db'))
+        setup_database(self.database)
+        self.binding = self.database.bind_ctx(MODELS)
+        self.binding.__enter__()
+
+    def tearDown(self) -> None:
+        disable_metrics()
+        self.binding.__exit__(None, None, None)
+        self.database.close()
+        self.temp_dir.cleanup()
+        self.server.stop()
+
+    def run_pipeline(self, workers: int = 1) -> int:
+        with AsyncForecastFetcher(base_url=self.server.base_url, retries=0) as fetcher:
+            forecast = fetcher.get_weather_data(self.days)
+        db_updater = DatabaseUpdater()
+        db_updater.save_weather_to_db(forecast)
+        records = db_updater.iter_data_for_dates(self.days)
+        return render_postcards(records, os.path.join(self.temp_dir.name, 'postcards'), workers)
+
+    def test_disabled_metrics_collect_nothing(self):
+        self.assertFalse(get_metrics().enabled)
+        self.assertEqual(self.run_pipeline(), 3)
+        self.assertEqual(get_metrics().snapshot(), {'stages': {}, 'counters': {}})
+
+    def test_stages_and_counters_of_run(self):
+        metrics = enable_metrics()
+        self.assertEqual(self.run_pipeline(workers=2), 3)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'pages_fetched': 3, 'pages_failed': 1, 'forecasts_stored': 3,
+                                                'postcards_rendered': 3})
+        stage_counts = {stage: data['count'] for stage, data in snapshot['stages'].items()}
+        self.assertEqual({stage: stage_counts[stage] for stage in ('fetch', 'parse', 'store', 'load', 'render',
+                                                                    'encode', 'write')},
+                         {'fetch': 4, 'parse': 3, 'store': 1, 'load': 3, 'render': 3, 'encode': 3, 'write': 3})
+        for data in snapshot['stages'].values():
+            self.assertEqual(sum(data['buckets']), data['count'])
+            self.assertLessEqual(data['max'], data['sum'])
+
+        summary = metrics.format_summary()
+        self.assertIn('pages_fetched: 3', summary)
+        self.assertTrue(any(line.startswith('render ') for line in summary.splitlines()))
+
+        prometheus = metrics.to_prometheus()
+        self.assertIn('weather_parser_stage_seconds_bucket{stage="fetch",le="+Inf"} 4\n', prometheus)
+        self.assertIn('weather_parser_stage_seconds_count{stage="render"} 3\n', prometheus)
+        self.assertIn('weather_parser_pages_failed_total 1\n', prometheus)
+        lines = [json.loads(line) for line in metrics.to_json_lines().splitlines()]
+        self.assertIn({'type': 'counter', 'name': 'postcards_rendered', 'value': 3},
+                      [{key: line[key] for key in ('type', 'name', 'value')} for line in lines if 'name' in line])
+        self.assertEqual(sum(line['count'] for line in lines if line['type'] == 'stage'), sum(stage_counts.values()))
+
+    def test_run_summary_and_export(self):
+        path_to_save, export_path = os.path.join(self.temp_dir.name, 'postcards'), os.path.join(self.temp_dir.name, 'm')
+        with patch('sys.stdout', io.StringIO()) as stdout:
+            Manager(f'-f {self.days[0]} -l {self.days[-1]} -p -j 1 --metrics-export {export_path} '
+                    f'--metrics-format jsonl', path_to_save, base_url=self.server.base_url, cache_path=None).run()
+        self.assertIn('pages_fetched: 3', stdout.getvalue())
+        with open(export_path) as export_file:
+            lines = [json.loads(line) for line in export_file]
+        self.assertEqual({line['stage'] for line in lines if line['type'] == 'stage'} & {'fetch', 'render'},
+                         {'fetch', 'render'})
+        self.assertFalse(get_metrics().enabled)
+
+    def test_postcards_drawn_one_by_one_counted(self):
+        path_to_save = os.path.join(self.temp_dir.name, 'postcards')
+        with patch('sys.stdout', io.StringIO()) as stdout, patch('postcard.viewImage'):
+            Manager(f'-f {self.days[0]} -l {self.days[-1]} -p --metrics', path_to_save,
+                    base_url=self.server.base_url, cache_path=None).run()
+        self.assertIn('postcards_rendered: 3', stdout.getvalue())
+        self.assertFalse(get_metrics().enabled)
+
+    def test_unchanged_postcards_not_drawn_again(self):
+        path_to_save = os.path.join(self.temp_dir.name, 'postcards')
+        for options, drawn in (('', 3), ('', 0), (' --force', 3)):
+            with patch('sys.stdout', io.StringIO()) as stdout, patch('postcard.viewImage') as view_image:
+                Manager(f'-f {self.days[0]} -l {self.days[-1]} -p --metrics{options}', path_to_save,
+                        base_url=self.server.base_url, cache_path=None).run()
+            self.assertEqual(view_image.call_count, drawn)
+            if not drawn:
+                self.assertIn('postcards_skipped: 3', stdout.getvalue())
+        self.assertEqual(get_count_of_postcards(path_to_save), 3)
+
+    def test_histogram_and_merge(self):
+        metrics, other = Metrics(buckets=(.01, .1)), Metrics(buckets=(.01, .1))
+        for seconds in (.005, .05, .05, 3.):
+            metrics.observe('render', seconds)
+        other.observe('render', .001)
+        other.count('postcards_rendered', 2)
+        metrics.merge(other.pop_snapshot())
+        self.assertEqual(other.snapshot(), {'stages': {}, 'counters': {}})
+        self.assertEqual(metrics.snapshot()['stages']['render']['buckets'], [2, 2, 1])
+        self.assertEqual(metrics.get_percentile('render', .5), .1)
+        self.assertEqual(metrics.get_percentile('render', 1.), 3.)
+        self.assertEqual(metrics.snapshot()['counters'], {'postcards_rendered': 2})
+
+
+class WeatherClassifierTest(unittest.TestCase):
+    EXPECTED_CATEGORIES = {
+        'Breezy and Partly Cloudy': CLOUD, 'Foggy': CLOUD, 'Humid and Overcast': CLOUD, 'Mostly Cloudy': CLOUD,
+        'Overcast': CLOUD, 'Partly Cloudy': CLOUD,
+        'Clear': SUN, 'Sunny': SUN,
+        'Flurries': SNOW, 'Heavy Snow': SNOW, 'Light Snow': SNOW, 'Possible Light Snow': SNOW, 'Snow': SNOW,
+        'Light Rain': RAIN, 'Possible Drizzle': RAIN, 'Possible Light Rain': RAIN, 'Rain': RAIN,
+        'Humid': NO_DATA,
+    }
+
+    def test_summaries_of_samples(self):
+        summaries = {hour['summary'] for _, html in load_html_samples() for hour in extract_hours(html)}
+        self.assertLessEqual(summaries, set(self.EXPECTED_CATEGORIES))
+        for summary, category in self.EXPECTED_CATEGORIES.items():
+            with self.subTest(summary=summary):
+                self.assertEqual(classify_weather_type(summary), category)
+                self.assertEqual(classify_weather_type(summary.lower()), category)
+
+    def test_first_category_wins(self):
+        self.assertEqual(classify_weather_type('Rain and Snow'), RAIN)
+        self.assertEqual(classify_weather_type('Snow and Overcast'), SNOW)
+        self.assertEqual(classify_weather_type('Clear and Breezy'), SUN)
+
+    def test_batch(self):
+        summaries = ['Light Snow', 'Clear', 'Light Snow', 'Humid', 'Rain']
+        hits = classify_weather_type.cache_info().hits
+        self.assertEqual(classify_weather_types(summaries), [SNOW, SUN, SNOW, NO_DATA, RAIN])
+        self.assertEqual(classify_weather_types(iter(summaries)), [SNOW, SUN, SNOW, NO_DATA, RAIN])
+        self.assertGreaterEqual(classify_weather_type.cache_info().hits - hits, 4)
+
+    def test_snow_icon(self):
+        icon_path, color = WeatherMaker._weather_type_handler('Possible Light Snow')
+        self.assertEqual(os.path.basename(icon_path), SNOW_ICON_PATH)
+        self.assertEqual(color, ICONS_DATA[SNOW][COLOR])
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.export_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.export_dir.cleanup()
+
+    def save_forecasts(self):
+        rows = make_forecast_rows(25, datetime.date(2021, 10, 1))
+        DatabaseUpdater().save_weather_to_db(rows + [dict(row, location='55.7558,37.6173') for row in rows[:3]])
+        Forecast.update(fetched_at=datetime.datetime(2023, 3, 15, 16)).execute()
+
+    @isolate_db
+    def test_csv_streamed_in_chunks(self):
+        self.save_forecasts()
+        self.assertEqual([len(chunk) for chunk in iter_forecast_chunks(chunk_size=10)], [10, 10, 8])
+        self.assertEqual(sum(len(chunk) for chunk in iter_forecast_chunks(
+            datetime.date(2021, 10, 2), datetime.date(2021, 10, 12), DEFAULT_LOCATION, chunk_size=4)), 10)
+
+        path = os.path.join(self.export_dir.name, 'forecasts.csv')
+        self.assertEqual(export_forecasts(path, 'csv', location=DEFAULT_LOCATION, chunk_size=7), 25)
+        with open(path, encoding='utf-8', newline='') as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(tuple(rows[0]), EXPORT_COLUMNS)
+        self.assertEqual(rows[0], {
+            'location': DEFAULT_LOCATION, 'date': '2021-10-01', 'temperature': '-20.0',
+            'weather_type': ICONS_DATA[SUN][WEATHER_TYPE], 'weather_category': str(WEATHER_CATEGORY_CODES[SUN]),
+            'weather_category_name': SUN, 'fetched_at': '2023-03-15 16:00:00'})
+        self.assertEqual([row['date'] for row in rows[-2:]], ['2021-10-24', '2021-10-25'])
+        self.assertEqual(os.listdir(self.export_dir.name), ['forecasts.csv'])
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o666 & ~umask)  # as for a file created by open
+
+    @isolate_db
+    def test_command_line(self):
+        self.save_forecasts()
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            export_main(['-', '--location', ' 55.7558 , 37.6173'])
+        self.assertEqual([row['location'] for row in csv.DictReader(io.StringIO(stdout.getvalue()))],
+                         ['55.7558,37.6173'] * 3)
+        with patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit):
+            export_main(['-', '--location', 'moscow'])
+
+    @isolate_db
+    def test_wrong_format_leaves_no_file(self):
+        path = os.path.join(self.export_dir.name, 'forecasts.xlsx')
+        with self.assertRaises(ValueError):
+            export_forecasts(path, 'xlsx')
+        with self.assertRaises(ValueError):
+            export_forecasts('-', 'parquet')
+        self.assertEqual(os.listdir(self.export_dir.name), [])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    @isolate_db
+    def test_columnar_files_typed(self):
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        self.save_forecasts()
+        parquet_path = os.path.join(self.export_dir.name, 'forecasts.parquet')
+        self.assertEqual(export_forecasts(parquet_path, 'parquet', chunk_size=10), 28)
+        self.assertEqual(pyarrow.parquet.ParquetFile(parquet_path).num_row_groups, 3)
+        table = pyarrow.parquet.read_table(parquet_path)
+        self.assertEqual(table.schema.names, list(EXPORT_COLUMNS))
+        self.assertEqual(table.schema.field('date').type, pyarrow.date32())
+        self.assertEqual(table.schema.field('temperature').type, pyarrow.float64())
+        self.assertEqual(table.slice(0, 1).to_pylist(), [{
+            'location': '55.7558,37.6173', 'date': datetime.date(2021, 10, 1), 'temperature': -20.0,
+            'weather_type': ICONS_DATA[SUN][WEATHER_TYPE], 'weather_category': WEATHER_CATEGORY_CODES[SUN],
+            'weather_category_name': SUN, 'fetched_at': datetime.datetime(2023, 3, 15, 16)}])
+
+        arrow_path = os.path.join(self.export_dir.name, 'forecasts.arrow')
+        self.assertEqual(export_forecasts(arrow_path, 'arrow', chunk_size=10), 28)
+        with pyarrow.ipc.open_stream(arrow_path) as reader:
+            self.assertEqual(reader.read_all(), table)
+
+
+class PostcardCacheTest(unittest.TestCase):
+    def test_size_bound_and_versions(self):
+        cache = PostcardCache(max_bytes=10)
+        cache.put('a', 'v1', b'1234')
+        cache.put('b', 'v1', b'1234')
+        self.assertEqual(cache.get('a', 'v1'), b'1234')  # 'b' becomes the least recently used
+        cache.put('c', 'v1', b'1234')
+        self.assertIsNone(cache.get('b', 'v1'))
+        self.assertEqual(cache.get('c', 'v1'), b'1234')
+        self.assertIsNone(cache.get('a', 'v2'))  # the data of 'a' has changed
+        self.assertIsNone(cache.get('a', 'v1'))
+        cache.put('d', 'v1', b'12345678901')  # larger than the cache
+        self.assertEqual(cache.get_stats(), {'items': 1, 'bytes': 4, 'max_bytes': 10, 'hits': 2, 'misses': 3,
+                                             'evictions': 1})
+
+
+class APITest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = create_database(os.path.join(self.temp_dir.name, 'api.db'))
+        setup_database(self.database)
+        self.binding = self.database.bind_ctx(MODELS)
+        self.binding.__enter__()
+        self.rows = make_forecast_rows(5, datetime.date(2021, 10, 14))
+        DatabaseUpdater().save_weather_to_db(self.rows)
+
+        self.server = APIServer(('127.0.0.1', 0))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.binding.__exit__(None, None, None)
+        self.database.close()
+        self.temp_dir.cleanup()
+
+    def get(self, path: str, etag: Optional[str] = None) -> tuple[int, dict, bytes]:
+        request = urllib.request.Request(self.url + path, headers={'If-None-Match': etag} if etag else {})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, dict(response.headers), response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, dict(error.headers), error.read()
+
+    def test_forecasts(self):
+        status, headers, body = self.get('/forecast?from=2021-10-15&to=2021-10-17')
+        self.assertEqual(status, 200)
+        forecasts = json.loads(body)
+        self.assertEqual([(data['date'], data['temperature'], data['weather_category_name']) for data in forecasts],
+                         [('2021-10-15', self.rows[1]['temperature'], RAIN),
+                          ('2021-10-16', self.rows[2]['temperature'], SNOW)])
+        self.assertEqual(self.get('/forecast?from=2021-10-15&to=2021-10-17', headers['ETag'])[0], 304)
+        self.assertEqual(json.loads(self.get('/forecast?from=2022-01-01')[2]), [])
+        self.assertEqual(self.get('/forecast?from=15.10.2021')[0], 400)
+        self.assertEqual(self.get('/forecast?location=north')[0], 400)
+
+    def test_postcards_cached_until_row_changes(self):
+        status, headers, body = self.get('/postcard/2021-10-15')
+        self.assertEqual((status, headers['Content-Type']), (200, 'image/jpeg'))
+        record = DatabaseUpdater().get_data_from_db(datetime.date(2021, 10, 16), datetime.date(2021, 10, 16))[0]
+        self.assertEqual(body, ImageMaker('').encode_postcard(record))
+        self.assertEqual(self.get('/postcard/2021-10-15')[2], body)
+        self.assertEqual(self.get('/postcard/2021-10-15', headers['ETag'])[0], 304)
+
+        Forecast.update(temperature=-30.).where(Forecast.date == datetime.date(2021, 10, 15)).execute()
+        status, new_headers, new_body = self.get('/postcard/2021-10-15', headers['ETag'])
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_headers['ETag'], headers['ETag'])
+        self.assertNotEqual(new_body, body)
+        stats = json.loads(self.get('/stats')[2])
+        self.assertEqual((stats['hits'], stats['misses'], stats['items']), (1, 2, 1))
+
+        self.assertEqual(self.get('/postcard/2022-10-15')[0], 404)
+        self.assertEqual(self.get('/postcard/yesterday')[0], 400)
+        self.assertEqual(self.get('/unknown')[0], 404)
+
+    def test_load_test(self):
+        paths = ['/postcard/2021-10-14', '/postcard/2021-10-15', '/forecast?from=2021-10-14&to=2021-10-19']
+        results = run_load_test(self.url, paths, clients=3, requests_count=30)
+        self.assertEqual((results['requests'], results['statuses']), (30, {'200': 30}))
+        self.assertLessEqual(results['p50_ms'], results['p99_ms'])
+        results = run_load_test(self.url, paths, clients=3, requests_count=30, use_etag=True)
+        self.assertEqual(results['statuses'], {'200': 9, '304': 21})
+
+
+class MigrationTest(unittest.TestCase):
+    LEGACY_ROWS = [
+        ('2021-10-15', '12.35', 'Clear', 'icons/sun.png', '32, 165, 218', '2021-10-16 10:00:00'),
+        ('2021-10-16 00:00:00', '-4', 'Heavy Snow', '', '235, 206, 135', None),
+        ('2021-10-17', '7', 'Foggy', '', '', None),
+        ('2021-10-18', 'n/a', 'Clear', '', '', None),
+    ]
+
+    def setUp(self) -> None:
+        self.database_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.database_dir.name, 'legacy.db')
+
+    def tearDown(self) -> None:
+        self.database_dir.cleanup()
+
+    def create_legacy_database(self, with_fetched_at: bool = True):
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(
+                'CREATE TABLE forecast (id INTEGER PRIMARY KEY, date DATETIME NOT NULL, temperature VARCHAR NOT NULL, '
+                'weather_type VARCHAR NOT NULL, icon_path VARCHAR NOT NULL, colors VARCHAR NOT NULL'
+                + (', fetched_at DATETIME)' if with_fetched_at else ')'))
+            connection.execute('CREATE UNIQUE INDEX forecast_date ON forecast (date)')
+            for row in self.LEGACY_ROWS:
+                values = row if with_fetched_at else row[:-1]
+                connection.execute(f'INSERT INTO forecast (date, temperature, weather_type, icon_path, colors'
+                                   f'{", fetched_at" if with_fetched_at else ""}) '
+                                   f'VALUES ({", ".join("?" * len(values))})', values)
+        connection.close()
+
+    def migrate(self) -> list:
+        db = create_database(self.path)
+        setup_database(db)
+        with db.bind_ctx(MODELS):
+            stored = list(Forecast.select(
+                Forecast.date, Forecast.temperature, Forecast.weather_type, Forecast.weather_category,
+                Forecast.fetched_at
+            ).order_by(Forecast.date).tuples())
+            self.assertEqual({row.location for row in Forecast.select(Forecast.location)}, {DEFAULT_LOCATION})
+            columns = {column.name for column in db.get_columns(Forecast._meta.table_name)}
+            self.assertNotIn('colors', columns)
+            self.assertNotIn('forecast_legacy', db.get_tables())
+            setup_database(db)  # the current schema is left as is
+            self.assertEqual(Forecast.select().count(), len(stored))
+        db.close()
+        return stored
+
+    def test_legacy_rows_converted(self):
+        self.create_legacy_database()
+        self.assertEqual(self.migrate(), [
+            (datetime.date(2021, 10, 15), 12.35, 'Clear', WEATHER_CATEGORY_CODES[SUN],
+             datetime.datetime(2021, 10, 16, 10)),
+            (datetime.date(2021, 10, 16), -4.0, 'Heavy Snow', WEATHER_CATEGORY_CODES[SNOW], None),
+            (datetime.date(2021, 10, 17), 7.0, 'Foggy', WEATHER_CATEGORY_CODES[CLOUD], None),
+            (datetime.date(2021, 10, 18), None, 'Clear', WEATHER_CATEGORY_CODES[SUN], None),
+        ])
+        db = create_database(self.path)
+        with db.bind_ctx(MODELS):
+            record, = DatabaseUpdater().iter_data_for_dates([datetime.date(2021, 10, 18)])
+        db.close()
+        self.assertEqual(record.temperature, NO_TEMPERATURE)
+
+    def test_legacy_rows_without_fetch_times(self):
+        self.create_legacy_database(with_fetched_at=False)
+        self.assertEqual([row[:2] for row in self.migrate()],
+                         [(datetime.date(2021, 10, day), temperature) for day, temperature in
+                          ((15, 12.35), (16, -4.0), (17, 7.0), (18, None))])
+
+    def test_rows_moved_to_default_location(self):
+        with sqlite3.connect(self.path) as connection:
+            connection.execute('CREATE TABLE forecast (date DATE NOT NULL PRIMARY KEY, temperature REAL NOT NULL, '
+                               'weather_type VARCHAR NOT NULL, weather_category INTEGER NOT NULL, fetched_at DATETIME) '
+                               'WITHOUT ROWID')
+            connection.execute("INSERT INTO forecast VALUES ('2021-10-15', 12.35, 'Clear', 1, NULL)")
+            connection.execute('CREATE TABLE hourlyforecast (id INTEGER PRIMARY KEY, date DATE NOT NULL, '
+                               'time INTEGER NOT NULL, summary VARCHAR, temperature REAL, apparent_temperature REAL, '
+                               'precip_probability REAL, humidity REAL, wind_speed REAL)')
+            connection.execute('CREATE UNIQUE INDEX hourlyforecast_time ON hourlyforecast (time)')
+            connection.execute("INSERT INTO hourlyforecast (date, time, temperature) VALUES ('2021-10-15', 1, 2.5)")
+        connection.close()
+        self.assertEqual(self.migrate(), [(datetime.date(2021, 10, 15), 12.35, 'Clear', 1, None)])
+
+        db = create_database(self.path)
+        with db.bind_ctx(MODELS):
+            self.assertEqual(list(HourlyForecast.select(HourlyForecast.location, HourlyForecast.temperature).tuples()),
+                             [(DEFAULT_LOCATION, 2.5)])
+            DatabaseUpdater().save_weather_to_db([{
+                'location': '55.7558,37.6173', 'date': datetime.date(2021, 10, 15), 'temperature': 1.0,
+                WEATHER_TYPE: 'Clear', WEATHER_CATEGORY: WEATHER_CATEGORY_CODES[SUN]}])
+            self.assertEqual(Forecast.select().where(Forecast.date == datetime.date(2021, 10, 15)).count(), 2)
+        db.close()
+
+    def test_new_columns_added(self):
+        with sqlite3.connect(self.path) as connection:
+            connection.execute('CREATE TABLE hourlyforecast (id INTEGER PRIMARY KEY, location VARCHAR NOT NULL, '
+                               'date DATE NOT NULL, time INTEGER NOT NULL, summary VARCHAR, temperature REAL, '
+                               'apparent_temperature REAL, precip_probability REAL, humidity REAL, wind_speed REAL)')
+            connection.execute("INSERT INTO hourlyforecast (location, date, time, temperature) "
+                               "VALUES ('1,2', '2021-10-15', 1, 2.5)")
+        connection.close()
+        db = create_database(self.path)
+        setup_database(db)
+        with db.bind_ctx(MODELS):
+            self.assertEqual(list(HourlyForecast.select(HourlyForecast.temperature, HourlyForecast.tz_offset).tuples()),
+                             [(2.5, None)])
+        db.close()
+
+    def test_forecasts_reclassified(self):
+        db = create_database(self.path)
+        setup_database(db)
+        with db.bind_ctx(MODELS):
+            DatabaseUpdater().save_weather_to_db([
+                {'date': datetime.date(2021, 12, day), 'temperature': -1.0, WEATHER_TYPE: weather_type,
+                 WEATHER_CATEGORY: WEATHER_CATEGORY_CODES[RAIN]}
+                for day, weather_type in ((1, 'Light Snow'), (2, 'Light Rain'), (3, 'Flurries'))])
+            Forecast.update(weather_category=WEATHER_CATEGORY_CODES[NO_DATA]).where(
+                Forecast.date == datetime.date(2021, 12, 3)).execute()
+            db.pragma('user_version', 1)  # the first data version moved the snow from the rain category only
+            setup_database(db)
+            self.assertEqual(list(Forecast.select(Forecast.weather_category).order_by(Forecast.date).tuples()),
+                             [(WEATHER_CATEGORY_CODES[SNOW],), (WEATHER_CATEGORY_CODES[RAIN],),
+                              (WEATHER_CATEGORY_CODES[SNOW],)])
+            self.assertEqual(db.pragma('user_version'), DATA_VERSION)
+        db.close()
+
+
 if __name__ == '__main__':
     unittest.main()
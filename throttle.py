@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Protection of the forecasts site from the fetcher and of the fetcher from an overloaded site.
+
+``TokenBucket`` spaces the requests out to a rate which adapts to the answers of the site: it is halved on every
+throttling or server error answer, paused for the time asked by ``Retry-After``, and grows back step by step
+with the successful answers. ``CircuitBreaker`` stops sending requests after a run of failures: the requests fail
+at once until the site had time to recover, then a trial answer closes the circuit or opens it again.
+
+Both are used by the coroutines of one event loop at a time and need no locks.
+"""
+import asyncio
+import time
+from typing import Optional
+
+from metrics import get_metrics
+
+RATE_INCREASE_STEPS = 10  # successful answers to grow the rate from the minimum by a tenth of the maximum each
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds of the Retry-After header given in seconds, None for a date or a missing header."""
+    try:
+        return max(0., float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """Limits the rate of the requests, letting a burst of them go at once.
+
+    Args:
+        rate: Requests per second while the site answers well.
+        burst: Count of requests let through at once after a pause.
+        min_rate: The rate is not lowered below it.
+        max_pause: The longest pause asked by the site which is honoured, in seconds.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: Optional[float] = None, max_pause: float = 60.):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.max_pause = max_pause
+        self.paused_until = 0.
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Waits for the turn of a request."""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def slow_down(self, retry_after: Optional[float] = None) -> None:
+        """Halves the rate after a throttling or a server error answer, pausing the requests if the site asks to."""
+        now = time.monotonic()
+        self._refill(now)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = min(self._tokens, 0.)  # the requests of the burst wait as well
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + min(retry_after, self.max_pause))
+        get_metrics().count('fetch_throttled')
+
+    def speed_up(self) -> None:
+        """Grows the rate back after a successful answer."""
+        if self.rate < self.max_rate:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.max_rate / RATE_INCREASE_STEPS)
+
+
+class CircuitBreaker:
+    """Fails the requests at once while the site keeps failing.
+
+    The circuit opens after ``failure_threshold`` failures in a row. After ``reset_timeout`` seconds it is half-open:
+    the requests go to the site again, the first failure opens the circuit again and a success closes it.
+
+    Args:
+        failure_threshold: Count of failures in a row opening the circuit.
+        reset_timeout: Seconds before the requests are let through an open circuit.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        return self.OPEN if self.retry_in() > 0 else self.HALF_OPEN
+
+    def retry_in(self) -> float:
+        """Seconds before the requests are let through, 0 if they are let through now."""
+        if self.opened_at is None:
+            return 0.
+        return max(0., self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Whether a request may be sent to the site."""
+        return self.state != self.OPEN
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.opened_at is None and self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            get_metrics().count('circuit_opened')
@@ -1,9 +1,11 @@
 import os
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-import cv2
-from numpy import ndarray
+from constants import ICON_FILE_NAME, ICONS_PATH, ICONS_DATA, POSTCARD_EXTENSION
 
-from constants import ICON_FILE_NAME, ICONS_PATH, ICONS_DATA
+if TYPE_CHECKING:
+    from numpy import ndarray
 
 
 def get_norm_and_joined_path(*args: str) -> str:
@@ -15,23 +17,37 @@ def get_norm_and_joined_path(*args: str) -> str:
     return os.path.normpath(os.path.join(*args))
 
 
-def get_image(weather_type: str) -> ndarray:
+def get_image(weather_type: str) -> 'ndarray':
     """Get image array of a weather type.
 
     :param weather_type: a string representing the type of weather
     :return: an array representing the weather icon image
     """
+    import cv2
+
     icon_name = ICONS_DATA[weather_type][ICON_FILE_NAME]
     path_to_icon = get_norm_and_joined_path(ICONS_PATH, icon_name)
     return cv2.imread(path_to_icon, -1)
 
 
+def make_read_only(image: 'ndarray') -> 'ndarray':
+    """Forbid writing to an image array.
+
+    :param image: an image array
+    :return: the same image array, read-only
+    """
+    image.flags.writeable = False
+    return image
+
+
 def viewImage(image, name_of_window):
     """Display an image.
 
     :param image: an image array to display
     :param name_of_window: a string representing the name of the display window
     """
+    import cv2
+
     cv2.namedWindow(name_of_window, cv2.WINDOW_NORMAL)
     cv2.imshow(name_of_window, image)
     cv2.waitKey(0)
@@ -49,12 +65,22 @@ def get_count_of_postcards(path: str) -> int:
 
     files = set()
     for name in os.listdir(path):
-        if os.path.isfile(os.path.join(path, name)):
+        if name.endswith(POSTCARD_EXTENSION) and os.path.isfile(os.path.join(path, name)):
             files.add(name)
     return len(files)
 
 
-TEST_POSTCARDS_DATA = (
-    (('Partly Cloudy', 'Thu, 14 Oct', '9', get_image('cloud'), (105, 105, 105)), '14_oct.jpg'),
-    (('Possible Light Rain', 'Sat, 16 Oct', '7', get_image('rain'), (225, 105, 65)), '16_oct.jpg'),
-)
+@lru_cache(maxsize=None)
+def get_test_postcards_data() -> tuple:
+    """Postcard data of the tests with the decoded icons and the names of the expected files."""
+    return (
+        (('Partly Cloudy', 'Thu, 14 Oct', '9', get_image('cloud'), (105, 105, 105)), '14_oct.jpg'),
+        (('Possible Light Rain', 'Sat, 16 Oct', '7', get_image('rain'), (225, 105, 65)), '16_oct.jpg'),
+    )
+
+
+def __getattr__(name: str):
+    """Decodes the icons of TEST_POSTCARDS_DATA on its first use instead of on every import of the module."""
+    if name == 'TEST_POSTCARDS_DATA':
+        return get_test_postcards_data()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
+import calendar
 import datetime
 import threading
 import time
-from typing import Tuple
-
-import requests
-from bs4 import BeautifulSoup
+from typing import Optional, Tuple
 
+from classifier import classify_weather_type, ICON_PATHS_AND_COLORS
 from constants import *
-from utils import get_norm_and_joined_path
+from extractor import extract_hours, extract_tz_offset, find_hour, PageLayoutError, TIME_KEY, SUMMARY_KEY, \
+    TEMPERATURE_KEY
+from metrics import get_metrics
 
 
 class WeatherMaker(threading.Thread):
@@ -17,17 +18,45 @@ class WeatherMaker(threading.Thread):
     Args:
         lock: A threading.Lock object for synchronizing access to shared resources.
         day: A datetime.date object representing the day to collect forecast data for.
-        weather_data: A list to hold the collected weather forecast data."""
+        weather_data: A list to hold the collected weather forecast data.
+        location: The coordinates of the forecast location.
+        base_url: The url of the forecasts site."""
 
-    def __init__(self, lock: threading.Lock, day: datetime.date, weather_data: list):
+    def __init__(self, lock: threading.Lock, day: datetime.date, weather_data: list,
+                 location: str = DEFAULT_LOCATION, base_url: str = BASE_URL):
         super().__init__()
         self.weather_data_list = weather_data
         self.lock = lock
         self.day = day
-        self.weather_resp = requests.get(f'{BASE_URL}/{SPB_COORDS}/{str(self.day)}/ca24/en ')
+        self.location = location
+        self.error: Optional[str] = None
+        import requests
+
+        self.weather_resp = requests.get(self.get_url(self.day, base_url, self.location))
 
     @staticmethod
-    def _weather_type_handler(weather_type: str) -> Tuple[str, str]:
+    def get_url(day: datetime.date, base_url: str = BASE_URL, location: str = DEFAULT_LOCATION) -> str:
+        """Returns the url of the page with the forecast for the day.
+
+        Args:
+            day: A datetime.date object representing the day of the forecast.
+            base_url: The url of the forecasts site.
+            location: The coordinates of the forecast location.
+        """
+        return f'{base_url}/{location}/{str(day)}/{FORECAST_UNITS}/{FORECAST_LANGUAGE}'
+
+    @staticmethod
+    def _weather_category(weather_type: str) -> str:
+        """
+        Returns the key of ICONS_DATA for the provided weather type.
+
+        Args:
+            weather_type: A string representing the type of weather forecast.
+        """
+        return classify_weather_type(weather_type)
+
+    @classmethod
+    def _weather_type_handler(cls, weather_type: str) -> Tuple[str, str]:
         """
         Returns a tuple of path to weather icon and color as BGR string for image, based on
         the provided weather type.
@@ -38,56 +67,113 @@ class WeatherMaker(threading.Thread):
         Returns:
             A tuple containing the path to the weather icon and the color as a BGR string for the image.
         """
+        return ICON_PATHS_AND_COLORS[cls._weather_category(weather_type)]
+
+    @classmethod
+    def parse_page(cls, day: datetime.date, html: str, location: str = DEFAULT_LOCATION) -> dict:
+        """Extracts the forecast for the day from the html page of https://darksky.net.
+
+        Args:
+            day: A datetime.date object representing the day of the forecast.
+            html: The text of the page.
+            location: The coordinates of the forecast location.
+
+        Returns:
+            A dict with the location, weather type, date, temperature and weather category code of the forecast.
+
+        Raises:
+            PageLayoutError: If there is no forecast for the day on the page.
+        """
+        with get_metrics().timer('parse'):
+            return cls.make_day_forecast(day, extract_hours(html), location, extract_tz_offset(html))
 
-        sunny_match = re.findall(SUNNY_PATTERN, weather_type)
-        rainy_match = re.findall(RAINY_PATTERN, weather_type)
-        snow_match = re.findall(SNOW_PATTERN, weather_type)
-        cloudy_match = re.findall(CLOUDY_PATTERN, weather_type)
-
-        if sunny_match:
-            key = SUN
-        elif rainy_match:
-            key = RAIN
-        elif snow_match:
-            key = RAIN
-        elif cloudy_match:
-            key = CLOUD
+    @classmethod
+    def make_day_forecast(cls, day: datetime.date, hours: list[dict], location: str = DEFAULT_LOCATION,
+                          tz_offset: Optional[float] = None) -> dict:
+        """Derives the forecast for the day from its hourly forecast, the 16:00 hour of the location is used.
+
+        Args:
+            day: A datetime.date object representing the day of the forecast.
+            hours: Hourly forecast dicts with 'time' (unix timestamp), 'summary' and 'temperature' keys,
+                as extracted from the page or stored in the HourlyForecast table.
+            location: The coordinates of the forecast location.
+            tz_offset: The offset of the local time of the location from UTC in hours, as given on the page.
+                The local time of the machine is used if it is unknown.
+
+        Returns:
+            A dict with the location, weather type, date, temperature and weather category code of the forecast.
+
+        Raises:
+            PageLayoutError: If there is no forecast for 16:00 of the day or its temperature is not a number.
+        """
+        local_time = time.strptime(str(day) + '-16', DATE_HOUR_FORMAT)
+        if tz_offset is None:
+            date_for_searching = int(time.mktime(local_time))
         else:
-            key = NO_DATA
+            date_for_searching = calendar.timegm(local_time) - round(tz_offset * 3600)
+        hour = find_hour(hours, date_for_searching)
+        if hour is None:
+            raise PageLayoutError(f'There is no forecast for {day} 16:00 on the page')
+
+        if hour.get(TEMPERATURE_KEY) is None:
+            raise PageLayoutError(f'There is no temperature for {day} 16:00 on the page')
+        try:
+            temperature = float(hour[TEMPERATURE_KEY])
+        except (TypeError, ValueError) as error:
+            raise PageLayoutError(f'The temperature for {day} 16:00 can not be parsed: {error}') from error
+        summary = hour.get(SUMMARY_KEY)
+        days_difference = (day - datetime.date.today()).days
+
+        if summary and days_difference < 10:
+            weather_type = summary
+        else:
+            weather_type = ICONS_DATA[NO_DATA][WEATHER_TYPE]
+
+        return {
+            'location': location,
+            WEATHER_TYPE: weather_type,
+            'date': day,
+            'temperature': temperature,
+            WEATHER_CATEGORY: WEATHER_CATEGORY_CODES[cls._weather_category(weather_type)]
+        }
+
+    @staticmethod
+    def make_hourly_forecast(day: datetime.date, hours: list[dict], location: str = DEFAULT_LOCATION,
+                             tz_offset: Optional[float] = None) -> list[dict]:
+        """Converts the hourly forecast extracted from the page to fields of the HourlyForecast table.
 
-        icon_data = ICONS_DATA[key]
-        weather_icon = icon_data[ICON_FILE_NAME]
-        color = icon_data[COLOR]
-        icon_path = get_norm_and_joined_path(ICONS_PATH, weather_icon)
-        return icon_path, color
+        Args:
+            day: A datetime.date object representing the day of the page.
+            hours: Hourly forecast dicts extracted from the page.
+            location: The coordinates of the forecast location.
+            tz_offset: The offset of the local time of the location from UTC in hours, as given on the page.
+
+        Returns:
+            A dict per hour, the values absent on the page are None.
+        """
+        return [{
+            'location': location,
+            'date': day,
+            'time': hour[TIME_KEY],
+            'summary': hour.get(SUMMARY_KEY),
+            'temperature': hour.get(TEMPERATURE_KEY),
+            'apparent_temperature': hour.get('apparentTemperature'),
+            'precip_probability': hour.get('precipProbability'),
+            'humidity': hour.get('humidity'),
+            'wind_speed': hour.get('windSpeed'),
+            'tz_offset': tz_offset,
+        } for hour in hours]
 
     def run(self):
-        """ Collects the weather forecast data from https://darksky.net and appends it to the res_holder list. """
-        if self.weather_resp.status_code == 200:
-            html_doc = BeautifulSoup(self.weather_resp.text, features='html.parser')
-            weather_data = html_doc.find_all('script')
-            date_for_searching = int(time.mktime(time.strptime(str(self.day) + '-16', DATE_HOUR_FORMAT)))
-            source = re.findall(f'{date_for_searching}.*?"time"', str(weather_data))
-
-            temperature_source = str(re.findall(r'"temperature":.*?,', str(source[0]))[0])
-            temperature = str(re.findall(r':\d*.?\d*', temperature_source)[0])[1:]
-
-            weather_match = re.findall(r'"summary":"[\w*\s?]*"', str(source[0]))
-            days_difference = (self.day - datetime.date.today()).days
-
-            if weather_match and days_difference < 10:
-                weather_type = str(weather_match[0]).split('":"')[1][:-1]
-            else:
-                weather_type = ICONS_DATA[NO_DATA][WEATHER_TYPE]
-
-            icon, color = self._weather_type_handler(weather_type.lower())
-
-            data = {
-                WEATHER_TYPE: weather_type,
-                'date': self.day,
-                'temperature': temperature,
-                'icon_path': icon,
-                'colors': color
-            }
-            with self.lock:
-                self.weather_data_list.append(data)
+        """ Collects the weather forecast data from https://darksky.net and appends it to the res_holder list.
+        The reason is kept in the error attribute if there is no forecast for the day. """
+        if self.weather_resp.status_code != 200:
+            self.error = f'HTTP {self.weather_resp.status_code}'
+            return
+        try:
+            data = self.parse_page(self.day, self.weather_resp.text, self.location)
+        except PageLayoutError as error:
+            self.error = str(error)
+            return
+        with self.lock:
+            self.weather_data_list.append(data)